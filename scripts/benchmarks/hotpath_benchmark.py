@@ -0,0 +1,329 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+import argparse
+import subprocess
+from synthetic_volumes import SIZES, SEGMENTS, write_dataset
+
+# Runtime and peak memory of the imaging hot paths on synthetic volumes, compared to a baseline.
+#
+# Every benchmark runs in its own interpreter so peak memory is not inflated by the ones before it.
+# Inputs are read before the timed runs, and peak memory is the increase of the process high water
+# mark over the runs (on Linux the mark is reset after loading; elsewhere the loading counts too).
+# The result of the last run is reduced to a digest that is stored with the baseline, so a faster
+# version that computes something else fails too. Nothing is downloaded and no GPU is used.
+
+# Default baseline, measured on a single core with the small and medium volumes
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hotpath_baseline.json")
+
+def _read(info, name):
+    import SimpleITK as sitk
+    return(sitk.ReadImage(info["files"][name]))
+
+def _key(info, name):
+    from picslpipes.utils.image_region_stats import read_key
+    return(read_key(info["files"][name]))
+
+def _merge_label_volumes(info):
+    from picslpipes.utils.merge_label_volumes import merge_label_volumes
+    inputs = { label: _read(info, "seg-"+str(label)) for label in SEGMENTS }
+    return(lambda: merge_label_volumes(inputs, list(SEGMENTS), overlap=True))
+
+def _merge_label_volume_files(info):
+    from picslpipes.utils.merge_label_volumes import merge_label_volume_files
+    inputs = { label: info["files"]["seg-"+str(label)] for label in SEGMENTS }
+    return(lambda: merge_label_volume_files(inputs, list(SEGMENTS), overlap=True))
+
+def _region_stats(info, extended):
+    from picslpipes.utils.image_region_stats import get_simple_itk_stats, stats_to_csv
+    ct = _read(info, "ct")
+    systems = [ (_read(info, "lungs"), _key(info, "lung_key"), "lungs"),
+                (_read(info, "lobes"), _key(info, "lobe_key"), "lobes"),
+                (_read(info, "lobe_vessels"), _key(info, "lobe_key"), "vessels") ]
+    def run():
+        stats = get_simple_itk_stats(ct, systems, extended=extended)
+        rows = []
+        for seg, key, name in systems:
+            rows += stats_to_csv(stats[name], key, name, "simpleitk", "synthetic", "1")
+        return(rows)
+    return(run)
+
+def _numpy_stats(info):
+    from picslpipes.utils.image_region_stats import get_numpy_stats
+    ct = _read(info, "ct")
+    lobes = _read(info, "lobes")
+    key = _key(info, "lobe_key")
+    return(lambda: get_numpy_stats(ct, lobes, key))
+
+def _stats_table(info):
+    from picslpipes.utils.image_region_stats import get_simple_itk_stats
+    from picslpipes.utils.stats_store import stats_to_table, write_csv
+    ct = _read(info, "ct")
+    lobes = _read(info, "lobes")
+    key = _key(info, "lobe_key")
+    stats = get_simple_itk_stats(ct, lobes, key, False)
+    out_file = os.path.join(tempfile.mkdtemp(), "stats.csv")
+    def run():
+        write_csv(stats_to_table(stats, key, "lobes", "simpleitk", "synthetic", "1"), out_file)
+        with open(out_file) as f:
+            return(f.read())
+    return(run)
+
+def _relabel_volume(info):
+    from picslpipes.utils.relabel_volume import relabel_volume
+    lobes = _read(info, "lobes")
+    tables = {"lungs": {1: 1, 2: 1, 3: 2, 4: 2, 5: 2}, "right_middle": {4: 1}}
+    return(lambda: relabel_volume(lobes, tables))
+
+def _clean_label_components(info):
+    from picslpipes.utils.label_cleaning import clean_label_components
+    lobes = _read(info, "lobes")
+    return(lambda: clean_label_components(lobes, min_volume=10.0))
+
+def _itk_texture(info, features):
+    import itk
+    from picslpipes.utils.itk_texture_features import quantize_image, intensity_bounds, roi_texture_feature_image
+    ct = itk.imread(info["files"]["ct"], itk.SS)
+    tumor = itk.imread(info["files"]["seg-3"], itk.UC)
+    hmin, hmax = intensity_bounds(ct, tumor)
+    # itk loads the filter modules on first use, do it before the high water mark is reset
+    itk.CoocurrenceTextureFeaturesImageFilter, itk.RunLengthTextureFeaturesImageFilter
+    bins = 16
+    def run():
+        quantized = quantize_image(ct, bins, hmin, hmax)
+        return(roi_texture_feature_image(quantized, tumor, features, bins, 0, bins, 2, 1, 10))
+    return(run)
+
+def _region_texture(info):
+    from picslpipes.utils.region_texture_features import get_region_texture_stats
+    ct = _read(info, "ct")
+    lobes = _read(info, "lobes")
+    key = _key(info, "lobe_key")
+    return(lambda: get_region_texture_stats(ct, lobes, key, bins=16, hmin=-1000, hmax=0))
+
+# Name to a setup function that loads the inputs and returns the call to time
+BENCHMARKS = {
+    "merge_label_volumes": _merge_label_volumes,
+    "merge_label_volume_files": _merge_label_volume_files,
+    "simpleitk_stats_csv": lambda info: _region_stats(info, False),
+    "simpleitk_stats_extended": lambda info: _region_stats(info, True),
+    "numpy_stats": _numpy_stats,
+    "stats_table_csv": _stats_table,
+    "relabel_volume": _relabel_volume,
+    "clean_label_components": _clean_label_components,
+    "itk_texture_glcm": lambda info: _itk_texture(info, "GLCM"),
+    "itk_texture_glrlm": lambda info: _itk_texture(info, "GLRLM"),
+    "region_texture_stats": _region_texture,
+}
+
+# Benchmarks that must compute the same result as another one
+SAME_RESULT = {"merge_label_volume_files": "merge_label_volumes"}
+
+def _canonical( result ):
+    """
+    JSON-able form of a benchmark result: images become their geometry and a hash of their
+    voxels, floats are rounded to 6 significant digits so the digest does not depend on the
+    last bits of a summation order
+    """
+    import numpy as np
+    if isinstance(result, dict):
+        return({ str(k): _canonical(v) for k, v in result.items() })
+    if isinstance(result, (list, tuple)):
+        return([ _canonical(v) for v in result ])
+    if isinstance(result, (float, np.floating)):
+        return(float(f"{result:.6g}"))
+    if isinstance(result, (int, np.integer)):
+        return(int(result))
+    if result is None or isinstance(result, (str, bool)):
+        return(result)
+    if isinstance(result, np.ndarray):
+        if np.issubdtype(result.dtype, np.floating):
+            # 4 decimals, with -0.0 as 0.0
+            result = np.round(result.astype(np.float64), 4) + 0.0
+        return({"shape": list(result.shape), "dtype": str(result.dtype), "sha256": hashlib.sha256(np.ascontiguousarray(result).tobytes()).hexdigest()})
+    module = type(result).__module__.split('.')[0]
+    if module == "SimpleITK":
+        import SimpleITK as sitk
+        geometry = [ result.GetSpacing(), result.GetOrigin(), result.GetDirection() ]
+        return({"geometry": _canonical(geometry), "voxels": _canonical(sitk.GetArrayFromImage(result))})
+    if module == "itk":
+        import itk
+        geometry = [ tuple(result.GetSpacing()), tuple(result.GetOrigin()), itk.array_from_matrix(result.GetDirection()).ravel().tolist() ]
+        return({"geometry": _canonical(geometry), "voxels": _canonical(itk.array_from_image(result))})
+    raise TypeError("No digest for results of type "+type(result).__name__)
+
+def digest( result ) -> str:
+    """
+    Short hash of a benchmark result, the same for equal results
+    """
+    return(hashlib.sha256(json.dumps(_canonical(result), sort_keys=True).encode()).hexdigest()[:16])
+
+def _high_water_mark() -> int:
+    # Peak RSS in bytes: VmHWM on Linux, ru_maxrss elsewhere
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return(int(line.split()[1]) * 1024)
+    except OSError:
+        pass
+    import resource
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale)
+
+def _current_rss() -> int:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return(int(line.split()[1]) * 1024)
+    except OSError:
+        pass
+    return(_high_water_mark())
+
+def _reset_high_water_mark():
+    # Linux only: writing 5 to clear_refs resets VmHWM to the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def run_benchmark( name: str, info: dict, repeats: int ) -> dict:
+    """
+    Load the inputs of one benchmark and time it, in the current process.
+
+    Returns:
+    dict: "seconds" (fastest run), "mean", "peak_mb", the high water mark increase over the runs,
+    and "digest" of the result of the last run.
+    """
+    func = BENCHMARKS[name](info)
+    _reset_high_water_mark()
+    rss = _current_rss()
+    times = []
+    result = None
+    for i in range(repeats):
+        # Release the previous result before the next run
+        result = None
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    peak = _high_water_mark() - rss
+    return({"seconds": min(times), "mean": sum(times)/len(times), "peak_mb": peak / 2**20, "digest": digest(result)})
+
+def run_child( name: str, info_file: str, repeats: int, timeout: float ) -> dict:
+    """
+    Run one benchmark in a fresh interpreter.
+
+    Returns:
+    dict: The measurements, {"skipped": reason} if a dependency is missing, or {"error": message}.
+    """
+    command = [sys.executable, os.path.abspath(__file__), "--child", name, "--info", info_file, "-r", str(repeats)]
+    try:
+        proc = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return({"error": "timed out after "+str(timeout)+"s"})
+    if proc.returncode == 3:
+        return({"skipped": proc.stdout.strip()})
+    if proc.returncode != 0:
+        lines = proc.stderr.strip().splitlines()
+        return({"error": lines[-1] if len(lines) > 0 else "exit code "+str(proc.returncode)})
+    return(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+def compare( measured: dict, baseline: dict, threshold: float, memory_threshold: float ) -> str:
+    """
+    Status of one benchmark against its baseline entry: "ok", or "FAIL" with the reason
+    """
+    if baseline is None:
+        return("ok (no baseline)")
+    reasons = []
+    if "digest" in baseline and measured["digest"] != baseline["digest"]:
+        reasons.append("result differs from baseline")
+    if measured["seconds"] > baseline["seconds"] * threshold:
+        reasons.append(f"slower than baseline {baseline['seconds']:.3f}s")
+    # Small allocations are noise, only compare memory above 16MB
+    if measured["peak_mb"] > max(baseline["peak_mb"] * memory_threshold, 16.0):
+        reasons.append(f"more memory than baseline {baseline['peak_mb']:.0f}MB")
+    if len(reasons) > 0:
+        return("FAIL "+", ".join(reasons))
+    return("ok")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the imaging hot paths on synthetic CT volumes')
+    parser.add_argument('-s', '--sizes', help='Volume sizes: '+str(list(SIZES.keys())), type=str, nargs='+', default=["small", "medium"])
+    parser.add_argument('-k', '--benchmarks', help='Benchmarks to run (default all): '+str(list(BENCHMARKS.keys())), type=str, nargs='+')
+    parser.add_argument('-d', '--data', help='Directory for the synthetic volumes, reused between runs', type=str,
+                        default=os.path.join(tempfile.gettempdir(), "picslpipes_benchmarks"))
+    parser.add_argument('-r', '--repeats', help='Timed runs per benchmark, the fastest is kept', type=int, default=3)
+    parser.add_argument('-b', '--baseline', help='Baseline json with seconds, peak MB and result digest per size/benchmark', type=str, default=BASELINE)
+    parser.add_argument('-t', '--threshold', help='Allowed slowdown relative to the baseline', type=float, default=1.5)
+    parser.add_argument('-m', '--memory-threshold', help='Allowed peak memory increase relative to the baseline', type=float, default=1.25)
+    parser.add_argument('-u', '--update', help='Write the measurements to the baseline file', action='store_true', default=False)
+    parser.add_argument('--timeout', help='Seconds allowed per benchmark', type=float, default=3600)
+    parser.add_argument('--child', help=argparse.SUPPRESS, type=str)
+    parser.add_argument('--info', help=argparse.SUPPRESS, type=str)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        with open(args.info) as f:
+            info = json.load(f)
+        try:
+            result = run_benchmark(args.child, info, args.repeats)
+        except ImportError as e:
+            print("missing "+str(e.name))
+            return(3)
+        print(json.dumps(result))
+        return(0)
+
+    names = args.benchmarks if args.benchmarks is not None else list(BENCHMARKS.keys())
+    for name in names:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark: "+name)
+            return(1)
+
+    baseline = {}
+    if args.baseline is not None and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    failures = []
+    for size in args.sizes:
+        directory = os.path.join(args.data, size)
+        info = write_dataset(directory, SIZES[size])
+        info_file = os.path.join(directory, "synthetic.json")
+        print(size+": "+" x ".join([ str(n) for n in info["size"] ]))
+        digests = {}
+
+        for name in names:
+            entry = size+"/"+name
+            measured = run_child(name, info_file, args.repeats, args.timeout)
+            if "skipped" in measured:
+                print(f"  {name:28s} skipped ({measured['skipped']})")
+                continue
+            if "error" in measured:
+                print(f"  {name:28s} FAIL {measured['error']}")
+                failures.append(entry)
+                continue
+
+            status = compare(measured, None if args.update else baseline.get(entry), args.threshold, args.memory_threshold)
+            digests[name] = measured["digest"]
+            same = SAME_RESULT.get(name)
+            if same in digests and digests[same] != measured["digest"]:
+                status = ("FAIL" if status.startswith("ok") else status+",")+" result differs from "+same
+            if status.startswith("FAIL"):
+                failures.append(entry)
+            if args.update:
+                baseline[entry] = {"seconds": measured["seconds"], "peak_mb": measured["peak_mb"], "digest": measured["digest"]}
+            print(f"  {name:28s} {measured['seconds']:8.3f}s {measured['peak_mb']:8.1f}MB  {status}")
+
+    if args.update:
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+
+    return(1 if len(failures) > 0 else 0)
+
+if __name__ == "__main__":
+    sys.exit(main())
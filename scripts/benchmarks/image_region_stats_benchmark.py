@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import SimpleITK as sitk
+if __package__ in (None, ""):
+    # Run from a checkout without the package installed: make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "src")))
+from picslpipes.utils.image_region_stats import get_simple_itk_stats, get_numpy_stats
+
+def synthetic_labels(size, n_labels, seed=0):
+    """
+    CT-like noise plus a label map of n_labels random boxes, roughly like a vessel label map.
+    """
+    rng = np.random.default_rng(seed)
+    ct = rng.normal(-700, 150, size[::-1]).astype(np.int16)
+    labels = np.zeros(size[::-1], dtype=np.uint16)
+    for value in range(1, n_labels+1):
+        extent = rng.integers(4, 16, 3)
+        corner = [ rng.integers(0, s-e) for s, e in zip(size[::-1], extent) ]
+        labels[corner[0]:corner[0]+extent[0], corner[1]:corner[1]+extent[1], corner[2]:corner[2]+extent[2]] = value
+
+    ct_img = sitk.GetImageFromArray(ct)
+    ct_img.SetSpacing([0.8, 0.8, 1.5])
+    label_img = sitk.GetImageFromArray(labels)
+    label_img.CopyInformation(ct_img)
+    key = { v: "label-"+str(v) for v in range(1, n_labels+1) }
+    return((ct_img, label_img, key))
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return((result, time.perf_counter()-start))
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the SimpleITK and numpy region stats calculators')
+    parser.add_argument('-s', '--size', help='Image size in x y z', type=int, nargs=3, default=[256, 256, 200])
+    parser.add_argument('-l', '--labels', help='Number of labels', type=int, default=200)
+    parser.add_argument('-r', '--repeats', help='Number of timed runs per calculator', type=int, default=3)
+    args = parser.parse_args()
+
+    ct, labels, key = synthetic_labels(args.size, args.labels)
+    print("size: "+str(args.size)+" labels: "+str(len(key)))
+
+    runs = {
+        "simpleitk extended": lambda: get_simple_itk_stats(ct, labels, key, True),
+        "simpleitk": lambda: get_simple_itk_stats(ct, labels, key, False),
+        "numpy": lambda: get_numpy_stats(ct, labels, key),
+        "numpy extended": lambda: get_numpy_stats(ct, labels, key, shape=["physical_size", "skewness", "elongation", "ellipsoid_diameter"]),
+    }
+
+    results = {}
+    for name, run in runs.items():
+        times = []
+        for i in range(args.repeats):
+            results[name], elapsed = timed(run)
+            times.append(elapsed)
+        print(f"{name:20s} best {min(times):8.3f}s  mean {np.mean(times):8.3f}s")
+
+    # Exact stats should agree, the SimpleITK median is a histogram estimate
+    for metric in ["mean", "minimum", "maximum", "sd"]:
+        diff = max([ abs(results["simpleitk"][v]["intensity"][metric] - results["numpy"][v]["intensity"][metric]) for v in key ])
+        print(f"max abs difference in {metric}: {diff:.3g}")
+
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
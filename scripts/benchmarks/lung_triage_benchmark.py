@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+import socket
+import tempfile
+import argparse
+import numpy as np
+import SimpleITK as sitk
+from synthetic_volumes import SIZES, write_dataset
+
+# Speed and accuracy of the ants_lung triage mode (lung_lobe_segmentation.py -r) against the
+# full resolution extraction: runtime of each path and Dice of the left and right lung.
+# Needs ants and antspynet, with the antspynet weights already in the local cache. The synthetic
+# CTs only exercise the code paths, speedup and Dice for the README come from -i with real scans.
+
+LUNGS = {1: "left", 2: "right"}
+
+def dice( a: np.ndarray, b: np.ndarray, label: int ) -> float:
+    """
+    Dice coefficient of one label in two label arrays, 1 if the label is in neither
+    """
+    in_a = a == label
+    in_b = b == label
+    total = int(in_a.sum()) + int(in_b.sum())
+    if total == 0:
+        return(1.0)
+    return(2.0 * int(np.sum(in_a & in_b)) / total)
+
+def _version( module: str ) -> str:
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return(version(module))
+    except PackageNotFoundError:
+        return("unknown")
+
+def timed_extraction( ct_file: str, out_file: str, resolution: float=None ) -> float:
+    from picslpipes.ct_lung_textures.lung_lobe_segmentation import ants_lung_extraction
+    start = time.perf_counter()
+    ants_lung_extraction(ct_file, out_file, resolution=resolution)
+    return(time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the ants_lung triage mode to the full resolution lung extraction')
+    parser.add_argument('-i', '--input', help='CT volumes (default: the synthetic CTs of --sizes)', type=str, nargs='+')
+    parser.add_argument('-s', '--sizes', help='Synthetic volume sizes: '+str(list(SIZES.keys())), type=str, nargs='+', default=["full"])
+    parser.add_argument('-d', '--data', help='Directory for the synthetic volumes, shared with hotpath_benchmark.py', type=str,
+                        default=os.path.join(tempfile.gettempdir(), "picslpipes_benchmarks"))
+    parser.add_argument('-r', '--resolutions', help='Triage spacings in mm', type=float, nargs='+', default=[2.0, 3.0, 4.0])
+    parser.add_argument('-o', '--output', help='Directory for the masks (default: a temporary directory)', type=str)
+    parser.add_argument('-m', '--min-dice', help='Fail if the Dice of a lung is below this', type=float, default=0.9)
+    parser.add_argument('-c', '--csv', help='Also append the results, with the host and versions, to this csv', type=str)
+    args = parser.parse_args()
+
+    from picslpipes.ct_lung_textures.lung_lobe_segmentation import load_models
+    from picslpipes.utils.io_policy import available_cpus
+
+    inputs = args.input
+    if inputs is None:
+        inputs = [ write_dataset(os.path.join(args.data, size), SIZES[size])["files"]["ct"] for size in args.sizes ]
+    out_dir = args.output if args.output is not None else tempfile.mkdtemp()
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Backend start up is not part of either path
+    load_models(['ants_lung'])
+
+    failed = False
+    header = "ct,resolution,seconds,speedup,"+",".join([ "dice_"+name for name in LUNGS.values() ])
+    # Where and with what the numbers were measured, for the csv
+    context = ",".join([time.strftime("%Y-%m-%d"), socket.gethostname(), str(available_cpus()), _version("antspyx"), _version("antspynet")])
+    log = None
+    if args.csv is not None:
+        new_file = not os.path.exists(args.csv)
+        log = open(args.csv, 'a')
+        if new_file:
+            log.write("date,host,cpus,antspyx,antspynet,"+header+"\n")
+    def report(line):
+        print(line)
+        if log is not None:
+            log.write(context+","+line+"\n")
+            log.flush()
+
+    print(header)
+    for ct_file in inputs:
+        # Parent directory too, the synthetic CTs of every size are all called ct.nii
+        name = os.path.basename(os.path.dirname(os.path.abspath(ct_file)))+"_"+os.path.basename(ct_file).split('.')[0]
+        full_file = os.path.join(out_dir, name+"_lungs.nii.gz")
+        full_seconds = timed_extraction(ct_file, full_file)
+        full = sitk.GetArrayFromImage(sitk.ReadImage(full_file))
+        report(f"{ct_file},full,{full_seconds:.2f},1.00,"+",".join([ "1.0000" for label in LUNGS ]))
+
+        for resolution in args.resolutions:
+            triage_file = os.path.join(out_dir, name+"_lungs_"+str(resolution)+"mm.nii.gz")
+            seconds = timed_extraction(ct_file, triage_file, resolution)
+            triage = sitk.GetArrayFromImage(sitk.ReadImage(triage_file))
+            scores = [ dice(full, triage, label) for label in LUNGS ]
+            report(f"{ct_file},{resolution},{seconds:.2f},{full_seconds/seconds:.2f},"+",".join([ f"{d:.4f}" for d in scores ]))
+            if min(scores) < args.min_dice:
+                failed = True
+
+    if log is not None:
+        log.close()
+    return(1 if failed else 0)
+
+if __name__ == "__main__":
+    sys.exit(main())
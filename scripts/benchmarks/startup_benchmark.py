@@ -0,0 +1,94 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# Entry points and the heavy backends that must not be imported just to start them
+ENTRY_POINTS = {
+    "picslpipes.utils.dicom_seg_meta": ["SimpleITK", "pydicom", "numpy"],
+    "picslpipes.utils.dicom_seg_files": ["SimpleITK", "pydicom", "numpy"],
+    "picslpipes.utils.merge_label_volumes": ["pydicom", "pandas"],
+    "picslpipes.utils.relabel_volume": ["pydicom", "pandas"],
+    "picslpipes.utils.image_region_stats": ["pydicom", "pandas", "itk"],
+    "picslpipes.utils.itk_texture_features": ["SimpleITK", "pydicom", "pandas"],
+    "picslpipes.utils.image_interop": ["SimpleITK", "itk", "ants", "nibabel"],
+    "picslpipes.utils.label_cleaning": ["pydicom", "pandas", "itk"],
+    "picslpipes.utils.geometry_check": ["pydicom", "pandas", "itk"],
+    "picslpipes.utils.tracing": ["SimpleITK", "numpy", "pydicom", "pandas", "itk"],
+    "picslpipes.ct_lung_textures.lung_lobe_segmentation": ["tensorflow", "antspynet", "ants", "nibabel", "totalsegmentator"],
+    "picslpipes.ct_lung_textures.lung_segmentation_client": ["tensorflow", "antspynet", "ants", "nibabel", "totalsegmentator", "numpy"],
+    "picslpipes.pipeline.nsclc": ["tensorflow", "antspynet", "ants", "totalsegmentator", "SimpleITK", "itk"],
+    "picslpipes.pipeline.batch": ["tensorflow", "antspynet", "ants", "totalsegmentator", "SimpleITK", "itk"],
+    "picslpipes.pipeline.scheduler": ["tensorflow", "antspynet", "ants", "totalsegmentator", "SimpleITK", "itk"],
+}
+
+def import_profile(module: str) -> tuple:
+    """
+    Import a module in a fresh interpreter with -X importtime.
+
+    Returns:
+    tuple: Cumulative import time of the module in seconds and the set of top-level packages imported,
+    or None if the import failed (e.g. a required dependency is not installed).
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import "+module],
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        return(None)
+
+    cumulative = None
+    packages = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        if not fields[1].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        packages.add(name.split(".")[0])
+        if name == module:
+            cumulative = int(fields[1]) / 1e6
+    return((cumulative, packages))
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure start up import time of the picslpipes entry points')
+    parser.add_argument('-b', '--baseline', help='Baseline json with import times per entry point', type=str)
+    parser.add_argument('-t', '--threshold', help='Allowed slowdown relative to the baseline', type=float, default=1.5)
+    parser.add_argument('-u', '--update', help='Write the measured times to the baseline file', action='store_true', default=False)
+    parser.add_argument('-r', '--repeats', help='Runs per entry point, the fastest is kept', type=int, default=3)
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline is not None and os.path.exists(args.baseline) and not args.update:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    measured = {}
+    failures = []
+    for module, forbidden in ENTRY_POINTS.items():
+        runs = [ import_profile(module) for i in range(args.repeats) ]
+        if any([ r is None for r in runs ]):
+            print(f"{module:55s} skipped (import failed)")
+            continue
+
+        seconds = min([ r[0] for r in runs ])
+        heavy = sorted(set(forbidden) & runs[0][1])
+        measured[module] = seconds
+
+        status = "ok"
+        if len(heavy) > 0:
+            status = "FAIL imports "+", ".join(heavy)
+            failures.append(module)
+        elif module in baseline and seconds > baseline[module] * args.threshold:
+            status = "FAIL slower than baseline "+str(round(baseline[module], 3))+"s"
+            failures.append(module)
+        print(f"{module:55s} {seconds:7.3f}s  {status}")
+
+    if args.update and args.baseline is not None:
+        with open(args.baseline, 'w') as f:
+            json.dump(measured, f, indent=4)
+
+    return(1 if len(failures) > 0 else 0)
+
+if __name__ == "__main__":
+    sys.exit(main())
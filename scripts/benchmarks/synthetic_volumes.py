@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import SimpleITK as sitk
+
+# Synthetic chest CT volumes and segmentations for the benchmarks, generated offline from a seed.
+#
+# The CT has air around an elliptical body, two ellipsoid lungs, a spinal cord, a tumor in the
+# right lung and random vessel segments inside the lungs, plus Gaussian noise. The label maps
+# follow the pipeline conventions: lungs 1=left 2=right, five lobes (1-2 left, 3-5 right),
+# a binary vessel mask and the vessels labeled by lobe. seg-1..seg-4 are the per-structure
+# binary masks (left lung, right lung, tumor, cord) that merge_label_volumes combines; the tumor
+# overlaps the right lung.
+
+# Voxel counts (x, y, z); "full" matches the 512x512x600 scans of the NSCLC cohort
+SIZES = {
+    "small": (128, 128, 100),
+    "medium": (256, 256, 300),
+    "full": (512, 512, 600),
+}
+
+# Field of view in mm, the spacing follows from the size
+FIELD_OF_VIEW = (360.0, 360.0, 360.0)
+
+SEGMENTS = {1: "Lung-Left", 2: "Lung-Right", 3: "GTV-1", 4: "Spinal-Cord"}
+LUNG_KEY = {1: "left", 2: "right"}
+LOBE_KEY = {1: "left-upper", 2: "left-lower", 3: "right-upper", 4: "right-middle", 5: "right-lower"}
+
+VERSION = "1"
+
+def _ellipsoid( x, y, w, center, radii ):
+    return(((x-center[0])/radii[0])**2 + ((y-center[1])/radii[1])**2 + ((w-center[2])/radii[2])**2 < 1)
+
+def _add_vessels( vessels: np.ndarray, lungs: np.ndarray, count: int, rng ):
+    """
+    Draw count random straight vessel segments starting inside the lungs, clipped to the lungs
+    """
+    shape = np.array(lungs.shape)
+    drawn = 0
+    while drawn < count:
+        start = rng.integers(0, shape)
+        if lungs[tuple(start)] == 0:
+            continue
+        direction = rng.normal(size=3)
+        direction /= np.linalg.norm(direction)
+        length = rng.uniform(0.05, 0.2) * shape.min()
+        radius = rng.uniform(1.0, 3.0)
+        end = start + direction*length
+
+        low = np.maximum(np.floor(np.minimum(start, end) - radius).astype(int), 0)
+        high = np.minimum(np.ceil(np.maximum(start, end) + radius).astype(int) + 1, shape)
+        grid = np.stack(np.meshgrid(*[ np.arange(a, b) for a, b in zip(low, high) ], indexing='ij'), axis=-1)
+        # Distance from each voxel of the box to the segment
+        t = np.clip(((grid - start) @ direction) / length, 0, 1)
+        distance = np.linalg.norm(grid - (start + t[..., None]*direction*length), axis=-1)
+        box = tuple([ slice(a, b) for a, b in zip(low, high) ])
+        vessels[box] |= (distance <= radius) & (lungs[box] > 0)
+        drawn += 1
+
+def synthetic_volumes( size: tuple, seed: int=0, vessels: int=200, slab: int=32 ) -> dict:
+    """
+    Generate the CT and label arrays, indexed [z,y,x].
+
+    Parameters:
+    size (tuple): Voxels along x, y and z.
+    seed (int): Random seed, the same seed gives the same volumes.
+    vessels (int): Number of vessel segments.
+    slab (int): Slices generated at a time, bounds the temporary memory.
+
+    Returns:
+    dict: "ct" (int16 HU), "lungs", "lobes", "vessels", "lobe_vessels", "seg-1".."seg-4" (uint8)
+    and "spacing".
+    """
+    nx, ny, nz = size
+    rng = np.random.default_rng(seed)
+    ct = np.empty((nz, ny, nx), dtype=np.int16)
+    lungs = np.zeros((nz, ny, nx), dtype=np.uint8)
+    lobes = np.zeros((nz, ny, nx), dtype=np.uint8)
+    tumor = np.zeros((nz, ny, nx), dtype=np.uint8)
+    cord = np.zeros((nz, ny, nx), dtype=np.uint8)
+
+    # Normalized coordinates in [-1, 1]: x toward the patient's left, y posterior, w superior
+    x = np.linspace(-1, 1, nx, dtype=np.float32)[None, None, :]
+    y = np.linspace(-1, 1, ny, dtype=np.float32)[None, :, None]
+    z = np.linspace(-1, 1, nz, dtype=np.float32)
+
+    for z0 in range(0, nz, slab):
+        w = z[z0:z0+slab, None, None]
+        s = slice(z0, z0+slab)
+        body = ((x/0.9)**2 + (y/0.7)**2 < 1) & (w > -2)
+        left = _ellipsoid(x, y, w, (0.4, 0.0, 0.1), (0.3, 0.45, 0.7))
+        right = _ellipsoid(x, y, w, (-0.4, 0.0, 0.1), (0.3, 0.45, 0.7))
+        gtv = _ellipsoid(x, y, w, (-0.4, -0.1, 0.2), (0.08, 0.08, 0.08))
+        spinal = ((x/0.04)**2 + ((y-0.55)/0.04)**2 < 1) & (w > -2)
+
+        lungs[s][left] = 1
+        lungs[s][right] = 2
+        # Oblique fissures, and a horizontal one for the right middle lobe
+        fissure = w - 0.5*y
+        lobes[s][left & (fissure > 0.05)] = 1
+        lobes[s][left & (fissure <= 0.05)] = 2
+        lobes[s][right & (fissure > 0.25)] = 3
+        lobes[s][right & (fissure <= 0.25) & (fissure > -0.15) & (y < 0)] = 4
+        lobes[s][right & (lobes[s] == 0)] = 5
+        tumor[s][gtv] = 1
+        cord[s][spinal] = 1
+
+        hu = np.where(body, np.float32(40), np.float32(-1000))
+        hu = np.where(left | right, np.float32(-850), hu)
+        hu = np.where(gtv | spinal, np.float32(30), hu)
+        ct[s] = np.clip(hu + rng.standard_normal(hu.shape, dtype=np.float32)*20, -1024, 3071).astype(np.int16)
+
+    vessel_mask = np.zeros(lungs.shape, dtype=bool)
+    _add_vessels(vessel_mask, lungs, vessels, rng)
+    ct[vessel_mask] = (40 + rng.standard_normal(int(vessel_mask.sum()), dtype=np.float32)*20).astype(np.int16)
+
+    spacing = tuple([ f/n for f, n in zip(FIELD_OF_VIEW, size) ])
+    return({
+        "ct": ct, "lungs": lungs, "lobes": lobes, "vessels": vessel_mask.view(np.uint8),
+        "lobe_vessels": lobes * vessel_mask,
+        "seg-1": (lungs == 1).view(np.uint8), "seg-2": (lungs == 2).view(np.uint8), "seg-3": tumor, "seg-4": cord,
+        "spacing": spacing
+    })
+
+def write_key( filename: str, key: dict ):
+    with open(filename, 'w') as f:
+        f.write("label,name\n")
+        for label, name in key.items():
+            f.write(str(label)+","+name+"\n")
+
+def write_dataset( directory: str, size: tuple, seed: int=0 ) -> dict:
+    """
+    Write the synthetic volumes as uncompressed NIfTI files (so reading them does not dominate
+    the benchmarks) with the label keys, unless a dataset for the same size and seed is already there.
+
+    Returns:
+    dict: Contents of DIRECTORY/synthetic.json: size, seed, spacing and the file of each volume.
+    """
+    info_file = os.path.join(directory, "synthetic.json")
+    if os.path.exists(info_file):
+        with open(info_file) as f:
+            info = json.load(f)
+        if info["size"] == list(size) and info["seed"] == seed and info["version"] == VERSION:
+            return(info)
+
+    os.makedirs(directory, exist_ok=True)
+    volumes = synthetic_volumes(size, seed)
+    spacing = volumes.pop("spacing")
+    files = {}
+    for name, array in volumes.items():
+        img = sitk.GetImageFromArray(array)
+        img.SetSpacing(spacing)
+        files[name] = os.path.join(directory, name+".nii")
+        sitk.WriteImage(img, files[name])
+
+    for name, key in [("lung_key", LUNG_KEY), ("lobe_key", LOBE_KEY), ("vessel_key", {1: "vessel"})]:
+        files[name] = os.path.join(directory, name+".csv")
+        write_key(files[name], key)
+
+    info = {"size": list(size), "seed": seed, "version": VERSION, "spacing": list(spacing), "files": files}
+    with open(info_file, 'w') as f:
+        json.dump(info, f, indent=4)
+    return(info)
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic chest CT volumes and segmentations for the benchmarks')
+    parser.add_argument('-o', '--output', help='Output directory, one subdirectory per size', type=str, required=True)
+    parser.add_argument('-s', '--sizes', help='Sizes to write: '+str(list(SIZES.keys())), type=str, nargs='+', default=["small"])
+    parser.add_argument('--seed', help='Random seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for name in args.sizes:
+        info = write_dataset(os.path.join(args.output, name), SIZES[name], args.seed)
+        print(name+": "+" x ".join([ str(n) for n in info["size"] ])+" in "+os.path.join(args.output, name))
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,10 @@ import os
 import sys
 import json
 import argparse
-import glob
+if __package__ in (None, ""):
+    # Run from a checkout without the package installed: make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "src")))
+from picslpipes.utils.dicom_seg_files import dicom_seg_files
 
 def main():
 
@@ -10,6 +13,7 @@ def main():
     my_parser.add_argument('-d', '--dir', type=str, required=True, help="Base directory for the segmentation files")
     my_parser.add_argument('-i', '--input', type=str, required=True, help="name and labels mapping file")
     my_parser.add_argument('-o', '--output', type=str, required=True, help="file with labels to merge")    
+    my_parser.add_argument('-x', '--index', type=str, required=False, help="segment index database to look the files up in")
     my_parser.add_argument('--verbose', help="Enable verbose output", action='store_true', default=False)
     args = my_parser.parse_args()
 
@@ -19,17 +23,24 @@ def main():
         label_map = json.load(f)
         f.close()
 
+    # One directory listing (or index query) for all labels
+    seg_files = dicom_seg_files(args.dir, [ l for l in label_map.values() if l is not None ], index=args.index)
+    if seg_files is None:
+        return(1)
+
     out_map={}
 
     for k in label_map.keys():
         label = label_map[k]
-        seg_file = glob.glob(os.path.join(args.dir, '*_seg-'+str(label)+'.nii.gz'))
+        if label is None or int(label) not in seg_files:
+            print("No segmentation file for "+k+" (label "+str(label)+") in "+args.dir)
+            return(1)
         out_label = out_labels[k]
-        out_map[out_label] = seg_file[0]
+        out_map[out_label] = seg_files[int(label)]
 
     with open(args.output, 'w') as of:
         json.dump(out_map, of)
         of.close()
 
 if __name__ == "__main__":
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())
@@ -29,72 +29,91 @@ echo "subject: $sub"
 echo "session: $session"
 echo "meta file: $meta_file"
 
-if [ ! -e "${out_dir}/${name}_lung_mask.nii.gz" ]; then
+# Reject the session if the segmentations are not on the CT grid, before any model runs
+if ! python ${py_path}/geometry_check.py -r $ct_file -i ${input_dir}/*_seg-*.nii.gz; then
+  echo "Segmentations are not on the grid of $ct_file"
+  exit 1
+fi
+
+# Intermediates are uncompressed .nii in the scratch directory (PICSLPIPES_SCRATCH, default the
+# output directory). Final .nii.gz outputs are compressed with PICSLPIPES_GZIP_THREADS threads
+# at PICSLPIPES_GZIP_LEVEL, see src/picslpipes/utils/io_policy.py
+# Set PICSLPIPES_TRACE=FILE.jsonl to record the time, memory and I/O of every python step, the
+# Chrome trace FILE.trace.json is written at the end
+scratch=${PICSLPIPES_SCRATCH:-$out_dir}
+mkdir -p $scratch
+lung_mask=${scratch}/${name}_lung_mask.nii
+ants_lung_mask=${scratch}/${name}_ants_lung_mask.nii
+lung_vessels_mask=${scratch}/${name}_lung_vessels_mask.nii
+ts_labels=${scratch}/${name}_ts.nii
+
+# Segment index of the whole dataset (segment_index.py), if one has been built
+seg_index_opt=""
+if [ -n "$PICSLPIPES_SEG_INDEX" ]; then
+  seg_index_opt="-x $PICSLPIPES_SEG_INDEX"
+fi
+
+if [ ! -e "${out_dir}/${name}_lungs.nii.gz" ]; then
   echo "Prepare manual lung segmentation"
-  python ${py_path}/dicom_seg_meta.py -i $meta_file -o ${out_dir}/${name}_seg_labels.json -s Lung-Left Lung-Right
-  python ${scripts}/nsclc_get_seg_files.py -d $input_dir -i ${out_dir}/${name}_seg_labels.json -o ${out_dir}/${name}_seg_files.json
-  python ${py_path}/merge_label_volumes.py -i ${out_dir}/${name}_seg_files.json -o ${out_dir}/${name}_lungs.nii.gz
-  ThresholdImage 3 ${out_dir}/${name}_lungs.nii.gz ${out_dir}/${name}_lung_mask.nii.gz 1 2 1 0
+  python ${py_path}/dicom_seg_meta.py -i $meta_file -o ${out_dir}/${name}_seg_labels.json -s Lung-Left Lung-Right $seg_index_opt
+  python ${scripts}/nsclc_get_seg_files.py -d $input_dir -i ${out_dir}/${name}_seg_labels.json -o ${out_dir}/${name}_seg_files.json $seg_index_opt
+  python ${py_path}/merge_label_volumes.py -i ${out_dir}/${name}_seg_files.json -o ${out_dir}/${name}_lungs.nii.gz -c
+fi
+
+if [ ! -e "$lung_mask" ]; then
+  ThresholdImage 3 ${out_dir}/${name}_lungs.nii.gz $lung_mask 1 2 1 0
 fi
 
 
 if [ ! -e "${out_dir}/${name}_ants_lung_lobes.nii.gz" ]; then
   echo "Segmenting lungs with ANTs"
-  python ${lung_path}/lung_lobe_segmentation.py -i ${out_dir}/${name}_lung_mask.nii.gz -o ${out_dir}/${name}_lung_lobes.nii.gz -m ants_lobes
+  python ${lung_path}/lung_lobe_segmentation.py -i $lung_mask -o ${out_dir}/${name}_lung_lobes.nii.gz -m ants_lobes
   python ${lung_path}/lung_lobe_segmentation.py -i $ct_file -o ${out_dir}/${name}_ants_lungs.nii.gz -m ants_lung
-  ThresholdImage 3 ${out_dir}/${name}_ants_lungs.nii.gz ${out_dir}/${name}_ants_lung_mask.nii.gz 1 2 1 0
-  python ${lung_path}/lung_lobe_segmentation.py -i ${out_dir}/${name}_ants_lung_mask.nii.gz -o ${out_dir}/${name}_ants_lung_lobes.nii.gz -m ants_lobes
+  ThresholdImage 3 ${out_dir}/${name}_ants_lungs.nii.gz $ants_lung_mask 1 2 1 0
+  python ${lung_path}/lung_lobe_segmentation.py -i $ants_lung_mask -o ${out_dir}/${name}_ants_lung_lobes.nii.gz -m ants_lobes
 fi
 
 
 if [ ! -e "${out_dir}/${name}_lung_vessels.nii.gz" ]; then
   echo "Segmenting lung vessels"
-  python ${lung_path}/lung_lobe_segmentation.py -i $ct_file -o ${out_dir}/${name}_lung_vessels_mask.nii.gz -m ts_vessels -x ${out_dir}/${name}_lung_mask.nii.gz
-  ThresholdImage 3 ${out_dir}/${name}_lung_vessels_mask.nii.gz ${out_dir}/${name}_lung_vessels_mask.nii.gz 1 1 1 0
-  ImageMath 3 ${out_dir}/${name}_lobe_vessels.nii.gz m ${out_dir}/${name}_lung_vessels_mask.nii.gz ${out_dir}/${name}_lung_lobes.nii.gz
-  ImageMath 3 ${out_dir}/${name}_lung_vessels.nii.gz m ${out_dir}/${name}_lung_vessels_mask.nii.gz ${out_dir}/${name}_lungs.nii.gz
+  python ${lung_path}/lung_lobe_segmentation.py -i $ct_file -o $lung_vessels_mask -m ts_vessels -x $lung_mask -c 10
+  ThresholdImage 3 $lung_vessels_mask $lung_vessels_mask 1 1 1 0
+  ImageMath 3 ${out_dir}/${name}_lobe_vessels.nii.gz m $lung_vessels_mask ${out_dir}/${name}_lung_lobes.nii.gz
+  ImageMath 3 ${out_dir}/${name}_lung_vessels.nii.gz m $lung_vessels_mask ${out_dir}/${name}_lungs.nii.gz
 fi
 
-if [ ! -e "${out_dir}/${name}_ts.nii.gz" ]; then
-  echo "Running total segmentator"
-  TotalSegmentator -i $ct_file -o ${out_dir}/${name}_ts.nii.gz --ml --task total
-fi
-
-# Extract totalsegmentator lung lobes
-if [ ! -e "${out_dir}/${name}_ts_lungs.nii.gz" ]; then
+# Extract totalsegmentator lung lobes, lungs and lung mask
+if [ ! -e "${out_dir}/${name}_ts_lungs.nii.gz" ] || [ ! -e "${out_dir}/${name}_ts_lung_mask.nii.gz" ]; then
+  if [ ! -e "$ts_labels" ]; then
+    # Only the lobe classes, on the CT cropped to the lung mask (the crop is shared with ts_vessels)
+    echo "Running total segmentator"
+    python ${lung_path}/lung_lobe_segmentation.py -i $ct_file -o $ts_labels -m ts_lobes -x $lung_mask -c 10
+  fi
   echo "Extracting TS lung lobes"
-  ThresholdImage 3 ${out_dir}/${name}_ts.nii.gz ${out_dir}/tmp_lobe1.nii.gz 11 11 1 0
-  ThresholdImage 3 ${out_dir}/${name}_ts.nii.gz ${out_dir}/tmp_lobe2.nii.gz 10 10 2 0
-  ThresholdImage 3 ${out_dir}/${name}_ts.nii.gz ${out_dir}/tmp_lobe3.nii.gz 14 14 3 0
-  ThresholdImage 3 ${out_dir}/${name}_ts.nii.gz ${out_dir}/tmp_lobe4.nii.gz 13 13 4 0
-  ThresholdImage 3 ${out_dir}/${name}_ts.nii.gz ${out_dir}/tmp_lobe5.nii.gz 12 12 5 0
-  ImageMath 3 ${out_dir}/${name}_ts_lung_lobes.nii.gz + ${out_dir}/tmp_lobe1.nii.gz ${out_dir}/tmp_lobe2.nii.gz
-  ImageMath 3 ${out_dir}/${name}_ts_lung_lobes.nii.gz + ${out_dir}/${name}_ts_lung_lobes.nii.gz ${out_dir}/tmp_lobe3.nii.gz
-  ImageMath 3 ${out_dir}/${name}_ts_lung_lobes.nii.gz + ${out_dir}/${name}_ts_lung_lobes.nii.gz ${out_dir}/tmp_lobe4.nii.gz
-  ImageMath 3 ${out_dir}/${name}_ts_lung_lobes.nii.gz + ${out_dir}/${name}_ts_lung_lobes.nii.gz ${out_dir}/tmp_lobe5.nii.gz
-  ThresholdImage 3 ${out_dir}/${name}_ts_lung_lobes.nii.gz ${out_dir}/tmp_left.nii.gz 1 2 1 0
-  ThresholdImage 3 ${out_dir}/${name}_ts_lung_lobes.nii.gz ${out_dir}/tmp_right.nii.gz 3 5 2 0
-  ImageMath 3 ${out_dir}/${name}_ts_lungs.nii.gz + ${out_dir}/tmp_left.nii.gz ${out_dir}/tmp_right.nii.gz
-  ThresholdImage 3 ${out_dir}/${name}_ts_lungs.nii.gz ${out_dir}/${name}_lung_mask.nii.gz 0 0 0 1
-  rm ${out_dir}/tmp*.nii.gz
+  python ${py_path}/relabel_volume.py -i $ts_labels -m ${scripts}/ts_lung_labels.json -o ${out_dir}/${name} -c ts_lung_lobes ts_lungs
 fi
 
-# Texture maps
+# Texture maps, inside the TotalSegmentator lung mask as in picslpipes.pipeline.nsclc
 # this is broken on cluster
 if [ ! -e "${out_dir}/${name}_GLCM.nii.gz" ]; then 
-  python $py_path/itk_texture_features.py -i $ct_file -s ${out_dir}/${name}_lung_mask.nii.gz -f GLCM -o ${out_dir}/${name}_GLCM.nii.gz -b 16 -r 2
-  python $py_path/itk_texture_features.py -i $ct_file -s ${out_dir}/${name}_lung_mask.nii.gz -f GLRLM -o ${out_dir}/${name}_GLRLM.nii.gz -b 16 -r 2 -d 1 -e 10
+  python $py_path/itk_texture_features.py -i $ct_file -s ${out_dir}/${name}_ts_lung_mask.nii.gz -f GLCM GLRLM -o ${out_dir}/${name}_GLCM.nii.gz ${out_dir}/${name}_GLRLM.nii.gz -b 16 -r 2 -d 1 -e 10 -c
 fi
 
 
 
 # Get stats files
-if [ ! -e "${out_dir}/${name}_lobe_vessels_sitk.csv" ]; then 
+key_dir="/project/picsl/jtduda/GlobalHealth/data/NSCLC-Radiomics/info"
+# Cohort stats dataset (stats_store.py), if one is used
+store_opt=""
+if [ -n "$PICSLPIPES_STATS_STORE" ]; then
+  store_opt="--store $PICSLPIPES_STATS_STORE"
+fi
+if [ ! -e "${out_dir}/${name}_region_stats_sitk.csv" ]; then 
   echo "Running summary stats"
-  python $py_path/image_region_stats.py -i $ct_file -s ${out_dir}/${name}_lung_lobes.nii.gz -k /project/picsl/jtduda/GlobalHealth/data/NSCLC-Radiomics/info/lobe_key.csv -n manual-lobes -o ${out_dir}/${name}_lung_lobes_sitk.csv -a $sub -b $session
-  python $py_path/image_region_stats.py -i $ct_file -s ${out_dir}/${name}_lungs.nii.gz -k /project/picsl/jtduda/GlobalHealth/data/NSCLC-Radiomics/info/lung_key.csv -n manual-lungs -o ${out_dir}/${name}_lungs_sitk.csv -a $sub -b $session
-  python $py_path/image_region_stats.py -i $ct_file -s ${out_dir}/${name}_lung_vessels.nii.gz -k /project/picsl/jtduda/GlobalHealth/data/NSCLC-Radiomics/info/vessel_key.csv -n ts-lobe-vessels -o ${out_dir}/${name}_lung_vessels_sitk.csv -a $sub -b $session
-  python $py_path/image_region_stats.py -i $ct_file -s ${out_dir}/${name}_lobe_vessels.nii.gz -k /project/picsl/jtduda/GlobalHealth/data/NSCLC-Radiomics/info/vessel_lobe_key.csv -n ts-vessels -o ${out_dir}/${name}_lobe_vessels_sitk.csv -a $sub -b $session
+  python $py_path/image_region_stats.py $store_opt -e -i $ct_file -a $sub -b $session -o ${out_dir}/${name}_region_stats_sitk.csv \
+    -s ${out_dir}/${name}_lung_lobes.nii.gz ${out_dir}/${name}_lungs.nii.gz ${out_dir}/${name}_lung_vessels.nii.gz ${out_dir}/${name}_lobe_vessels.nii.gz \
+    -k ${key_dir}/lobe_key.csv ${key_dir}/lung_key.csv ${key_dir}/vessel_key.csv ${key_dir}/vessel_lobe_key.csv \
+    -n manual-lobes manual-lungs ts-lobe-vessels ts-vessels
 
   ##python $py_path/image_region_stats.py -i $ct_file -s ${out_dir}/${name}_ -k /project/picsl/jtduda/GlobalHealth/data/NSCLC-Radiomics/info/lung_key.csv -n manual-lungs -o ${out_dir}/${name}_lungs_sitk.csv -a $sub -b $session
 fi
@@ -106,3 +125,8 @@ fi
 
 
 
+
+# One Chrome trace for all the steps above (each step only appends its records)
+if [ -n "$PICSLPIPES_TRACE" ]; then
+  python ${py_path}/tracing.py -i $PICSLPIPES_TRACE > /dev/null
+fi
@@ -9,7 +9,8 @@ setup(
     license='MIT',
     description='An example python package',
     long_description=open('README.md').read(),
-    install_requires=['numpy'],
+    install_requires=['numpy', 'SimpleITK', 'itk', 'nibabel', 'pydicom'],
+    extras_require={'store': ['pyarrow']},
     url='https://github.com/jeffduda/picsl-gh-pipelines',
     author='Jeff Duda',
     author_email='jeff.duda@gmail.com'
@@ -1,50 +1,382 @@
 import os
 import argparse
-import ants
-import antspynet
-import tensorflow as tf
+import json
+import time
+import logging
+import socketserver
 import sys
-import nibabel as nib
-from totalsegmentator.python_api import totalsegmentator
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/ct_lung_textures/lung_lobe_segmentation.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.utils.io_policy import add_io_arguments, apply_io_arguments
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments, traced
 
+# Backends are imported inside the functions that use them, so each model only pays for
+# its own imports (e.g. -m ants_lobes never loads TotalSegmentator)
 
-def totalsegmentator_lung_vessels(img: str, mask: str, out_file: str, verbose=False):
-    ct = nib.load(img)
-    vessel_seg = totalsegmentator(ct, task='lung_vessels')
-    nib.save(vessel_seg, out_file)
+MODELS = ['ants_lung', 'ants_lobes', 'ts_vessels', 'ts_lobes']
 
-    vessel_img = ants.image_read(out_file)
-    vessel_img = ants.threshold_image(vessel_img,1,1,1,0)
+# TotalSegmentator 'total' task classes of the lobes (labels 10-14)
+TS_LOBE_CLASSES = ["lung_upper_lobe_left", "lung_lower_lobe_left", "lung_upper_lobe_right",
+                   "lung_middle_lobe_right", "lung_lower_lobe_right"]
+
+# Margin (mm) around the lung mask kept when cropping the CT for the TotalSegmentator models
+LUNG_CROP_PAD = 10.0
+
+
+# Networks built by load_models (or on first use), by model name. They stay resident for the
+# life of the process, so a --serve daemon or a batch worker builds each one once
+_NETWORKS = {}
+
+def _ants_lung_network() -> dict:
+    """
+    The antspynet CT lung U-Net with its weights and the LUNA16 priors on the network grid, built
+    as antspynet.lung_extraction(modality="ct") builds them on every call
+    """
+    import numpy as np
+    import ants
+    from antspynet.architectures import create_unet_model_3d
+    from antspynet.utilities import get_pretrained_network, get_antsxnet_data
+
+    size = (128, 128, 128)
+    priors = ants.ndimage_to_list(ants.image_read(get_antsxnet_data("luna16LungPriors")))
+    priors = [ ants.resample_image(p, size, use_voxels=True).numpy() - 0.5 for p in priors ]
+    # background, left lung, right lung, airways
+    unet = create_unet_model_3d((*size, len(priors)+1), number_of_outputs=4, mode="classification",
+                                number_of_layers=4, number_of_filters_at_base_layer=16, dropout_rate=0.0,
+                                convolution_kernel_size=(3, 3, 3), deconvolution_kernel_size=(2, 2, 2),
+                                weight_decay=1e-5, additional_options=("attentionGating",))
+    unet.load_weights(get_pretrained_network("lungCtWithPriorsSegmentationWeights"))
+    return({"unet": unet, "size": size, "priors": priors})
+
+def _ants_lobes_network() -> dict:
+    """
+    The antspynet lobe U-Net for lung masks with its weights, template and lobe priors, built as
+    antspynet.lung_extraction(modality="maskLobes") builds them on every call
+    """
+    import ants
+    from antspynet.architectures import create_unet_model_3d
+    from antspynet.utilities import get_pretrained_network, get_antsxnet_data
+
+    template = ants.image_read(get_antsxnet_data("protonLungTemplate"))
+    priors = [ p.numpy() for p in ants.ndimage_to_list(ants.image_read(get_antsxnet_data("protonLobePriors"))) ]
+    unet = create_unet_model_3d((*template.shape, len(priors)+1), number_of_outputs=len(priors)+1, mode="classification",
+                                number_of_filters_at_base_layer=16, number_of_layers=4,
+                                convolution_kernel_size=(3, 3, 3), deconvolution_kernel_size=(2, 2, 2),
+                                dropout_rate=0.0, weight_decay=0, additional_options=("attentionGating",))
+    unet.load_weights(get_pretrained_network("maskLobes"))
+    return({"unet": unet, "template": template, "priors": priors})
+
+def _hold_nnunet_predictors():
+    """
+    Keep the nnU-Net predictors TotalSegmentator loads, so each trained model is read once per process.
+
+    totalsegmentator.nnunet builds and initializes a new nnUNetPredictor for every call. Its
+    nnUNetPredictor is replaced by a subclass whose initialize_from_trained_model_folder restores
+    the network, plans and weights loaded by the first call for the same model folder, folds and
+    checkpoint. Preprocessing, resampling and the export still run per call.
+    """
+    import totalsegmentator.nnunet as ts_nnunet
+    if getattr(ts_nnunet.nnUNetPredictor, "resident", False):
+        return
+    loaded = {}
+
+    class ResidentPredictor(ts_nnunet.nnUNetPredictor):
+        resident = True
+
+        def initialize_from_trained_model_folder(self, model_training_output_dir, use_folds, checkpoint_name="checkpoint_final.pth"):
+            key = (str(model_training_output_dir), str(use_folds), checkpoint_name)
+            if key not in loaded:
+                before = dict(vars(self))
+                super().initialize_from_trained_model_folder(model_training_output_dir, use_folds, checkpoint_name)
+                loaded[key] = { k: v for k, v in vars(self).items() if k not in before or before[k] is not v }
+                logging.info("loaded nnU-Net model "+key[0])
+            vars(self).update(loaded[key])
+
+    ts_nnunet.nnUNetPredictor = ResidentPredictor
+
+def _network(model: str) -> dict:
+    """
+    Resident network of an antspynet model, built on first use
+    """
+    if model not in _NETWORKS:
+        _NETWORKS[model] = _ants_lung_network() if model == 'ants_lung' else _ants_lobes_network()
+    return(_NETWORKS[model])
+
+@traced()
+def load_models(models: list):
+    """
+    Build the networks of the given models once in this process, so later calls reuse them.
+
+    The antspynet U-Nets are built with their weights and priors and kept resident; the ants
+    model functions predict with them instead of rebuilding them per call. For the TotalSegmentator
+    models the backend is imported and its nnU-Net predictors are held across calls: the weights
+    of each trained model are read by the first subject and reused by every later one.
+    :param models: model names as used by -m: ants_lung, ants_lobes, ts_vessels, ts_lobes
+    :return: None
+    """
+    for model in ['ants_lung', 'ants_lobes']:
+        if model in models:
+            _network(model)
+    if 'ts_vessels' in models or 'ts_lobes' in models:
+        import nibabel
+        import totalsegmentator.python_api
+        _hold_nnunet_predictors()
+
+def _file_stamp(filename: str) -> list:
+    st = os.stat(filename)
+    return([os.path.abspath(filename), st.st_size, st.st_mtime_ns])
+
+@traced()
+def lung_crop(img: str, mask: str, pad: float=LUNG_CROP_PAD, crop_dir: str=None) -> tuple:
+    """
+    Crop a CT to the bounding box of the nonzero voxels of a lung mask, padded by pad mm.
+
+    The crop is cached as an uncompressed CTNAME_lungcrop.nii (in crop_dir, else the io_policy
+    scratch directory, else next to the mask) with a json sidecar recording the CT, mask and
+    padding it was made from, so the lobe and vessel models share one crop as long as those
+    are unchanged.
+    :param img: input CT
+    :param mask: lung mask on the grid of img
+    :param pad: margin around the mask in mm
+    :param crop_dir: directory for the cached crop
+    :return: (full CT Volume, cropped CT as a nibabel image, start index, stop index of the crop)
+    """
+    import numpy as np
+    import nibabel as nib
+    from picslpipes.utils.image_interop import from_nibabel, to_nibabel
+    from picslpipes.utils.io_policy import read_volume, scratch_path, write_image
+
+    ct = from_nibabel(nib.load(img))
+    name = os.path.basename(img).replace('.nii.gz', '').replace('.nii', '')
+    crop_file = scratch_path(os.path.join(os.path.dirname(os.path.abspath(mask)), name+'_lungcrop.nii'), crop_dir)
+    sidecar = crop_file.replace('.nii', '.json')
+    key = {"ct": _file_stamp(img), "mask": _file_stamp(mask), "pad": pad}
+
+    if os.path.exists(crop_file) and os.path.exists(sidecar):
+        with open(sidecar) as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            logging.debug("lung_crop: reusing "+crop_file)
+            return((ct, nib.load(crop_file), cached["start"], cached["stop"]))
+
+    mask_img = read_volume(mask)
+    if not mask_img.same_grid(ct):
+        raise ValueError("Mask "+mask+" is not on the grid of "+img)
+    inside = np.asarray(mask_img.array) != 0
+    if not inside.any():
+        raise ValueError("Mask "+mask+" is empty")
+
+    start = []
+    stop = []
+    for axis in range(3):
+        others = tuple([ a for a in range(3) if a != axis ])
+        present = np.flatnonzero(inside.any(axis=others))
+        margin = int(np.ceil(pad / ct.spacing[axis]))
+        start.append(max(int(present[0]) - margin, 0))
+        stop.append(min(int(present[-1]) + 1 + margin, inside.shape[axis]))
+
+    write_image(to_nibabel(ct.crop(start, stop)), crop_file)
+    with open(sidecar, 'w') as f:
+        json.dump({"key": key, "start": start, "stop": stop}, f)
+    logging.debug("lung_crop: "+str(start)+" to "+str(stop)+" of "+str(inside.shape))
+    return((ct, nib.load(crop_file), start, stop))
+
+def _paste_crop(ct, seg, start: list, stop: list):
+    """
+    Volume on the CT grid with the labels of a segmentation of the crop [start, stop) and 0 elsewhere
+    """
+    import numpy as np
+    from picslpipes.utils.image_interop import from_nibabel
+    seg_vol = from_nibabel(seg)
+    labels = np.asarray(seg_vol.array)
+    full = np.zeros(ct.array.shape, dtype=labels.dtype)
+    full[tuple([ slice(a, b) for a, b in zip(start, stop) ])] = labels
+    return(ct.like(full))
+
+@traced()
+def totalsegmentator_lung_vessels(img: str, mask: str, out_file: str, verbose=False, pad: float=None):
+    """
+    Segment the lung vessels with TotalSegmentator, restricted to a mask
+    :param img: input CT
+    :param mask: optional mask, vessels outside its nonzero voxels are removed
+    :param out_file: output vessel mask
+    :param pad: if given (and mask is), only segment the CT cropped to the mask with this margin in mm
+    :return: None
+    """
+    import numpy as np
+    import nibabel as nib
+    from totalsegmentator.python_api import totalsegmentator
+    from picslpipes.utils.image_interop import to_nibabel, from_nibabel
+    from picslpipes.utils.io_policy import read_volume, write_image
+
+    _hold_nnunet_predictors()
+    if pad is not None and mask is not None:
+        ct, crop, start, stop = lung_crop(img, mask, pad)
+        vessel_seg = _paste_crop(ct, totalsegmentator(crop, task='lung_vessels', quiet=not verbose), start, stop)
+    else:
+        ct = nib.load(img)
+        vessel_seg = from_nibabel(totalsegmentator(ct, task='lung_vessels'))
+    vessels = (np.asarray(vessel_seg.array) == 1)
 
     if mask is not None:
-        mask_img = ants.image_read(mask)
-        mask_img = ants.threshold_image(mask_img, 0, 0, 0, 1)
-        vessel_img = mask_img * vessel_img
-    
-    ants.image_write(vessel_img, out_file)
-    
+        mask_img = read_volume(mask)
+        if not mask_img.same_grid(vessel_seg):
+            raise ValueError("Mask "+mask+" is not on the grid of "+img)
+        vessels &= (np.asarray(mask_img.array) != 0)
+
+    write_image(to_nibabel(vessel_seg.like(vessels.astype(np.float32))), out_file)
 
-def ants_lung_extraction(img: str, out_file: str, verbose=False):
+@traced()
+def totalsegmentator_lung_lobes(img: str, mask: str, out_file: str, verbose=False, pad: float=LUNG_CROP_PAD):
     """
-    Extract the lung lobes from a binary mask using ANTs
-    :param mask: input binary mask
+    Segment the lung lobes with TotalSegmentator on the CT cropped to a lung mask.
+
+    Only the lobe classes of the 'total' task are requested (roi_subset) and only the cropped
+    field of view is segmented. The labels keep the 'total' task numbering (10-14), so the
+    output relabels like a full --task total run with ts_lung_labels.json.
+    :param img: input CT
+    :param mask: lung mask on the grid of img, used for the crop
+    :param out_file: output labels on the grid of img
+    :param pad: margin around the mask in mm
+    :return: None
+    """
+    from totalsegmentator.python_api import totalsegmentator
+    from picslpipes.utils.image_interop import to_nibabel
+    from picslpipes.utils.io_policy import write_image
+
+    if mask is None:
+        raise ValueError("ts_lobes needs a lung mask (-x) to crop the CT")
+    _hold_nnunet_predictors()
+    ct, crop, start, stop = lung_crop(img, mask, LUNG_CROP_PAD if pad is None else pad)
+    lobes = totalsegmentator(crop, task='total', roi_subset=TS_LOBE_CLASSES, ml=True, quiet=not verbose)
+    write_image(to_nibabel(_paste_crop(ct, lobes, start, stop)), out_file)
+
+def _resample_labels(labels, size, origin, spacing, direction):
+    """
+    Nearest neighbor resampling of a SimpleITK label image onto the grid of an ANTs image
+    (size, origin, spacing and 3x3 direction), without allocating a reference image
+    """
+    import numpy as np
+    import SimpleITK as sitk
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize([ int(s) for s in size ])
+    resampler.SetOutputOrigin([ float(o) for o in origin ])
+    resampler.SetOutputSpacing([ float(s) for s in spacing ])
+    resampler.SetOutputDirection(np.asarray(direction, dtype=np.float64).ravel().tolist())
+    resampler.SetInterpolator(sitk.sitkNearestNeighbor)
+    resampler.SetDefaultPixelValue(0)
+    return(resampler.Execute(labels))
+
+def _predict_ct_lungs(image, network: dict, verbose=False):
+    """
+    antspynet.lung_extraction(image, modality="ct")['segmentation_image'] with a resident network
+    """
+    import numpy as np
+    import ants
+
+    size = network["size"]
+    # Nearest axis aligned direction, as antspynet simplifies it
+    direction = np.floor(np.abs(image.direction) + 0.5)
+    direction[image.direction < 0] *= -1.0
+    ct = ants.resample_image(image, size, use_voxels=True, interp_type=0)
+    ct[ct < -1000] = -1000
+    ct[ct > 400] = 400
+    ct.set_direction(direction)
+    ct.set_origin((0, 0, 0))
+    ct.set_spacing((1, 1, 1))
+
+    reference = ants.make_image(size, voxval=0, spacing=(1, 1, 1), origin=(0, 0, 0), direction=np.identity(3))
+    center = np.floor(ants.get_center_of_mass(reference * 0 + 1))
+    translation = np.asarray(np.floor(ants.get_center_of_mass(ct * 0 + 1))) - np.asarray(center)
+    xfrm = ants.create_ants_transform(transform_type="Euler3DTransform", center=np.asarray(center), translation=translation)
+    ct = (ct - ct.min()) / (ct.max() - ct.min())
+    warped = ants.apply_ants_transform_to_image(xfrm, ct, reference, interpolation="nearestneighbor")
+    warped = ((warped - warped.min()) / (warped.max() - warped.min())) - 0.5
+
+    batch = np.zeros((1, *size, len(network["priors"])+1))
+    batch[0, :, :, :, 0] = warped.numpy()
+    for i, prior in enumerate(network["priors"]):
+        batch[0, :, :, :, i+1] = prior
+    predicted = network["unet"].predict(batch, verbose=verbose)
+
+    probabilities = []
+    for i in range(predicted.shape[-1]):
+        probability = ants.from_numpy(np.squeeze(predicted[:, :, :, :, i]), origin=warped.origin,
+                                      spacing=warped.spacing, direction=warped.direction)
+        probability = ants.apply_ants_transform_to_image(ants.invert_ants_transform(xfrm), probability, ct)
+        probability = ants.resample_image(probability, resample_params=image.shape, use_voxels=True, interp_type=0)
+        probabilities.append(ants.copy_image_info(image, probability))
+    return(_argmax_image(probabilities, image))
+
+def _predict_mask_lobes(image, network: dict, verbose=False):
+    """
+    antspynet.lung_extraction(image, modality="maskLobes")['segmentation_image'] with a resident network
+    """
+    import numpy as np
+    import ants
+
+    template = network["template"]
+    center = ants.get_center_of_mass(template * 0 + 1)
+    translation = np.asarray(ants.get_center_of_mass(image * 0 + 1)) - np.asarray(center)
+    xfrm = ants.create_ants_transform(transform_type="Euler3DTransform", center=np.asarray(center), translation=translation)
+    warped = ants.apply_ants_transform_to_image(xfrm, image, template)
+    warped_array = warped.numpy()
+    warped_array[warped_array != 0] = 1
+
+    batch = np.zeros((1, *warped_array.shape, len(network["priors"])+1))
+    batch[0, :, :, :, 0] = warped_array
+    for i, prior in enumerate(network["priors"]):
+        batch[0, :, :, :, i+1] = prior
+    predicted = network["unet"].predict(batch, verbose=int(verbose))
+
+    probabilities = []
+    for i in range(predicted.shape[-1]):
+        probability = ants.from_numpy(np.squeeze(predicted[0, :, :, :, i]), origin=warped.origin,
+                                      spacing=warped.spacing, direction=warped.direction)
+        probabilities.append(ants.apply_ants_transform_to_image(ants.invert_ants_transform(xfrm), probability, image))
+    return(_argmax_image(probabilities, image))
+
+def _argmax_image(probabilities: list, image):
+    """
+    Label image of the most probable class at each voxel of image
+    """
+    import numpy as np
+    import ants
+    domain = image * 0 + 1
+    labels = np.argmax(ants.image_list_to_matrix(probabilities, domain), axis=0)
+    return(ants.matrix_to_images(np.expand_dims(labels, axis=0), domain)[0])
+
+@traced()
+def ants_lung_extraction(img: str, out_file: str, verbose=False, resolution: float=None):
+    """
+    Extract the left (1) and right (2) lung from a CT using ANTs
+    :param img: input CT
     :param out_file: output mask
+    :param resolution: if given, triage mode: run the extraction and the cleaning on the CT resampled
+        to this isotropic spacing in mm, and upsample the mask to the CT grid with nearest neighbor
     :return: None
     """
+    import ants
+    import SimpleITK as sitk
+    from picslpipes.utils.io_policy import write_image
+    from picslpipes.utils.image_interop import from_ants, to_sitk
+    from picslpipes.utils.label_cleaning import clean_label_components
+
     ct = ants.image_read(img)
-    lung_ex = antspynet.lung_extraction(ct, modality="ct", verbose=verbose)
-
-    out_mask = lung_ex['segmentation_image']*0
-    lung_left = ants.threshold_image(lung_ex['segmentation_image'], 1, 1, 1, 0)
-    left_cluster = ants.iMath(lung_left, 'GetLargestComponent', 20)
-    #ants.image_write(left_cluster, 'left_cluster.nii.gz')
-    out_mask[left_cluster > 0] = 1
-    lung_right = ants.threshold_image(lung_ex['segmentation_image'], 2, 2, 1, 0)
-    right_cluster = ants.iMath(lung_right, 'GetLargestComponent', 20)
-    #ants.image_write(right_cluster, 'right_cluster.nii.gz')
-    out_mask[right_cluster > 0] = 2
-    ants.image_write(out_mask, out_file)
+    full = ct
+    if resolution is not None:
+        ct = ants.resample_image(full, (resolution, resolution, resolution), use_voxels=False, interp_type=0)
+    lung_ex = _predict_ct_lungs(ct, _network('ants_lung'), verbose=verbose)
+
+    # Largest component of the left (1) and right (2) lung in one connected components pass
+    seg = sitk.Cast(to_sitk(from_ants(lung_ex)), sitk.sitkUInt8)
+    out_mask = clean_label_components(seg, labels=[1, 2])
+    if resolution is not None:
+        out_mask = _resample_labels(out_mask, full.shape, full.origin, full.spacing, full.direction)
+    write_image(out_mask, out_file)
 
+@traced()
 def ants_lung_lobes_from_mask(mask: str, out_file: str, verbose=False):
     """
     Extract the lung lobes from a binary mask using ANTs
@@ -52,41 +384,113 @@ def ants_lung_lobes_from_mask(mask: str, out_file: str, verbose=False):
     :param out_file: output mask
     :return: None
     """
+    import ants
+    from picslpipes.utils.io_policy import write_image
+
     mask_img = ants.image_read(mask)
     mask_img = ants.threshold_image(mask_img, 0, 0, 0, 1)
-    lung_ex = antspynet.lung_extraction(mask_img, modality="maskLobes", verbose=verbose)
-    out_img = lung_ex['segmentation_image'] * mask_img
-    ants.image_write(out_img, out_file)
+    lobes = _predict_mask_lobes(mask_img, _network('ants_lobes'), verbose=verbose)
+    out_img = lobes * mask_img
+    write_image(out_img, out_file)
+
+def run_model(model: str, input: str, mask: str, output: str, verbose=False, pad: float=None, resolution: float=None) -> bool:
+    """
+    Dispatch one segmentation request to the model function
+    :param model: ants_lung, ants_lobes, ts_vessels or ts_lobes
+    :param pad: crop margin in mm for the TotalSegmentator models (ts_vessels runs on the full CT if None)
+    :param resolution: isotropic spacing in mm of the ants_lung triage mode (full resolution if None)
+    :return: False if the model is not recognized
+    """
+    if model=='ants_lung':
+        ants_lung_extraction(input, output, verbose=verbose, resolution=resolution)
+    elif model=='ants_lobes':
+        ants_lung_lobes_from_mask(input, output, verbose=verbose)
+    elif model=='ts_vessels':
+        totalsegmentator_lung_vessels(input, mask, output, pad=pad)
+    elif model=='ts_lobes':
+        totalsegmentator_lung_lobes(input, mask, output, pad=pad)
+    else:
+        return(False)
+    return(True)
+
+class SegmentationRequestHandler(socketserver.StreamRequestHandler):
+    """
+    One JSON request per connection: {"model", "input", "mask", "output", "pad", "resolution"}.
+    Replies with {"status": "ok", "seconds"} or {"status": "error", "error"}.
+    """
+    def handle(self):
+        start = time.time()
+        try:
+            request = json.loads(self.rfile.readline())
+            logging.info("request: "+str(request))
+            if not run_model(request["model"], request["input"], request.get("mask"), request["output"],
+                             pad=request.get("pad"), resolution=request.get("resolution")):
+                reply = {"status": "error", "error": "Model not recognized: "+str(request["model"])}
+            else:
+                reply = {"status": "ok", "seconds": time.time()-start}
+        except Exception as e:
+            logging.exception("request failed")
+            reply = {"status": "error", "error": repr(e)}
+        self.wfile.write((json.dumps(reply)+"\n").encode())
+
+def serve(socket_path: str, models: list):
+    """
+    Load the models once and serve segmentation requests on a local Unix socket.
+
+    The networks built by load_models stay resident and every request predicts with them.
+    Requests are handled one at a time, so the models are never used concurrently.
+    Use lung_segmentation_client.py (same flags as this script plus --socket) to submit jobs.
+    :param socket_path: path of the Unix socket to create
+    :param models: models to build before accepting requests
+    :return: None
+    """
+    load_models(models)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socketserver.UnixStreamServer(socket_path, SegmentationRequestHandler)
+    logging.info("serving on "+socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
 
 def main():
     parser = argparse.ArgumentParser(description='Apply lung segmentation models to a CT volume')
-    parser.add_argument('-i', '--input', help='Input CT volume', type=str, required=True)
+    parser.add_argument('-i', '--input', help='Input CT volume', type=str, required=False)
     parser.add_argument('-x', '--mask', help='Mask to use for segmentation', type=str, required=False)
-    parser.add_argument('-m', '--model', help='Model to use for segmentation', type=str, required=True)
+    parser.add_argument('-m', '--model', help='Model to use for segmentation', type=str, required=False)
     parser.add_argument('-o', '--output', help='Output volume')
+    parser.add_argument('-c', '--crop', help='Run the TotalSegmentator models on the CT cropped to the mask with this margin in mm (ts_lobes default: '+str(LUNG_CROP_PAD)+')', type=float, required=False)
+    parser.add_argument('-r', '--resolution', help='Triage mode for ants_lung: run on the CT resampled to this isotropic spacing in mm and upsample the mask', type=float, required=False)
+    parser.add_argument('--serve', help='Load the models once and serve requests on this Unix socket', type=str, required=False)
+    add_io_arguments(parser)
+    add_trace_arguments(parser)
     args = parser.parse_args()
+    apply_io_arguments(args)
+    apply_trace_arguments(args)
     print(args)
 
-    if args.model=='ants_lung':
-        print("runnning... ants lung extraction")
-        print("input: ", args.input)
-        print("output: ", args.output)
-        ants_lung_extraction(args.input, args.output, verbose=True)
-    elif args.model=='ants_lobes':
-        print("runnning... ants lobe extraction")
-        print("input: ", args.input)
-        print("output: ", args.output)
-        ants_lung_lobes_from_mask(args.input, args.output, verbose=True)
-    elif args.model=='ts_vessels':
-        print("runnning... total segmentator lung vessels")
+    if args.serve is not None:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s - %(levelname)-6s - %(message)s")
+        models = MODELS if args.model is None else [args.model]
+        serve(args.serve, models)
+        return(0)
+
+    if args.input is None or args.model is None:
+        parser.error("-i/--input and -m/--model are required unless --serve is used")
+
+    if args.model in MODELS:
+        print("runnning... "+args.model)
         print("input: ", args.input)
         print("output: ", args.output)
-        totalsegmentator_lung_vessels(args.input, args.mask, args.output)
-    else:
-        print("Model not recognized. Choose from [ants_lung, ants_lobes]")
+
+    if not run_model(args.model, args.input, args.mask, args.output, verbose=True, pad=args.crop, resolution=args.resolution):
+        print("Model not recognized. Choose from "+str(MODELS))
         exit(1)
 
 
 if __name__=="__main__":
     sys.exit(main())
-
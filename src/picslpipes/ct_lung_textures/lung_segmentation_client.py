@@ -0,0 +1,53 @@
+import os
+import sys
+import json
+import socket
+import argparse
+
+def request_segmentation(socket_path: str, model: str, input: str, output: str, mask: str=None, pad: float=None, resolution: float=None) -> dict:
+    """
+    Send one job to a lung_lobe_segmentation.py --serve daemon and wait for the reply
+    :param socket_path: Unix socket of the daemon
+    :return: reply dict with "status" and either "seconds" or "error"
+    """
+    # The daemon has its own working directory
+    request = {
+        "model": model,
+        "input": os.path.abspath(input),
+        "mask": None if mask is None else os.path.abspath(mask),
+        "output": os.path.abspath(output),
+        "pad": pad,
+        "resolution": resolution
+    }
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request)+"\n").encode())
+        reply = sock.makefile('r').readline()
+    return(json.loads(reply))
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply lung segmentation models to a CT volume using a running daemon')
+    parser.add_argument('-i', '--input', help='Input CT volume', type=str, required=True)
+    parser.add_argument('-x', '--mask', help='Mask to use for segmentation', type=str, required=False)
+    parser.add_argument('-m', '--model', help='Model to use for segmentation', type=str, required=True)
+    parser.add_argument('-o', '--output', help='Output volume', required=True)
+    parser.add_argument('-c', '--crop', help='Run the TotalSegmentator models on the CT cropped to the mask with this margin in mm', type=float, required=False)
+    parser.add_argument('-r', '--resolution', help='Triage mode for ants_lung: isotropic spacing in mm to run the extraction at', type=float, required=False)
+    parser.add_argument('-s', '--socket', help='Unix socket of lung_lobe_segmentation.py --serve', type=str, required=True)
+    args = parser.parse_args()
+
+    try:
+        reply = request_segmentation(args.socket, args.model, args.input, args.output, args.mask, args.crop, args.resolution)
+    except OSError as e:
+        print("Could not reach segmentation daemon at "+args.socket+": "+str(e))
+        return(1)
+
+    if reply["status"] != "ok":
+        print("Segmentation failed: "+reply["error"])
+        return(1)
+
+    print("output: "+args.output+" ("+str(round(reply["seconds"], 1))+"s)")
+    return(0)
+
+if __name__=="__main__":
+    sys.exit(main())
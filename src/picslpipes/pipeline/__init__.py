@@ -0,0 +1 @@
+from .dag import Stage, Pipeline
@@ -0,0 +1,127 @@
+import argparse
+import os
+import sys
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/pipeline/batch.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.utils.io_policy import add_io_arguments, apply_io_arguments
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments
+
+MODELS = ['ants_lung', 'ants_lobes', 'ts_vessels', 'ts_lobes']
+
+def _warm_worker(models: list):
+    """
+    Process pool initializer: build the segmentation networks once per worker. They stay resident
+    in lung_lobe_segmentation, so run_model and the pipeline stages of this worker predict with them
+    """
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(name)s - %(levelname)-6s - %(message)s")
+    if len(models) == 0:
+        return
+    from picslpipes.ct_lung_textures.lung_lobe_segmentation import load_models
+    load_models(models)
+
+def _run_session(session_dir: str, out_root: str, key_dir: str, stages: list, cache_dir: str, stats_store: str=None, index: str=None) -> tuple:
+    """
+    Run the NSCLC pipeline for one session directory inside a warm worker
+    """
+    from picslpipes.pipeline.nsclc import nsclc_pipeline
+    start = time.time()
+    session = os.path.basename(os.path.normpath(session_dir))
+    subject = os.path.basename(os.path.dirname(os.path.normpath(session_dir)))
+    out_dir = os.path.join(out_root, subject, session)
+    try:
+        status = nsclc_pipeline(session_dir, out_dir, key_dir, cache_dir, stats_store=stats_store, index=index).run(stages)
+        return((session_dir, status, time.time()-start, None))
+    except Exception as e:
+        return((session_dir, None, time.time()-start, repr(e)))
+
+def run_batch(sessions: list, out_root: str, key_dir: str, jobs: int=1, stages: list=None, cache_dir: str=None, models: list=MODELS, stats_store: str=None, index: str=None) -> dict:
+    """
+    Run the NSCLC pipeline for many session directories on a pool of long-lived workers.
+
+    Each worker builds the segmentation networks once in its initializer (load_models) and then
+    handles sessions until the list is exhausted. The stages of every session predict with the
+    networks resident in the worker, so building the models and reading their weights is paid
+    once per worker instead of once per stage call.
+
+    Parameters:
+    sessions (list): Session directories (SUBJECT/SESSION).
+    out_root (str): Outputs go to out_root/SUBJECT/SESSION.
+    key_dir (str): Directory with the label key csv files.
+    jobs (int): Number of worker processes.
+    stages (list): Only bring these stages up to date (default: all).
+    cache_dir (str): Shared cache store (default: one per output directory).
+    models (list): Models to build once in each worker.
+    stats_store (str): Stats dataset every session's region stats are appended to.
+    index (str): Segment index database the sessions are looked up in (see nsclc.nsclc_pipeline).
+
+    Returns:
+    dict: Session directory to a dict with the stage status, elapsed seconds and error, if any.
+    """
+    results = {}
+    start = time.time()
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=_warm_worker, initargs=(models,)) as pool:
+        futures = [ pool.submit(_run_session, s, out_root, key_dir, stages, cache_dir, stats_store, index) for s in sessions ]
+        for future in as_completed(futures):
+            session_dir, status, elapsed, error = future.result()
+            results[session_dir] = {"status": status, "seconds": elapsed, "error": error}
+            if error is not None:
+                logging.error(session_dir+" failed after "+str(round(elapsed, 1))+"s: "+error)
+            hours = (time.time()-start) / 3600.0
+            logging.info(str(len(results))+"/"+str(len(sessions))+" done, "+str(round(len(results)/hours, 1))+" subjects/hour")
+
+    return(results)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the NSCLC pipeline over many sessions with warm workers')
+    parser.add_argument('-i', '--input', help='Session directories', type=str, nargs='*', default=[])
+    parser.add_argument('-l', '--list', help='Text file with one session directory per line', type=str)
+    parser.add_argument('-o', '--output', help='Output root directory', type=str, required=True)
+    parser.add_argument('-k', '--keys', help='Directory with the label key csv files', type=str, required=True)
+    parser.add_argument('-j', '--jobs', help='Number of worker processes', type=int, default=1)
+    parser.add_argument('-s', '--stages', help='Only bring these stages (and their inputs) up to date', type=str, nargs='+')
+    parser.add_argument('-c', '--cache', help='Shared cache directory', type=str)
+    parser.add_argument('-m', '--models', help='Models to build once per worker: '+str(MODELS), type=str, nargs='*', default=MODELS)
+    parser.add_argument('--store', help='Also append the region stats to this Parquet stats dataset', type=str)
+    parser.add_argument('-x', '--index', help='Segment index database to look the sessions up in (default: $PICSLPIPES_SEG_INDEX)', type=str)
+    parser.add_argument('-v', '--verbose', help="verbose output", action='store_true', default=False)
+    add_io_arguments(parser)
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+    # Workers inherit the settings through the environment
+    apply_io_arguments(args)
+    apply_trace_arguments(args)
+
+    log_level=logging.INFO
+    if args.verbose:
+        log_level=logging.DEBUG
+    logging.basicConfig(level=log_level, format="%(asctime)s %(name)s - %(levelname)-6s - %(message)s")
+
+    sessions = list(args.input)
+    if args.list is not None:
+        with open(args.list) as f:
+            sessions = sessions + [ line.strip() for line in f if len(line.strip()) > 0 ]
+
+    if len(sessions) == 0:
+        logging.error("No session directories given")
+        return(1)
+
+    start = time.time()
+    results = run_batch(sessions, args.output, args.keys, args.jobs, args.stages, args.cache, args.models, args.store, args.index)
+    elapsed = time.time() - start
+
+    failed = [ s for s, r in results.items() if r["error"] is not None ]
+    print("sessions: "+str(len(results))+" failed: "+str(len(failed)))
+    print("throughput: "+str(round(len(results) / (elapsed/3600.0), 1))+" subjects/hour")
+    for s in failed:
+        print("failed: "+s+" "+results[s]["error"])
+
+    return(1 if len(failed) > 0 else 0)
+
+if __name__ == "__main__":
+    sys.exit(main())
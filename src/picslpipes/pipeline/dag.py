@@ -0,0 +1,291 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from picslpipes.utils.tracing import stage as trace_stage
+
+class Stage:
+    """
+    One step of a pipeline: a function called with named input files, output files and parameters.
+
+    Parameters:
+    name (str): Unique stage name.
+    func (callable): Called as func(**inputs, **outputs, **params).
+    inputs (dict): Argument name to input file or directory path.
+    outputs (dict): Argument name to output file path.
+    params (dict): Extra JSON-serializable arguments, included in the cache key.
+    version (str): Bump to invalidate cached results after changing what func does.
+    hash_as (dict): Input argument name to how that input enters the cache key: "content" (the
+    default) hashes the file or everything in the directory, "names" only the names of the files
+    in a directory, for stages that just list it, and "listed" a JSON file plus the content of the
+    files its values name, for stages that read the files a list points to.
+    """
+    def __init__(self, name: str, func, inputs: dict, outputs: dict, params: dict=None, version: str="1", hash_as: dict=None):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = {} if params is None else params
+        self.version = version
+        self.hash_as = {} if hash_as is None else hash_as
+
+    def __repr__(self):
+        return("Stage("+self.name+")")
+
+class FileHasher:
+    """
+    Content hashes of files and directories, memoized on path, size and mtime so unchanged
+    files are only read once across runs.
+    """
+    def __init__(self, memo_file: str=None):
+        self.memo_file = memo_file
+        self.memo = {}
+        if memo_file is not None and os.path.exists(memo_file):
+            with open(memo_file, 'r') as f:
+                self.memo = json.load(f)
+
+    def save(self):
+        if self.memo_file is not None:
+            tmp = self.memo_file+'.tmp.'+str(os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self.memo, f)
+            os.replace(tmp, self.memo_file)
+
+    def hash_file(self, path: str) -> str:
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        if path in self.memo and self.memo[path][0] == stamp:
+            return(self.memo[path][1])
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self.memo[path] = [stamp, digest]
+        return(digest)
+
+    def hash_path(self, path: str) -> str:
+        if not os.path.isdir(path):
+            return(self.hash_file(path))
+
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                h.update(os.path.relpath(file_path, path).encode())
+                h.update(self.hash_file(file_path).encode())
+        return(h.hexdigest())
+
+    def hash_names(self, path: str) -> str:
+        """
+        Hash of the names of the files below a directory, without reading them
+        """
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                h.update(os.path.relpath(os.path.join(root, name), path).encode()+b'\0')
+        return(h.hexdigest())
+
+    def hash_listed(self, path: str) -> str:
+        """
+        Hash of a JSON file and of the files named by its values (a list or a dict)
+        """
+        with open(path, 'r') as f:
+            listed = json.load(f)
+        if isinstance(listed, dict):
+            listed = [ listed[k] for k in sorted(listed.keys()) ]
+        h = hashlib.sha256(self.hash_file(path).encode())
+        for file_path in listed:
+            h.update(self.hash_path(file_path).encode())
+        return(h.hexdigest())
+
+class Pipeline:
+    """
+    A DAG of stages with a content-addressed cache.
+
+    Stage order comes from matching input paths to the output paths of other stages. Each
+    stage's cache key hashes its name, function, version, parameters and the content of its
+    inputs, so a changed image, key file or parameter reruns that stage, and any downstream
+    stage whose inputs change as a result, while untouched stages are skipped. Outputs are
+    hard linked into the cache directory by content hash (copied when the cache is on another
+    filesystem), so deleted outputs, or outputs of an earlier set of inputs, are restored instead
+    of recomputed. Outputs are removed before their stage runs, so writers always create a new
+    file rather than rewriting a cached one in place.
+
+    Parameters:
+    cache_dir (str): Directory for the cache store.
+    """
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.stages = {}
+        os.makedirs(os.path.join(cache_dir, 'keys'), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        self.hasher = FileHasher(os.path.join(cache_dir, 'file_hashes.json'))
+
+    def add(self, stage: Stage) -> Stage:
+        if stage.name in self.stages:
+            raise ValueError("Duplicate stage name: "+stage.name)
+        for other in self.stages.values():
+            shared = set(map(os.path.abspath, other.outputs.values())) & set(map(os.path.abspath, stage.outputs.values()))
+            if len(shared) > 0:
+                raise ValueError("Stages "+other.name+" and "+stage.name+" both write "+str(shared))
+        self.stages[stage.name] = stage
+        return(stage)
+
+    def dependencies(self, stage: Stage) -> list:
+        """
+        Names of the stages that produce the inputs of stage
+        """
+        producers = {}
+        for other in self.stages.values():
+            for path in other.outputs.values():
+                producers[os.path.abspath(path)] = other.name
+        deps = []
+        for path in stage.inputs.values():
+            name = producers.get(os.path.abspath(path))
+            if name is not None and name not in deps:
+                deps.append(name)
+        return(deps)
+
+    def order(self, targets: list=None) -> list:
+        """
+        Stage names in dependency order, limited to targets and their upstream stages
+        """
+        if targets is None:
+            targets = list(self.stages.keys())
+
+        ordered = []
+        visiting = set()
+        def visit(name):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError("Pipeline has a cycle through stage "+name)
+            if name not in self.stages:
+                raise ValueError("Unknown stage: "+name)
+            visiting.add(name)
+            for dep in self.dependencies(self.stages[name]):
+                visit(dep)
+            visiting.remove(name)
+            ordered.append(name)
+
+        for name in targets:
+            visit(name)
+        return(ordered)
+
+    def key(self, stage: Stage) -> str:
+        """
+        Cache key from the stage definition and the content of its inputs
+        """
+        hashers = {"content": self.hasher.hash_path, "names": self.hasher.hash_names, "listed": self.hasher.hash_listed}
+        record = {
+            "name": stage.name,
+            "func": stage.func.__module__+"."+stage.func.__qualname__,
+            "version": stage.version,
+            "params": stage.params,
+            "inputs": { arg: hashers[stage.hash_as.get(arg, "content")](path) for arg, path in sorted(stage.inputs.items()) },
+            "outputs": sorted(stage.outputs.keys())
+        }
+        return(hashlib.sha256(json.dumps(record, sort_keys=True, default=str).encode()).hexdigest())
+
+    def _object_path(self, digest: str) -> str:
+        return(os.path.join(self.cache_dir, 'objects', digest[:2], digest))
+
+    def _link(self, src: str, dst: str) -> None:
+        # Hard link, or copy across filesystems and where links are not supported
+        tmp = dst+'.tmp.'+str(os.getpid())
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+        # Renaming a link onto another link of the same file leaves both names in place
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+    def _store(self, path: str) -> str:
+        digest = self.hasher.hash_file(path)
+        obj = self._object_path(digest)
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            self._link(path, obj)
+        return(digest)
+
+    def _restore(self, digest: str, path: str) -> None:
+        if os.path.exists(path) and self.hasher.hash_file(path) == digest:
+            return
+        logging.debug("Restoring "+path+" from cache")
+        d = os.path.dirname(os.path.abspath(path))
+        os.makedirs(d, exist_ok=True)
+        self._link(self._object_path(digest), path)
+
+    def run_stage(self, stage: Stage, force: bool=False) -> str:
+        """
+        Run one stage unless a cached result for its key exists.
+
+        Returns:
+        str: "cached" if the outputs were already up to date or restored, "ran" otherwise.
+        """
+        for arg, path in stage.inputs.items():
+            if not os.path.exists(path):
+                raise FileNotFoundError("Stage "+stage.name+" input "+arg+" does not exist: "+path)
+
+        key = self.key(stage)
+        key_file = os.path.join(self.cache_dir, 'keys', key+'.json')
+
+        if not force and os.path.exists(key_file):
+            with open(key_file, 'r') as f:
+                stored = json.load(f)
+            if all([ os.path.exists(self._object_path(d)) for d in stored.values() ]) and set(stored.keys()) == set(stage.outputs.keys()):
+                for arg, path in stage.outputs.items():
+                    self._restore(stored[arg], path)
+                logging.info("Stage "+stage.name+": cached")
+                return("cached")
+
+        logging.info("Stage "+stage.name+": running")
+        for path in stage.outputs.values():
+            d = os.path.dirname(os.path.abspath(path))
+            os.makedirs(d, exist_ok=True)
+            # The old output may be a link to a cache object, which an in-place write would change
+            if os.path.lexists(path):
+                os.remove(path)
+
+        with trace_stage("pipeline."+stage.name, outputs=list(stage.outputs.values())):
+            stage.func(**stage.inputs, **stage.outputs, **stage.params)
+
+        stored = {}
+        for arg, path in stage.outputs.items():
+            if not os.path.exists(path):
+                raise FileNotFoundError("Stage "+stage.name+" did not write output "+arg+": "+path)
+            stored[arg] = self._store(path)
+
+        tmp = key_file+'.tmp.'+str(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(stored, f)
+        os.replace(tmp, key_file)
+        return("ran")
+
+    def run(self, targets: list=None, force: list=None) -> dict:
+        """
+        Run the stages needed for targets (default: all) in dependency order.
+
+        Parameters:
+        targets (list): Stage names to bring up to date.
+        force (list): Stage names to rerun even when cached.
+
+        Returns:
+        dict: Stage name to "ran" or "cached".
+        """
+        force = [] if force is None else force
+        status = {}
+        try:
+            for name in self.order(targets):
+                status[name] = self.run_stage(self.stages[name], name in force)
+        finally:
+            self.hasher.save()
+        return(status)
@@ -0,0 +1,293 @@
+import argparse
+import os
+import sys
+import glob
+import json
+import logging
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/pipeline/nsclc.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.pipeline.dag import Stage, Pipeline
+from picslpipes.utils.io_policy import add_io_arguments, apply_io_arguments, scratch_path, write_image
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments
+
+# TotalSegmentator 'total' task labels 10-14 to lobes and lungs: the tables nsclc_radiomics_process.sh
+# passes to relabel_volume.py -m
+TS_LUNG_LABELS_JSON = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..", "scripts", "nsclc_radiomics", "ts_lung_labels.json"))
+LUNG_MASK_LABELS = {"mask": {"1": 1, "2": 1}}
+
+# Segment index database (segment_index.py) used when no index is passed, as in nsclc_radiomics_process.sh
+ENV_SEG_INDEX = "PICSLPIPES_SEG_INDEX"
+
+# Margin (mm) around the lung mask of the cropped TotalSegmentator runs, as LUNG_CROP_PAD in lung_lobe_segmentation.py
+LUNG_CROP_PAD = 10.0
+
+# Stage functions: thin wrappers so every stage reads and writes files. Backends are
+# imported inside each function so cached stages never load them.
+
+def seg_labels(meta: str, labels_json: str, structures: list, index: str=None):
+    from picslpipes.utils.dicom_seg_meta import dicom_seg_meta
+    labels = dicom_seg_meta(structures, meta, index)
+    if labels is None:
+        raise RuntimeError("Could not read the segment labels of "+meta)
+    with open(labels_json, 'w') as of:
+        json.dump(labels, of)
+
+def seg_files(input_dir: str, labels_json: str, files_json: str, out_labels: dict, index: str=None):
+    from picslpipes.utils.dicom_seg_files import dicom_seg_files
+    with open(labels_json) as f:
+        label_map = json.load(f)
+
+    found = dicom_seg_files(input_dir, [ l for l in label_map.values() if l is not None ], index=index)
+    out_map={}
+    for k, label in label_map.items():
+        if found is None or label is None or int(label) not in found:
+            raise FileNotFoundError("No segmentation file for "+k+" in "+input_dir)
+        out_map[out_labels[k]] = found[int(label)]
+
+    with open(files_json, 'w') as of:
+        json.dump(out_map, of)
+
+def merge(files_json: str, merged: str, slab_size: int, clean: bool=False):
+    from picslpipes.utils.merge_label_volumes import merge_label_volume_files
+    with open(files_json) as f:
+        in_files = json.load(f)
+    out_imgs = merge_label_volume_files(in_files, list(in_files.keys()), slab_size)
+    if out_imgs is None:
+        raise RuntimeError("Could not merge "+files_json)
+    merged_image = out_imgs[0]
+    if clean:
+        from picslpipes.utils.label_cleaning import clean_label_components
+        merged_image = clean_label_components(merged_image)
+    write_image(merged_image, merged)
+
+def decode_seg(seg: str, ct: str, merged: str, structures: list, clean: bool=False):
+    from picslpipes.utils.dicom_seg_meta import dicom_seg_meta_dcm
+    from picslpipes.utils.dicom_seg_decode import decode_dicom_seg
+    label_map = dicom_seg_meta_dcm(structures, seg)
+    if label_map is None or None in label_map.values():
+        raise RuntimeError("Structures "+str(structures)+" not found in "+seg)
+    out_imgs = decode_dicom_seg(seg, ct, [ label_map[s] for s in structures ])
+    if out_imgs is None:
+        raise RuntimeError("Could not decode "+seg)
+    merged_image = out_imgs[0]
+    if clean:
+        from picslpipes.utils.label_cleaning import clean_label_components
+        merged_image = clean_label_components(merged_image)
+    write_image(merged_image, merged)
+
+def relabel(labels: str, tables: dict=None, clean: list=None, mapping: str=None, **outputs):
+    import SimpleITK as sitk
+    from picslpipes.utils.relabel_volume import relabel_volume
+    if mapping is not None:
+        # Tables from a relabel_volume.py -m json, an input so edits to it rerun the stage
+        with open(mapping) as f:
+            tables = json.load(f)
+    out_images = relabel_volume(sitk.ReadImage(labels), tables)
+    if out_images is None:
+        raise RuntimeError("Could not relabel "+labels)
+    if clean is not None:
+        # Only maps with one connected region per label, e.g. not the single label lung masks
+        from picslpipes.utils.label_cleaning import clean_label_components
+        for name in clean:
+            out_images[name] = clean_label_components(out_images[name])
+    for name, path in outputs.items():
+        write_image(out_images[name], path)
+
+def ants_lungs(ct: str, lungs: str):
+    from picslpipes.ct_lung_textures.lung_lobe_segmentation import ants_lung_extraction
+    ants_lung_extraction(ct, lungs)
+
+def ants_lobes(mask: str, lobes: str):
+    from picslpipes.ct_lung_textures.lung_lobe_segmentation import ants_lung_lobes_from_mask
+    ants_lung_lobes_from_mask(mask, lobes)
+
+def ts_vessels(ct: str, mask: str, vessels: str, pad: float=None):
+    from picslpipes.ct_lung_textures.lung_lobe_segmentation import totalsegmentator_lung_vessels
+    totalsegmentator_lung_vessels(ct, mask, vessels, pad=pad)
+
+def ts_lobes(ct: str, mask: str, labels: str, pad: float):
+    from picslpipes.ct_lung_textures.lung_lobe_segmentation import totalsegmentator_lung_lobes
+    totalsegmentator_lung_lobes(ct, mask, labels, pad=pad)
+
+def mask_labels(labels: str, mask: str, output: str):
+    import SimpleITK as sitk
+    label_img = sitk.ReadImage(labels)
+    mask_img = sitk.Cast(sitk.ReadImage(mask) > 0, label_img.GetPixelID())
+    write_image(label_img * mask_img, output)
+
+def texture(ct: str, mask: str, glcm: str, glrlm: str, bins: int, radius: int, min_distance: int, max_distance: int):
+    import itk
+    from picslpipes.utils.itk_texture_features import intensity_bounds, quantize_image, roi_texture_feature_image
+    im = itk.imread(ct, itk.SS)
+    mask_img = itk.imread(mask, itk.UC)
+    hmin, hmax = intensity_bounds(im)
+    quantized = quantize_image(im, bins, hmin, hmax)
+    for features, output in [('GLCM', glcm), ('GLRLM', glrlm)]:
+        result = roi_texture_feature_image(quantized, mask_img, features, bins, 0, bins, radius, min_distance, max_distance)
+        if result is None:
+            raise RuntimeError("Empty texture mask "+mask)
+        write_image(result, output)
+
+def region_stats(ct: str, output: str, systems: list, subject: str, session: str, store: str=None, **files):
+    import SimpleITK as sitk
+    from picslpipes.utils.image_region_stats import get_simple_itk_stats, read_key, write_stats
+    signal = sitk.ReadImage(ct)
+    segs = [ (sitk.ReadImage(files[seg], sitk.sitkUInt16), read_key(files[key]), name) for seg, key, name in systems ]
+    stats = get_simple_itk_stats(signal, segs, extended=True)
+    write_stats(segs, stats, 'simpleitk', subject, session, output, store)
+
+def preflight(ct_file: str, images: list, seg_file: str=None):
+    """
+    Reject a session whose images are not on the grid of its CT, reading headers only
+    """
+    from picslpipes.utils.geometry_check import check_geometry, check_dicom_seg
+    results = check_geometry(ct_file, images)
+    if results is None:
+        raise ValueError("Could not read the header of "+ct_file)
+    problems = []
+    for filename, result in results.items():
+        if not result["ok"]:
+            fix = "" if result["reorient"] is None else " (reorient to "+result["reorient"]+")"
+            problems.append(os.path.basename(filename)+" differs in "+", ".join(result["differences"])+fix)
+    if seg_file is not None and not check_dicom_seg(ct_file, seg_file):
+        problems.append(os.path.basename(seg_file)+" frames are not on the grid")
+    if len(problems) > 0:
+        raise ValueError("Not on the grid of "+os.path.basename(ct_file)+": "+"; ".join(problems))
+
+def nsclc_pipeline(input_dir: str, out_dir: str, key_dir: str, cache_dir: str=None, scratch_dir: str=None, seg_file: str=None, stats_store: str=None, check: bool=True, index: str=None) -> Pipeline:
+    """
+    Declare the NSCLC-Radiomics stages of nsclc_radiomics_process.sh for one session directory.
+
+    Parameters:
+    input_dir (str): Session directory with the *CT.nii.gz, *seg-meta.json and *_seg-N.nii.gz files.
+    out_dir (str): Directory for the outputs.
+    key_dir (str): Directory with the lobe, lung, vessel and vessel-lobe key csv files.
+    cache_dir (str): Cache store, defaults to .picslpipes_cache in out_dir.
+    scratch_dir (str): Directory for the uncompressed intermediates (masks and the full TotalSegmentator
+    labels), defaults to the io_policy scratch directory or out_dir.
+    seg_file (str): DICOM SEG with the manual lungs. When given the lungs are decoded from it
+    directly instead of merging the per-segment *_seg-N.nii.gz files.
+    stats_store (str): Stats dataset (see stats_store.py) the region stats are also appended to
+    when the region_stats stage runs.
+    check (bool): Check that the segmentations (and a TotalSegmentator output from an earlier run)
+    share the grid of the CT before declaring the stages, raising ValueError if they do not.
+    index (str): Segment index database (see segment_index.py) the seg_labels and seg_files stages
+    look the session up in, defaults to PICSLPIPES_SEG_INDEX as in the driver script.
+
+    Returns:
+    Pipeline: Pipeline with one stage per step of the driver script.
+    """
+    meta_files = glob.glob(os.path.join(input_dir, '*seg-meta.json'))
+    ct_files = glob.glob(os.path.join(input_dir, '*CT.nii.gz'))
+    if (len(meta_files) == 0 and seg_file is None) or len(ct_files) == 0:
+        raise FileNotFoundError("No *seg-meta.json or *CT.nii.gz in "+input_dir)
+    meta_file = meta_files[0] if len(meta_files) > 0 else None
+    ct_file = ct_files[0]
+    name = os.path.basename(ct_file).replace('.nii.gz', '')
+    session = os.path.basename(os.path.normpath(input_dir))
+    subject = os.path.basename(os.path.dirname(os.path.normpath(input_dir)))
+
+    if cache_dir is None:
+        cache_dir = os.path.join(out_dir, '.picslpipes_cache')
+    if index is None:
+        index = os.environ.get(ENV_SEG_INDEX)
+
+    def out(suffix):
+        return(os.path.join(out_dir, name+'_'+suffix))
+
+    def tmp(suffix):
+        return(scratch_path(out(suffix), scratch_dir))
+
+    if check:
+        images = sorted(glob.glob(os.path.join(input_dir, '*_seg-*.nii.gz')))
+        images += [ f for f in [tmp("ts.nii.gz")] if os.path.exists(f) ]
+        preflight(ct_file, images, seg_file)
+
+    p = Pipeline(cache_dir)
+    if seg_file is not None:
+        p.add(Stage("lungs", decode_seg, {"seg": seg_file, "ct": ct_file}, {"merged": out("lungs.nii.gz")},
+                    {"structures": ["Lung-Left", "Lung-Right"], "clean": True}))
+    else:
+        p.add(Stage("seg_labels", seg_labels, {"meta": meta_file}, {"labels_json": out("seg_labels.json")},
+                    {"structures": ["Lung-Left", "Lung-Right"], "index": index}))
+        # seg_files only lists the session directory, and merge only reads the files seg_files picked
+        p.add(Stage("seg_files", seg_files, {"input_dir": input_dir, "labels_json": out("seg_labels.json")},
+                    {"files_json": out("seg_files.json")}, {"out_labels": {"Lung-Left": 1, "Lung-Right": 2}, "index": index},
+                    hash_as={"input_dir": "names"}))
+        p.add(Stage("lungs", merge, {"files_json": out("seg_files.json")},
+                    {"merged": out("lungs.nii.gz")}, {"slab_size": 64, "clean": True}, hash_as={"files_json": "listed"}))
+    p.add(Stage("lung_mask", relabel, {"labels": out("lungs.nii.gz")}, {"mask": tmp("lung_mask.nii.gz")},
+                {"tables": LUNG_MASK_LABELS}))
+    p.add(Stage("lung_lobes", ants_lobes, {"mask": tmp("lung_mask.nii.gz")}, {"lobes": out("lung_lobes.nii.gz")}))
+    p.add(Stage("ants_lungs", ants_lungs, {"ct": ct_file}, {"lungs": out("ants_lungs.nii.gz")}))
+    p.add(Stage("ants_lung_mask", relabel, {"labels": out("ants_lungs.nii.gz")}, {"mask": tmp("ants_lung_mask.nii.gz")},
+                {"tables": LUNG_MASK_LABELS}))
+    p.add(Stage("ants_lung_lobes", ants_lobes, {"mask": tmp("ants_lung_mask.nii.gz")}, {"lobes": out("ants_lung_lobes.nii.gz")}))
+    p.add(Stage("lung_vessels_mask", ts_vessels, {"ct": ct_file, "mask": tmp("lung_mask.nii.gz")},
+                {"vessels": tmp("lung_vessels_mask.nii.gz")}, {"pad": LUNG_CROP_PAD}))
+    p.add(Stage("lobe_vessels", mask_labels, {"labels": out("lung_lobes.nii.gz"), "mask": tmp("lung_vessels_mask.nii.gz")},
+                {"output": out("lobe_vessels.nii.gz")}))
+    p.add(Stage("lung_vessels", mask_labels, {"labels": out("lungs.nii.gz"), "mask": tmp("lung_vessels_mask.nii.gz")},
+                {"output": out("lung_vessels.nii.gz")}))
+    # Lobe classes only, on the CT cropped to the manual lungs (the crop is shared with lung_vessels_mask)
+    p.add(Stage("ts", ts_lobes, {"ct": ct_file, "mask": tmp("lung_mask.nii.gz")}, {"labels": tmp("ts.nii.gz")},
+                {"pad": LUNG_CROP_PAD}))
+    with open(TS_LUNG_LABELS_JSON) as f:
+        ts_outputs = list(json.load(f).keys())
+    p.add(Stage("ts_lungs", relabel, {"labels": tmp("ts.nii.gz"), "mapping": TS_LUNG_LABELS_JSON},
+                { k: out(k+".nii.gz") for k in ts_outputs },
+                {"clean": ["ts_lung_lobes", "ts_lungs"]}))
+    p.add(Stage("texture", texture, {"ct": ct_file, "mask": out("ts_lung_mask.nii.gz")},
+                {"glcm": out("GLCM.nii.gz"), "glrlm": out("GLRLM.nii.gz")},
+                {"bins": 16, "radius": 2, "min_distance": 1, "max_distance": 10}))
+    p.add(Stage("region_stats", region_stats,
+                {"ct": ct_file,
+                 "lung_lobes": out("lung_lobes.nii.gz"), "lungs": out("lungs.nii.gz"),
+                 "lung_vessels": out("lung_vessels.nii.gz"), "lobe_vessels": out("lobe_vessels.nii.gz"),
+                 "lobe_key": os.path.join(key_dir, "lobe_key.csv"), "lung_key": os.path.join(key_dir, "lung_key.csv"),
+                 "vessel_key": os.path.join(key_dir, "vessel_key.csv"), "vessel_lobe_key": os.path.join(key_dir, "vessel_lobe_key.csv")},
+                {"output": out("region_stats_sitk.csv")},
+                {"subject": subject, "session": session, "store": stats_store,
+                 "systems": [["lung_lobes", "lobe_key", "manual-lobes"], ["lungs", "lung_key", "manual-lungs"],
+                             ["lung_vessels", "vessel_key", "ts-lobe-vessels"], ["lobe_vessels", "vessel_lobe_key", "ts-vessels"]]}))
+    return(p)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the NSCLC-Radiomics pipeline with cached stages')
+    parser.add_argument('-i', '--input', help='Session directory', type=str, required=True)
+    parser.add_argument('-o', '--output', help='Output directory', type=str, required=True)
+    parser.add_argument('-k', '--keys', help='Directory with the label key csv files', type=str, required=True)
+    parser.add_argument('-c', '--cache', help='Cache directory (default: OUTPUT/.picslpipes_cache)', type=str)
+    parser.add_argument('--store', help='Also append the region stats to this Parquet stats dataset', type=str)
+    parser.add_argument('-x', '--index', help='Segment index database to look the session up in (default: $'+ENV_SEG_INDEX+')', type=str)
+    parser.add_argument('-d', '--dicom-seg', help='DICOM SEG to decode the manual lungs from, instead of the *_seg-N.nii.gz files', type=str)
+    parser.add_argument('-s', '--stages', help='Only bring these stages (and their inputs) up to date', type=str, nargs='+')
+    parser.add_argument('-f', '--force', help='Rerun these stages even if cached', type=str, nargs='+', default=[])
+    parser.add_argument('-l', '--list', help='List the stages in run order and exit', action='store_true', default=False)
+    parser.add_argument('--no-check', help='Skip the header check that all inputs share the grid of the CT', action='store_true', default=False)
+    parser.add_argument('-v', '--verbose', help="verbose output", action='store_true', default=False)
+    add_io_arguments(parser)
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+    settings = apply_io_arguments(args)
+    apply_trace_arguments(args)
+
+    log_level=logging.INFO
+    if args.verbose:
+        log_level=logging.DEBUG
+    logging.basicConfig(level=log_level, format="%(asctime)s %(name)s - %(levelname)-6s - %(message)s")
+
+    p = nsclc_pipeline(args.input, args.output, args.keys, args.cache, settings["scratch"], args.dicom_seg, args.store, not args.no_check, args.index)
+    if args.list:
+        for name in p.order(args.stages):
+            print(name+': '+', '.join(p.dependencies(p.stages[name])))
+        return(0)
+
+    status = p.run(args.stages, args.force)
+    for name, s in status.items():
+        print(name+','+s)
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
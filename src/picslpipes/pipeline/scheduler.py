@@ -0,0 +1,399 @@
+import argparse
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+import subprocess
+import multiprocessing
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/pipeline/scheduler.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments, stage
+
+# Cohort runs on a shared filesystem without a central server.
+#
+# A manifest directory holds manifest.json (one work unit per SUBJECT/SESSION directory with its
+# status and timing) and a claims/ directory. An array job task claims a unit by creating
+# claims/UNIT.lock with O_CREAT|O_EXCL, which only one task can do, so no unit runs twice.
+# Task i of n first works through its own shard (every n-th unit from i), then steals unclaimed
+# units from the other shards, so tasks that finish early keep working. A running task touches
+# its claim as a heartbeat; a claim whose heartbeat is older than the stale timeout (a node that
+# died) is taken over by renaming it away, which again only one task can do.
+
+MANIFEST = "manifest.json"
+CLAIMS = "claims"
+
+# Array task index and count set by the cluster schedulers (LSF and SGE indices start at 1)
+TASK_INDEX_VARS = [("SLURM_ARRAY_TASK_ID", 0), ("LSB_JOBINDEX", 1), ("SGE_TASK_ID", 1), ("PBS_ARRAY_INDEX", 0)]
+TASK_COUNT_VARS = ["SLURM_ARRAY_TASK_COUNT", "PICSLPIPES_ARRAY_TASKS"]
+
+def unit_id( subject: str, session: str ) -> str:
+    return(subject+"__"+session)
+
+def find_sessions( root: str, pattern: str='CT.nii.gz' ) -> list:
+    """
+    (subject, session, path) of every ROOT/SUBJECT/SESSION directory with a file ending in pattern
+    """
+    sessions = []
+    for subject in sorted([ e for e in os.scandir(root) if e.is_dir() ], key=lambda e: e.name):
+        for session in sorted([ e for e in os.scandir(subject.path) if e.is_dir() ], key=lambda e: e.name):
+            if any([ name.endswith(pattern) for name in os.listdir(session.path) ]):
+                sessions.append((subject.name, session.name, os.path.abspath(session.path)))
+    return(sessions)
+
+class _FileLock:
+    """
+    Lock file created with O_EXCL, broken if it is older than timeout seconds
+    """
+    def __init__(self, path: str, timeout: float=60.0):
+        self.path = path
+        self.timeout = timeout
+
+    def __enter__(self):
+        while True:
+            try:
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return(self)
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(self.path).st_mtime > self.timeout:
+                        os.remove(self.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class Manifest:
+    """
+    Work units of a cohort run and their claims, in a directory on a shared filesystem.
+
+    Parameters:
+    directory (str): Manifest directory, created if it does not exist.
+    stale (float): Seconds without a heartbeat after which a claim may be taken over.
+    """
+    def __init__(self, directory: str, stale: float=3600.0):
+        self.directory = directory
+        self.stale = stale
+        self.claims = os.path.join(directory, CLAIMS)
+        self.path = os.path.join(directory, MANIFEST)
+        os.makedirs(self.claims, exist_ok=True)
+
+    def _lock(self):
+        return(_FileLock(self.path+'.lock'))
+
+    def _write(self, manifest: dict):
+        tmp = self.path+'.tmp.'+str(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def read(self) -> dict:
+        with open(self.path, 'r') as f:
+            return(json.load(f))
+
+    def build(self, root: str, pattern: str='CT.nii.gz') -> dict:
+        """
+        Add a unit for every session below root that is not in the manifest yet.
+
+        Returns:
+        dict: The manifest, {"root", "units": [ {"id", "subject", "session", "path", "status",
+        "attempts", "host", "started", "seconds", "error"} ]}.
+        """
+        with self._lock():
+            manifest = self.read() if os.path.exists(self.path) else {"root": os.path.abspath(root), "units": []}
+            known = set([ u["id"] for u in manifest["units"] ])
+            for subject, session, path in find_sessions(root, pattern):
+                if unit_id(subject, session) in known:
+                    continue
+                manifest["units"].append({"id": unit_id(subject, session), "subject": subject, "session": session, "path": path,
+                                          "status": "pending", "attempts": 0, "host": None, "started": None,
+                                          "seconds": None, "error": None})
+            self._write(manifest)
+        return(manifest)
+
+    def update(self, uid: str, **fields) -> dict:
+        """
+        Set fields of one unit in the manifest, under the manifest lock
+        """
+        with self._lock():
+            manifest = self.read()
+            for unit in manifest["units"]:
+                if unit["id"] == uid:
+                    unit.update(fields)
+                    self._write(manifest)
+                    return(unit)
+        raise KeyError("No unit "+uid+" in "+self.path)
+
+    def claim_path(self, uid: str) -> str:
+        return(os.path.join(self.claims, uid+'.lock'))
+
+    def claim(self, uid: str) -> bool:
+        """
+        Claim a unit for this process. Only one process can hold the claim of a unit.
+        A stale claim is first moved aside, which only one of the competing processes can do.
+        """
+        path = self.claim_path(uid)
+        age = self.claim_age(uid)
+        if age is not None:
+            if age <= self.stale:
+                return(False)
+            stale = path+'.stale.'+socket.gethostname()+'.'+str(os.getpid())
+            try:
+                os.rename(path, stale)
+            except FileNotFoundError:
+                return(False)
+            # Another process may have replaced the stale claim with a fresh one between stat and rename
+            if time.time() - os.stat(stale).st_mtime <= self.stale:
+                try:
+                    os.link(stale, path)
+                except OSError:
+                    pass
+                os.remove(stale)
+                return(False)
+            os.remove(stale)
+
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return(False)
+        with os.fdopen(fd, 'w') as f:
+            f.write(socket.gethostname()+' '+str(os.getpid())+'\n')
+        return(True)
+
+    def release(self, uid: str):
+        try:
+            os.remove(self.claim_path(uid))
+        except FileNotFoundError:
+            pass
+
+    def heartbeat(self, uid: str):
+        try:
+            os.utime(self.claim_path(uid))
+        except FileNotFoundError:
+            pass
+
+    def reset_failed(self) -> int:
+        """
+        Make failed units claimable again
+        """
+        count = 0
+        for unit in self.read()["units"]:
+            if unit["status"] == "failed":
+                self.update(unit["id"], status="pending", attempts=0, error=None)
+                self.release(unit["id"])
+                count += 1
+        return(count)
+
+    def claim_age(self, uid: str) -> float:
+        """
+        Seconds since the last heartbeat of a unit's claim, None if it is not claimed
+        """
+        try:
+            return(time.time() - os.stat(self.claim_path(uid)).st_mtime)
+        except FileNotFoundError:
+            return(None)
+
+    def summary(self) -> dict:
+        """
+        Number of units per status. Running units whose claim has no heartbeat within the stale
+        timeout (their node died after the last worker exited) are counted as "stale", a new
+        worker will take them over
+        """
+        counts = {}
+        for unit in self.read()["units"]:
+            status = unit["status"]
+            if status == "running":
+                age = self.claim_age(unit["id"])
+                if age is None or age > self.stale:
+                    status = "stale"
+            counts[status] = counts.get(status, 0) + 1
+        return(counts)
+
+def shard_order( units: list, task: int, tasks: int ) -> list:
+    """
+    Units in the order task visits them: its own shard first, then the other shards starting
+    with the next task, so idle tasks spread out over the remaining work
+    """
+    order = []
+    for offset in range(tasks):
+        shard = (task + offset) % tasks
+        order.extend(units[shard::tasks])
+    return(order)
+
+def run_unit( unit: dict, out_root: str, key_dir: str, stages: list=None, cache_dir: str=None, stats_store: str=None, command: str=None,
+              index: str=None ) -> str:
+    """
+    Process one unit with the NSCLC pipeline, or with a shell command in which {path}, {subject},
+    {session} and {output} are replaced.
+
+    Returns:
+    str: Error message, or None on success.
+    """
+    out_dir = os.path.join(out_root, unit["subject"], unit["session"])
+    if command is not None:
+        cmd = command.format(path=unit["path"], subject=unit["subject"], session=unit["session"], output=out_dir)
+        result = subprocess.run(cmd, shell=True)
+        return(None if result.returncode == 0 else "exit status "+str(result.returncode))
+
+    from picslpipes.pipeline.batch import _run_session
+    session_dir, status, elapsed, error = _run_session(unit["path"], out_root, key_dir, stages, cache_dir, stats_store, index)
+    return(error)
+
+def run_worker( manifest_dir: str, task: int, tasks: int, out_root: str, key_dir: str=None, stages: list=None, cache_dir: str=None,
+                stats_store: str=None, command: str=None, stale: float=3600.0, attempts: int=2, models: list=None, index: str=None ) -> dict:
+    """
+    Claim and process units of a manifest until none is left to claim.
+
+    Parameters:
+    manifest_dir (str): Directory of a manifest built with Manifest.build.
+    task (int): Index of this array task, 0 to tasks-1.
+    tasks (int): Number of array tasks sharing the manifest.
+    out_root (str): Outputs go to out_root/SUBJECT/SESSION.
+    key_dir (str): Directory with the label key csv files (NSCLC pipeline only).
+    stages, cache_dir, stats_store, index: As for batch.run_batch.
+    command (str): Shell command run per unit instead of the NSCLC pipeline.
+    stale (float): Seconds without a heartbeat after which another task takes over a claim.
+    attempts (int): Times a failing unit is run before it is left failed.
+    models (list): Models to load once in this worker before the first unit.
+
+    Returns:
+    dict: Unit ID to "done" or "failed" for the units this task ran.
+    """
+    manifest = Manifest(manifest_dir, stale)
+    if command is None and models is not None and len(models) > 0:
+        from picslpipes.ct_lung_textures.lung_lobe_segmentation import load_models
+        load_models(models)
+
+    host = socket.gethostname()+':'+str(os.getpid())
+    ran = {}
+    claimed = True
+    while claimed:
+        # Sweep again after every sweep that claimed something: failed units released for a retry
+        # and stale claims may have become claimable in the meantime
+        claimed = False
+        units = [ u for u in manifest.read()["units"] if u["status"] not in ["done", "failed"] ]
+        for unit in shard_order(units, task, tasks):
+            if not manifest.claim(unit["id"]):
+                continue
+            current = [ u for u in manifest.read()["units"] if u["id"] == unit["id"] ][0]
+            if current["status"] in ["done", "failed"]:
+                # Finished by another task since the sweep started, the claim stays as the marker
+                continue
+            if current["status"] == "running":
+                logging.warning("Taking over "+unit["id"]+" from "+str(current["host"])+" after its claim went stale")
+            claimed = True
+
+            start = time.time()
+            manifest.update(unit["id"], status="running", host=host, started=start, attempts=current["attempts"]+1)
+            stop = threading.Event()
+            def beat():
+                while not stop.wait(max(stale/4.0, 0.1)):
+                    manifest.heartbeat(unit["id"])
+            beater = threading.Thread(target=beat, daemon=True)
+            beater.start()
+            try:
+                with stage("scheduler.unit", unit=unit["id"], task=task):
+                    error = run_unit(unit, out_root, key_dir, stages, cache_dir, stats_store, command, index)
+            except Exception as e:
+                error = repr(e)
+            stop.set()
+            beater.join()
+            elapsed = time.time() - start
+
+            if error is None:
+                status = "done"
+            elif current["attempts"]+1 < attempts:
+                status = "pending"
+            else:
+                status = "failed"
+            manifest.update(unit["id"], status=status, seconds=elapsed, error=error)
+            # Done and failed units keep their claim so no task picks them up again
+            if status == "pending":
+                manifest.release(unit["id"])
+            ran[unit["id"]] = status
+            logging.info(unit["id"]+" "+status+" in "+str(round(elapsed, 1))+"s on task "+str(task))
+    return(ran)
+
+def array_task( task: int=None, tasks: int=None ) -> tuple:
+    """
+    (index, count) of this array task, from the arguments or the cluster scheduler environment
+    """
+    if task is None:
+        for var, first in TASK_INDEX_VARS:
+            if var in os.environ:
+                task = int(os.environ[var]) - first
+                break
+    if tasks is None:
+        for var in TASK_COUNT_VARS:
+            if var in os.environ:
+                tasks = int(os.environ[var])
+                break
+    return((0 if task is None else task, 1 if tasks is None else tasks))
+
+def _local_worker( kwargs: dict ) -> dict:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s - %(levelname)-6s - %(message)s")
+    return(run_worker(**kwargs))
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a manifest of subject/session units and work through it from array job tasks')
+    parser.add_argument('-d', '--manifest', help='Manifest directory on a filesystem shared by all tasks', type=str, required=True)
+    parser.add_argument('-r', '--root', help='Dataset root (SUBJECT/SESSION) to add units from', type=str)
+    parser.add_argument('-o', '--output', help='Output root directory, run units when given', type=str)
+    parser.add_argument('-k', '--keys', help='Directory with the label key csv files', type=str)
+    parser.add_argument('-s', '--stages', help='Only bring these stages (and their inputs) up to date', type=str, nargs='+')
+    parser.add_argument('-c', '--cache', help='Shared cache directory', type=str)
+    parser.add_argument('--store', help='Also append the region stats to this Parquet stats dataset', type=str)
+    parser.add_argument('--index', help='Segment index database to look the units up in (default: $PICSLPIPES_SEG_INDEX)', type=str)
+    parser.add_argument('-x', '--command', help='Shell command per unit instead of the NSCLC pipeline, with {path} {subject} {session} {output}', type=str)
+    parser.add_argument('-t', '--task', help='Index of this array task (default: from the scheduler environment)', type=int)
+    parser.add_argument('-n', '--tasks', help='Number of array tasks (default: from the scheduler environment)', type=int)
+    parser.add_argument('-p', '--local', help='Run this many worker processes here, standing in for array tasks', type=int)
+    parser.add_argument('-m', '--models', help='Models to load once per worker', type=str, nargs='*', default=[])
+    parser.add_argument('--stale', help='Seconds without a heartbeat before a claim is taken over', type=float, default=3600.0)
+    parser.add_argument('--attempts', help='Times a failing unit is run before it is marked failed', type=int, default=2)
+    parser.add_argument('--reset-failed', help='Make failed units claimable again', action='store_true', default=False)
+    parser.add_argument('-v', '--verbose', help="verbose output", action='store_true', default=False)
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+    apply_trace_arguments(args)
+
+    log_level=logging.INFO
+    if args.verbose:
+        log_level=logging.DEBUG
+    logging.basicConfig(level=log_level, format="%(asctime)s %(name)s - %(levelname)-6s - %(message)s")
+
+    manifest = Manifest(args.manifest, args.stale)
+    if args.root is not None:
+        units = manifest.build(args.root)["units"]
+        print("units: "+str(len(units)))
+    if args.reset_failed:
+        print("reset: "+str(manifest.reset_failed()))
+
+    if args.output is not None:
+        if args.command is None and args.keys is None:
+            parser.error("-k/--keys is required to run the NSCLC pipeline")
+        kwargs = {"manifest_dir": args.manifest, "out_root": args.output, "key_dir": args.keys, "stages": args.stages,
+                  "cache_dir": args.cache, "stats_store": args.store, "command": args.command, "stale": args.stale,
+                  "attempts": args.attempts, "models": args.models, "index": args.index}
+        if args.local is not None:
+            context = multiprocessing.get_context('spawn')
+            with context.Pool(args.local) as pool:
+                pool.map(_local_worker, [ dict(kwargs, task=i, tasks=args.local) for i in range(args.local) ])
+        else:
+            task, tasks = array_task(args.task, args.tasks)
+            run_worker(task=task, tasks=tasks, **kwargs)
+
+    print(", ".join([ k+": "+str(v) for k, v in sorted(manifest.summary().items()) ]))
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,24 @@
-#from . import dicom_seg_meta
+import importlib
+
 from .dicom_seg_meta import dicom_seg_meta
 from .dicom_seg_files import dicom_seg_files
-from .merge_label_volumes import merge_label_volumes
 
+# SimpleITK based tools are loaded on first access so the JSON-only tools above do not pay
+# for importing it. merge_label_volumes and relabel_volume are not exported here: the package
+# attribute of those names is their submodule (import picslpipes.utils.relabel_volume binds it),
+# so import those functions from their modules
+_lazy_exports = {
+    "merge_label_volume_files": ".merge_label_volumes",
+    "decode_dicom_seg": ".dicom_seg_decode",
+    "clean_label_components": ".label_cleaning",
+}
+
+def __getattr__(name):
+    if name in _lazy_exports:
+        value = getattr(importlib.import_module(_lazy_exports[name], __name__), name)
+        globals()[name] = value
+        return(value)
+    raise AttributeError("module "+__name__+" has no attribute "+name)
+
+def __dir__():
+    return(sorted(list(globals().keys()) + list(_lazy_exports.keys())))
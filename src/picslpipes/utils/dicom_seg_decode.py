@@ -0,0 +1,285 @@
+import argparse
+import os
+import sys
+import logging
+import json
+import SimpleITK as sitk
+import numpy as np
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/utils/dicom_seg_decode.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.utils.merge_label_volumes import merge_label_slab, overlap_bits, mark_label_slab, count_overlap_values, overlap_metadata
+from picslpipes.utils.io_policy import add_io_arguments, apply_io_arguments, write_image
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments, traced
+
+def reference_geometry( reference ) -> tuple:
+    """
+    Size, origin, spacing and direction of the reference grid.
+
+    Parameters:
+    reference: SimpleITK image, or filename of which only the header is read.
+    """
+    if isinstance(reference, str):
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(reference)
+        reader.ReadImageInformation()
+        reference = reader
+    return((reference.GetSize(), reference.GetOrigin(), reference.GetSpacing(), reference.GetDirection()))
+
+def seg_frames( ds ):
+    """
+    Yield (frame number, 2D boolean mask) for every frame of a DICOM SEG.
+
+    BINARY segmentations are bit-packed with the first pixel in the lowest bit, and frames
+    follow each other without padding. When a frame is a whole number of bytes (e.g.
+    512x512) each frame is unpacked on its own, otherwise the bit stream is unpacked once.
+    FRACTIONAL segmentations are thresholded at half of MaximumFractionalValue.
+    """
+    rows = int(ds.Rows)
+    cols = int(ds.Columns)
+    n_frames = int(ds.get("NumberOfFrames", 1))
+    frame_pixels = rows*cols
+
+    if ds.file_meta.TransferSyntaxUID.is_compressed:
+        # Encapsulated pixel data, let pydicom decode it
+        frames = ds.pixel_array.reshape((n_frames, rows, cols))
+        threshold = 0 if int(ds.BitsAllocated) == 1 else int(ds.get("MaximumFractionalValue", 1)) / 2.0
+        for i in range(n_frames):
+            yield((i, frames[i] > threshold))
+        return
+
+    buffer = np.frombuffer(ds.PixelData, dtype=np.uint8)
+    if int(ds.BitsAllocated) == 1:
+        if frame_pixels % 8 == 0:
+            frame_bytes = frame_pixels // 8
+            for i in range(n_frames):
+                bits = np.unpackbits(buffer[i*frame_bytes:(i+1)*frame_bytes], bitorder='little')
+                yield((i, bits.view(bool).reshape((rows, cols))))
+        else:
+            bits = np.unpackbits(buffer, bitorder='little', count=n_frames*frame_pixels)
+            bits = bits.view(bool).reshape((n_frames, rows, cols))
+            for i in range(n_frames):
+                yield((i, bits[i]))
+    else:
+        threshold = int(ds.get("MaximumFractionalValue", 255)) / 2.0
+        frames = buffer[:n_frames*frame_pixels].reshape((n_frames, rows, cols))
+        for i in range(n_frames):
+            yield((i, frames[i] > threshold))
+
+def _frame_attribute( ds, frame, sequence, attribute ):
+    """
+    Functional group attribute of a frame, from the per-frame groups or else the shared groups
+    """
+    for groups in [ds.get("PerFrameFunctionalGroupsSequence"), ds.get("SharedFunctionalGroupsSequence")]:
+        if groups is None:
+            continue
+        group = groups[frame] if len(groups) > 1 else groups[0]
+        if sequence in group:
+            return(group[sequence][0].get(attribute))
+    return(None)
+
+def frame_placements( ds, geometry: tuple, tol: float=0.1 ) -> dict:
+    """
+    Locate every frame of a DICOM SEG on the reference grid.
+
+    Each frame must be a whole slice of the grid along one axis, up to flips and swaps of the
+    in-plane axes, which covers SEG objects made from the same series as the reference CT.
+
+    Returns:
+    dict: Frame number to (segment number, index of the first pixel on the grid, axis and step
+    of increasing column, axis and step of increasing row), or None if a frame is off the grid.
+    """
+    size, origin, spacing, direction = geometry
+    to_index = np.linalg.inv(np.array(direction).reshape(3, 3) * np.array(spacing))
+    origin = np.array(origin)
+
+    placements = {}
+    for frame in range(int(ds.get("NumberOfFrames", 1))):
+        segment = _frame_attribute(ds, frame, "SegmentIdentificationSequence", "ReferencedSegmentNumber")
+        position = _frame_attribute(ds, frame, "PlanePositionSequence", "ImagePositionPatient")
+        orientation = _frame_attribute(ds, frame, "PlaneOrientationSequence", "ImageOrientationPatient")
+        pixel_spacing = _frame_attribute(ds, frame, "PixelMeasuresSequence", "PixelSpacing")
+        if segment is None or position is None or orientation is None or pixel_spacing is None:
+            logging.error(f"frame_placements: frame {frame} is missing its segment number or plane geometry")
+            return None
+
+        start = to_index @ (np.array(position, dtype=np.float64) - origin)
+        # PixelSpacing is (between rows, between columns)
+        col_step = to_index @ (np.array(orientation[:3], dtype=np.float64) * float(pixel_spacing[1]))
+        row_step = to_index @ (np.array(orientation[3:], dtype=np.float64) * float(pixel_spacing[0]))
+
+        steps = []
+        for step in [col_step, row_step]:
+            axis = int(np.argmax(np.abs(step)))
+            unit = np.zeros(3)
+            unit[axis] = np.sign(step[axis])
+            if not np.allclose(step, unit, atol=tol):
+                logging.error(f"frame_placements: frame {frame} is not aligned with the reference grid")
+                return None
+            steps.append((axis, int(unit[axis])))
+
+        index = np.round(start)
+        if not np.allclose(start, index, atol=tol) or steps[0][0] == steps[1][0]:
+            logging.error(f"frame_placements: frame {frame} is not on a slice of the reference grid")
+            return None
+        placements[frame] = (int(segment), index.astype(int), steps[0], steps[1])
+
+    return(placements)
+
+def _frame_view( xyz: np.ndarray, start: np.ndarray, col: tuple, row: tuple, rows: int, cols: int ) -> tuple:
+    """
+    View of the slice of xyz (an [x,y,z] view of the output) covered by a frame, and whether
+    the frame must be transposed to match it
+    """
+    index = [ int(i) for i in start ]
+    for (axis, step), n in [(col, cols), (row, rows)]:
+        first = index[axis]
+        last = first + step*(n-1)
+        if min(first, last) < 0 or max(first, last) >= xyz.shape[axis]:
+            return(None)
+        if step > 0:
+            index[axis] = slice(first, last+1)
+        else:
+            index[axis] = slice(first, last-1 if last > 0 else None, -1)
+
+    third = 3 - col[0] - row[0]
+    if index[third] < 0 or index[third] >= xyz.shape[third]:
+        return(None)
+    return((xyz[tuple(index)], col[0] < row[0]))
+
+@traced()
+def decode_dicom_seg( seg_file: str, reference, segments: list=None, overlap: bool=False ) -> tuple:
+    """
+    Decode a DICOM SEG directly into one label volume on the grid of a reference image.
+
+    The same as converting every segment to its own image and running merge_label_volumes
+    with segments as the priorities, without writing and reading the per-segment images:
+    frames are unpacked one at a time and written straight into the merged (and overlap) array.
+
+    Parameters:
+    seg_file (str): DICOM SEG file.
+    reference: SimpleITK image or filename of the image (usually the CT) defining the output grid.
+    segments (list): Segment numbers in priority order, default all segments in order.
+    overlap (bool): Also build the bitmask overlap image, as in merge_label_volumes.
+
+    Returns:
+    tuple: Merged SimpleITK label image and a metadata dictionary (plus the overlap image if requested),
+    or None if the file cannot be decoded onto the reference grid.
+    """
+    logging.debug("decode_dicom_seg: start")
+    import pydicom
+
+    try:
+        ds = pydicom.dcmread(seg_file)
+    except Exception as e:
+        logging.error("decode_dicom_seg: could not read file as dicom: "+seg_file+" "+str(e))
+        return None
+
+    geometry = reference_geometry(reference)
+    placements = frame_placements(ds, geometry)
+    if placements is None:
+        return None
+
+    seg_labels = { int(item.SegmentNumber): str(item.get("SegmentDescription", item.get("SegmentLabel", ""))) for item in ds.SegmentSequence }
+    if segments is None:
+        segments = sorted(seg_labels.keys())
+    missing = [ s for s in segments if s not in seg_labels ]
+    if len(missing) > 0:
+        logging.error("decode_dicom_seg: segments not in "+seg_file+": "+str(missing))
+        return None
+    priority = { segment: p for p, segment in enumerate(segments, start=1) }
+
+    size = geometry[0]
+    merged_array = np.zeros(size[::-1], dtype=np.uint8)
+    membership = None
+    if overlap:
+        bits = overlap_bits(segments)
+        if bits is None:
+            return None
+        membership = np.zeros(size[::-1], dtype=bits[1])
+
+    # Overlaying in priority order leaves the highest priority claiming each voxel, so frames
+    # can be written in file order by only overwriting lower priorities
+    rows = int(ds.Rows)
+    cols = int(ds.Columns)
+    xyz = merged_array.T
+    for frame, mask in seg_frames(ds):
+        segment, start, col, row = placements[frame]
+        if segment not in priority:
+            continue
+        view = _frame_view(xyz, start, col, row, rows, cols)
+        if view is None:
+            logging.error(f"decode_dicom_seg: frame {frame} falls outside the reference grid")
+            return None
+        if view[1]:
+            mask = mask.T
+        merge_label_slab(view[0], mask & (view[0] < priority[segment]), priority[segment])
+        if overlap:
+            membership_view = _frame_view(membership.T, start, col, row, rows, cols)[0]
+            mark_label_slab(membership_view, mask, bits[0][segment])
+
+    metadata = {
+        "MergedSegments": [ {"OriginalLabel": segment, "SegmentDescription": seg_labels[segment], "Priority": p, "RelabeledValue": p}
+                            for segment, p in priority.items() ]
+    }
+
+    merged_image = sitk.GetImageFromArray(merged_array)
+    merged_image.SetOrigin(geometry[1])
+    merged_image.SetSpacing(geometry[2])
+    merged_image.SetDirection(geometry[3])
+
+    logging.debug("decode_dicom_seg: complete")
+
+    if overlap:
+        overlap_values = {}
+        count_overlap_values(membership, overlap_values)
+        metadata["Overlap"] = overlap_metadata(bits[0], overlap_values)
+        overlap_image = sitk.GetImageFromArray(membership)
+        overlap_image.CopyInformation(merged_image)
+        return((merged_image, metadata, overlap_image))
+
+    return((merged_image, metadata))
+
+def main():
+    my_parser = argparse.ArgumentParser(description='Decode a DICOM SEG into one label volume on the grid of a reference image')
+    my_parser.add_argument('-i', '--input', type=str, required=True, help="DICOM SEG file")
+    my_parser.add_argument('-r', '--reference', type=str, required=True, help="image defining the output grid, e.g. the CT")
+    my_parser.add_argument('-o', '--output', type=str, required=True, help="output label image filename")
+    my_parser.add_argument('-s', '--structures', type=str, nargs='+', required=False, help="segment descriptions to decode, in priority order")
+    my_parser.add_argument('-l', '--labels', type=int, nargs='+', required=False, help="segment numbers to decode, in priority order")
+    my_parser.add_argument('-x', '--overlap', type=str, required=False, help="output bitmask image of voxels claimed by each segment")
+    my_parser.add_argument('-m', '--meta', type=str, required=False, help="output json with the merge metadata")
+    my_parser.add_argument('--verbose', help="Enable verbose output", action='store_true', default=False)
+    add_io_arguments(my_parser)
+    add_trace_arguments(my_parser)
+    args = my_parser.parse_args()
+    apply_io_arguments(args)
+    apply_trace_arguments(args)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format="%(asctime)s %(name)s - %(levelname)-6s - %(message)s")
+
+    segments = args.labels
+    if args.structures is not None:
+        from picslpipes.utils.dicom_seg_meta import dicom_seg_meta_dcm
+        label_map = dicom_seg_meta_dcm(args.structures, args.input)
+        if label_map is None:
+            exit(1)
+        missing = [ s for s, label in label_map.items() if label is None ]
+        if len(missing) > 0:
+            logging.error("Structures not found in "+args.input+": "+str(missing))
+            exit(1)
+        segments = [ label_map[s] for s in args.structures ]
+
+    out_imgs = decode_dicom_seg(args.input, args.reference, segments, args.overlap is not None)
+    if out_imgs is None:
+        exit(1)
+
+    write_image(out_imgs[0], args.output)
+    if args.overlap is not None:
+        write_image(out_imgs[2], args.overlap)
+    if args.meta is not None:
+        with open(args.meta, 'w') as f:
+            json.dump(out_imgs[1], f, indent=4)
+
+if __name__ == "__main__":
+    sys.exit(main())
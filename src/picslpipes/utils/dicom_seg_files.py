@@ -1,27 +1,64 @@
 import argparse
 import os
 import sys
+import re
 import logging
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/utils/dicom_seg_files.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments, traced
 
-def dicom_seg_files( dir: str, labels: list[int], ext=".nii.gz" ) -> dict:
-    
+@traced()
+def dicom_seg_files( dir: str, labels: list[int], ext=".nii.gz", index: str=None ) -> dict:
+    """
+    Find the per-segment images (FILE_seg-N.nii.gz as written by dcmqi) for a list of label IDs.
+
+    Parameters:
+    dir (str): Directory with the per-segment images.
+    labels (list): Label IDs to find images for.
+    ext (str): Extension of the images.
+    index (str): Segment index database (see segment_index.py). If every label has an indexed file
+    that is unchanged since, the files are looked up there instead of listing the directory.
+
+    Returns:
+    dict: Label ID to file path for the labels that were found, or None on bad input.
+    """
     logging.debug("dicom_seg_files: start")
 
-    # Check if input path exists
-    if not os.path.exists(dir):
-        logging.error("dicom_seg_files: input directory does not exist")
-        return None
-    
     # Check that labels were input
     if not len(labels) > 0:
         logging.error("dicom_seg_files: no labels in list")
         return None
-    
-    
-    files={}
+
+    if index is not None:
+        import sqlite3
+        from picslpipes.utils.segment_index import SegmentIndex
+        try:
+            seg_index = SegmentIndex(index, read_only=True)
+            try:
+                files = seg_index.seg_files(labels, directory=dir)
+            finally:
+                seg_index.close()
+            if len(files) == len(set([ int(label) for label in labels ])):
+                return(files)
+            logging.debug("dicom_seg_files: "+dir+" not fully in index or changed since, listing directory")
+        except sqlite3.Error as e:
+            logging.warning("dicom_seg_files: could not read segment index "+index+" "+str(e))
+
+    # Check if input path exists
+    if not os.path.exists(dir):
+        logging.error("dicom_seg_files: input directory does not exist")
+        return None
+
     # Find files and put into a dict that looks like:
     # files = { 1:'file_seg-1.nii.gz', 2: 'file_seg-2.nii.gz'}
-    
+    pattern = re.compile(r'_seg-(\d+)'+re.escape(ext)+'$')
+    wanted = set([ int(label) for label in labels ])
+    files={}
+    for entry in os.scandir(dir):
+        match = pattern.search(entry.name)
+        if match is not None and int(match.group(1)) in wanted:
+            files[int(match.group(1))] = entry.path
 
     return(files)
 
@@ -30,8 +67,11 @@ def main():
     my_parser = argparse.ArgumentParser(description='Find files for segmentation labels')
     my_parser.add_argument('-d', '--directory',  type=str, help='input directory', required=True)
     my_parser.add_argument('-l', '--labels', type=int, help="label to find image for", required=True, nargs='+')
+    my_parser.add_argument('-x', '--index', type=str, help="segment index database to look the files up in", required=False)
     my_parser.add_argument('-v', '--verbose', help="verbose output", action='store_true', default=False)
+    add_trace_arguments(my_parser)
     args = my_parser.parse_args()
+    apply_trace_arguments(args)
 
     # Setup logging
     log_level=logging.WARNING
@@ -43,9 +83,8 @@ def main():
     logging.debug("Directory to search: "+str(args.directory))
     logging.debug("Labels to find images for: "+str(args.labels))
 
-    files = dicom_seg_files( args.directory, args.labels )
+    files = dicom_seg_files( args.directory, args.labels, index=args.index )
     print(files)
 
 if __name__=="__main__":
     sys.exit(main())
-
@@ -3,29 +3,93 @@ import os
 import sys
 import logging
 import pathlib
-import pydicom
 import json
 from typing import Optional
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/utils/dicom_seg_meta.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments, traced
+
+@traced()
+def dicom_seg_segments( infile: str ) -> list:
+    """
+    Read the segment attributes of a DICOM SEG without loading its pixel data.
+
+    Returns:
+    list: One dictionary per item of the SegmentSequence with "labelID" (SegmentNumber),
+    "SegmentLabel" and "SegmentDescription" (the label when the description is missing),
+    or None if the file cannot be read as a DICOM SEG.
+    """
+    logging.debug("dicom_seg_segments()")
+    import pydicom
 
-def dicom_seg_meta_dcm( structure_names: list[str], infile: str ) -> dict:
-    logging.error("Reading from dicom seg is still a WIP")
-    return(None)
-
-    logging.debug("dicom_seg_meta_dcm()")
-    meta={}
-    
     try:
-        ds=pydicom.dcmread(infile)
-    except:
-        logging.error("dicom_seg_meta_dcm: could not read file as dicom: "+infile)
+        ds=pydicom.dcmread(infile, stop_before_pixels=True)
+    except Exception as e:
+        logging.error("dicom_seg_segments: could not read file as dicom: "+infile+" "+str(e))
         return None
 
-    return(meta)
+    if "SegmentSequence" not in ds:
+        logging.error("dicom_seg_segments: no SegmentSequence in "+infile)
+        return None
+
+    segments=[]
+    for item in ds.SegmentSequence:
+        label = str(item.get("SegmentLabel", ""))
+        segments.append({
+            "labelID": int(item.SegmentNumber),
+            "SegmentLabel": label,
+            "SegmentDescription": str(item.get("SegmentDescription", label))
+        })
+    return(segments)
 
-def dicom_seg_meta( structure_names: list[str], infile: str ) -> dict:
+def dicom_seg_meta_dcm( structure_names: list[str], infile: str ) -> dict:
+    """
+    Same as dicom_seg_meta_json, reading the segment attributes from the DICOM SEG header.
+    A structure matches the SegmentDescription or, failing that, the SegmentLabel of a segment.
+    """
+    logging.debug("dicom_seg_meta_dcm()")
+
+    segments = dicom_seg_segments(infile)
+    if segments is None:
+        return None
+
+    structure_label_mapping = {structure: None for structure in structure_names}
+    for segment in segments:
+        for name in [segment["SegmentLabel"], segment["SegmentDescription"]]:
+            if name in structure_names:
+                structure_label_mapping[name] = segment["labelID"]
+
+    return(structure_label_mapping)
+
+def is_dicom_file( infile: str ) -> bool:
+    """
+    Check for the DICM marker after the 128 byte preamble
+    """
+    with open(infile, 'rb') as f:
+        f.seek(128)
+        return(f.read(4) == b'DICM')
+
+@traced()
+def dicom_seg_meta( structure_names: list[str], infile: str, index: str=None ) -> dict:
     
     logging.debug("dicom_seg_meta()")
 
+    # Answer from the segment index (see segment_index.py) when infile is indexed and unchanged since
+    if index is not None:
+        import sqlite3
+        from picslpipes.utils.segment_index import SegmentIndex
+        try:
+            seg_index = SegmentIndex(index, read_only=True)
+            try:
+                if seg_index.has_source(infile):
+                    return(seg_index.label_ids(structure_names, source=infile))
+            finally:
+                seg_index.close()
+            logging.debug("dicom_seg_meta: "+infile+" not in index or changed since, reading it")
+        except sqlite3.Error as e:
+            logging.warning("dicom_seg_meta: could not read segment index "+index+" "+str(e))
+
     # Check if input path exists
     if not os.path.exists(infile):
         logging.error("dicom_seg_meta: input file does not exist")
@@ -34,9 +98,13 @@ def dicom_seg_meta( structure_names: list[str], infile: str ) -> dict:
     if pathlib.Path(infile).suffix == ".json":
         meta=dicom_seg_meta_json(structure_names, infile)
     elif pathlib.Path(infile).suffix == ".dcm":
-        meta=dicom_seg_meta_dcm(infile)
-    elif pathlib.Path(infile).suffix == "":    
-        meta=dicom_seg_meta_json(infile)
+        meta=dicom_seg_meta_dcm(structure_names, infile)
+    elif pathlib.Path(infile).suffix == "":
+        # DICOM files are often written without a suffix
+        if is_dicom_file(infile):
+            meta=dicom_seg_meta_dcm(structure_names, infile)
+        else:
+            meta=dicom_seg_meta_json(structure_names, infile)
     else:
         logging.error("dicom_seg_meta: unknown input file type: "+pathlib.Path(infile).suffix)
         return None
@@ -75,13 +143,16 @@ def dicom_seg_meta_json(structure_names: list[str], json_path: str) -> dict[str,
 def main():
     
     my_parser = argparse.ArgumentParser(description='Extract meta info from dicom seg or json')
-    my_parser.add_argument('-i', '--input',  type=str, help='json file to get info from', required=True)
+    my_parser.add_argument('-i', '--input',  type=str, help='json or dicom seg file to get info from', required=True)
     my_parser.add_argument('-o', '--output', type=str, help="file for output", required=False)
     my_parser.add_argument('-s', '--structures', type=str, nargs='+', help="List of structures to identify",
                            required=False)
     my_parser.add_argument('-l', '--list', type=str, help="text file with list of structures", required=False)
+    my_parser.add_argument('-x', '--index', type=str, help="segment index database to look the input up in", required=False)
     my_parser.add_argument('-v', '--verbose', help="verbose output", action='store_true', default=False)
+    add_trace_arguments(my_parser)
     args = my_parser.parse_args()
+    apply_trace_arguments(args)
 
     # Setup logging
     log_level=logging.WARNING
@@ -110,7 +181,7 @@ def main():
 
     logging.debug("Structures: "+str(structures))
 
-    meta = dicom_seg_meta(structures, args.input)
+    meta = dicom_seg_meta(structures, args.input, args.index)
 
     # write to json if file is passed
     if args.output:
@@ -0,0 +1,218 @@
+import argparse
+import os
+import sys
+import logging
+import SimpleITK as sitk
+import numpy as np
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/utils/geometry_check.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments, traced
+
+# Compare the voxel grids of the images of one job from their headers only (no pixel data is
+# decoded), so a subject whose segmentations do not share the grid of its CT is rejected before
+# any stage runs instead of failing in CopyInformation or the label statistics filters.
+
+def _file_information( filename: str ) -> sitk.ImageFileReader:
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(filename)
+    reader.ReadImageInformation()
+    return(reader)
+
+def read_geometry( filename: str ) -> dict:
+    """
+    Size, origin, spacing and direction of an image from its header.
+
+    Parameters:
+    filename (str): Image file (NIfTI, NRRD, a single DICOM file, ...) or a directory with one DICOM
+    series, of which only the first and last slice headers are read.
+
+    Returns:
+    dict: "size", "origin", "spacing" and "direction" (row-major 3x3, as in SimpleITK),
+    or None if the header cannot be read.
+    """
+    try:
+        if os.path.isdir(filename):
+            files = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(filename)
+            if len(files) == 0:
+                logging.error("read_geometry: no DICOM series in "+filename)
+                return None
+            first = _file_information(files[0])
+            size = list(first.GetSize())
+            spacing = list(first.GetSpacing())
+            size[2] = len(files)
+            if len(files) > 1:
+                last = _file_information(files[-1])
+                spacing[2] = float(np.linalg.norm(np.array(last.GetOrigin()) - np.array(first.GetOrigin()))) / (len(files)-1)
+            info = (tuple(size), first.GetOrigin(), tuple(spacing), first.GetDirection())
+        else:
+            reader = _file_information(filename)
+            info = (reader.GetSize(), reader.GetOrigin(), reader.GetSpacing(), reader.GetDirection())
+    except Exception as e:
+        logging.error("read_geometry: could not read header of "+filename+" "+str(e))
+        return None
+
+    return({"size": tuple(int(s) for s in info[0]), "origin": tuple(info[1]), "spacing": tuple(info[2]), "direction": tuple(info[3])})
+
+def orientation( geometry: dict ) -> str:
+    """
+    Three letter orientation code (e.g. "LPS", "RAS") of a grid, as used by DICOMOrient
+    """
+    return(sitk.DICOMOrientImageFilter.GetOrientationFromDirectionCosines(geometry["direction"]))
+
+def reoriented_geometry( geometry: dict, target: dict ) -> dict:
+    """
+    Grid that DICOMOrient would produce when permuting and flipping the axes of geometry to
+    the orientation of target, computed from the header values alone.
+    """
+    direction = np.array(geometry["direction"]).reshape(3, 3)
+    target_direction = np.array(target["direction"]).reshape(3, 3)
+    spacing = np.array(geometry["spacing"])
+    size = np.array(geometry["size"])
+
+    # Source axis closest to each target axis, and whether it runs the other way
+    alignment = direction.T @ target_direction
+    axes = np.argmax(np.abs(alignment), axis=0)
+    signs = np.sign(alignment[axes, [0, 1, 2]])
+
+    origin = np.array(geometry["origin"], dtype=np.float64)
+    for axis, sign in zip(axes, signs):
+        if sign < 0:
+            origin = origin + direction[:, axis] * spacing[axis] * (size[axis]-1)
+
+    return({"size": tuple(int(s) for s in size[axes]), "origin": tuple(origin), "spacing": tuple(spacing[axes]),
+            "direction": tuple((direction[:, axes] * signs).ravel())})
+
+def grid_differences( reference: dict, geometry: dict, tol: float=1e-3 ) -> list:
+    """
+    Properties in which geometry differs from reference.
+
+    Returns:
+    list: Names of the properties ("size", "spacing", "direction", "origin") that do not match,
+    empty if the grids are the same. Spacing and origin are compared relative to the reference spacing.
+    """
+    differences = []
+    if tuple(reference["size"]) != tuple(geometry["size"]):
+        differences.append("size")
+    scale = float(np.min(reference["spacing"]))
+    if not np.allclose(reference["spacing"], geometry["spacing"], atol=tol*scale):
+        differences.append("spacing")
+    if not np.allclose(reference["direction"], geometry["direction"], atol=tol):
+        differences.append("direction")
+    if not np.allclose(reference["origin"], geometry["origin"], atol=tol*scale):
+        differences.append("origin")
+    return(differences)
+
+@traced()
+def check_geometry( reference: str, images: list, tol: float=1e-3 ) -> dict:
+    """
+    Check that every image shares the voxel grid of a reference image, reading headers only.
+
+    Images whose axes are only permuted or flipped relative to the reference (the voxel ordering
+    differences between converters) are flagged with the orientation that puts them on the
+    reference grid.
+
+    Parameters:
+    reference (str): Image defining the grid, usually the CT.
+    images (list): Image files to compare to it.
+    tol (float): Tolerance on the direction cosines, and on spacing and origin as a fraction of the
+    smallest reference spacing.
+
+    Returns:
+    dict: Image filename to a dict with "ok", the list of "differences" and "reorient", the orientation
+    code that fixes the image or None, or None if the reference header cannot be read.
+    """
+    ref_geometry = read_geometry(reference)
+    if ref_geometry is None:
+        return None
+
+    results = {}
+    for filename in images:
+        geometry = read_geometry(filename)
+        if geometry is None:
+            results[filename] = {"ok": False, "differences": ["unreadable"], "reorient": None}
+            continue
+        differences = grid_differences(ref_geometry, geometry, tol)
+        reorient = None
+        if len(differences) > 0 and len(grid_differences(ref_geometry, reoriented_geometry(geometry, ref_geometry), tol)) == 0:
+            reorient = orientation(ref_geometry)
+        results[filename] = {"ok": len(differences) == 0, "differences": differences, "reorient": reorient}
+    return(results)
+
+@traced()
+def check_dicom_seg( reference: str, seg_file: str ) -> bool:
+    """
+    Check that every frame of a DICOM SEG lies on a slice of the reference grid, from the DICOM header
+    only, so dicom_seg_decode.py can place it.
+    """
+    import pydicom
+    from picslpipes.utils.dicom_seg_decode import reference_geometry, frame_placements, _frame_view
+
+    try:
+        ds = pydicom.dcmread(seg_file, stop_before_pixels=True)
+    except Exception as e:
+        logging.error("check_dicom_seg: could not read file as dicom: "+seg_file+" "+str(e))
+        return(False)
+
+    geometry = reference_geometry(reference)
+    placements = frame_placements(ds, geometry)
+    if placements is None:
+        return(False)
+
+    # Bounds only, so a zero-strided stand-in for the output array is enough
+    grid = np.broadcast_to(np.uint8(0), tuple(geometry[0]))
+    for frame, (segment, start, col, row) in placements.items():
+        if _frame_view(grid, start, col, row, int(ds.Rows), int(ds.Columns)) is None:
+            logging.error(f"check_dicom_seg: frame {frame} of {seg_file} falls outside the reference grid")
+            return(False)
+    return(True)
+
+def reorient_image( filename: str, orientation_code: str, out_file: str ):
+    """
+    Permute and flip the axes of an image to the given orientation and write it
+    """
+    from picslpipes.utils.io_policy import read_image, write_image
+    write_image(sitk.DICOMOrient(read_image(filename), orientation_code), out_file)
+
+def main():
+    my_parser = argparse.ArgumentParser(description='Check that images share the voxel grid of a reference image, reading headers only')
+    my_parser.add_argument('-r', '--reference', type=str, required=True, help="image defining the grid, e.g. the CT")
+    my_parser.add_argument('-i', '--input', type=str, nargs='*', default=[], help="images to check")
+    my_parser.add_argument('-d', '--dicom-seg', type=str, nargs='*', default=[], help="DICOM SEG files to check")
+    my_parser.add_argument('-t', '--tolerance', type=float, default=1e-3, help="tolerance, relative to the smallest reference spacing")
+    my_parser.add_argument('-f', '--fix', type=str, required=False, help="write reoriented copies of the images that only differ in axis order to this directory")
+    my_parser.add_argument('--verbose', help="Enable verbose output", action='store_true', default=False)
+    add_trace_arguments(my_parser)
+    args = my_parser.parse_args()
+    apply_trace_arguments(args)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format="%(asctime)s %(name)s - %(levelname)-6s - %(message)s")
+
+    results = check_geometry(args.reference, args.input, args.tolerance)
+    if results is None:
+        return(1)
+
+    failed = False
+    for filename, result in results.items():
+        if result["ok"]:
+            continue
+        if result["reorient"] is not None and args.fix is not None:
+            out_file = os.path.join(args.fix, os.path.basename(filename))
+            reorient_image(filename, result["reorient"], out_file)
+            print(filename+": reoriented to "+result["reorient"]+" in "+out_file)
+            continue
+        failed = True
+        message = filename+": differs in "+", ".join(result["differences"])
+        if result["reorient"] is not None:
+            message += " (reorient to "+result["reorient"]+" with -f)"
+        print(message)
+
+    for seg_file in args.dicom_seg:
+        if not check_dicom_seg(args.reference, seg_file):
+            failed = True
+            print(seg_file+": frames are not on the reference grid")
+
+    return(1 if failed else 0)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import numpy as np
+
+# Conversions between nibabel, ANTsPy, SimpleITK and ITK images without going through files.
+#
+# Every conversion goes through a Volume: a numpy array indexed [x,y,z] plus the ITK (LPS)
+# origin, spacing and direction. Libraries are only imported by the functions that need them.
+# Views are used wherever the library allows it:
+#   from_sitk, from_itk, from_ants, from_nibabel and to_nibabel, to_itk share the pixel buffer
+#   to_sitk and to_ants copy, because those libraries always allocate their own buffer
+
+# nibabel affines are RAS, ITK geometry is LPS
+_RAS_TO_LPS = np.diag([-1.0, -1.0, 1.0])
+
+class Volume:
+    """
+    A numpy array indexed [x,y,z] with its physical geometry in ITK (LPS) convention.
+
+    Parameters:
+    array (np.ndarray): Voxel values, shape (x, y, z).
+    origin (tuple): Physical position of voxel (0,0,0).
+    spacing (tuple): Voxel size along x, y and z.
+    direction (np.ndarray): 3x3 matrix whose columns are the directions of the x, y and z axes.
+    owner: Object that owns the buffer of a view, kept alive with the Volume.
+    """
+    def __init__(self, array, origin, spacing, direction, owner=None):
+        self.array = array
+        self.origin = tuple([ float(o) for o in origin ])
+        self.spacing = tuple([ float(s) for s in spacing ])
+        self.direction = np.asarray(direction, dtype=np.float64).reshape(3, 3)
+        self._owner = owner
+
+    def like(self, array):
+        """
+        A new Volume with the same geometry and different voxel values
+        """
+        if array.shape != self.array.shape:
+            raise ValueError("Shape "+str(array.shape)+" does not match "+str(self.array.shape))
+        return(Volume(array, self.origin, self.spacing, self.direction))
+
+    def crop(self, start, stop):
+        """
+        A view of the box [start, stop) of voxel indices, with the origin moved to its first voxel
+        """
+        index = tuple([ slice(int(a), int(b)) for a, b in zip(start, stop) ])
+        origin = np.asarray(self.origin) + self.direction @ (np.asarray(start, dtype=np.float64) * np.asarray(self.spacing))
+        return(Volume(self.array[index], origin, self.spacing, self.direction, owner=self))
+
+    def same_grid(self, other, tol=1e-4) -> bool:
+        return(self.array.shape == other.array.shape
+               and np.allclose(self.origin, other.origin, atol=tol)
+               and np.allclose(self.spacing, other.spacing, atol=tol)
+               and np.allclose(self.direction, other.direction, atol=tol))
+
+def from_sitk(img) -> Volume:
+    import SimpleITK as sitk
+    array = sitk.GetArrayViewFromImage(img).T
+    return(Volume(array, img.GetOrigin(), img.GetSpacing(), img.GetDirection(), owner=img))
+
+def to_sitk(vol: Volume):
+    import SimpleITK as sitk
+    img = sitk.GetImageFromArray(np.ascontiguousarray(vol.array.T))
+    img.SetOrigin(vol.origin)
+    img.SetSpacing(vol.spacing)
+    img.SetDirection(vol.direction.ravel().tolist())
+    return(img)
+
+def from_itk(img) -> Volume:
+    import itk
+    array = itk.GetArrayViewFromImage(img).T
+    return(Volume(array, tuple(img.GetOrigin()), tuple(img.GetSpacing()), itk.array_from_matrix(img.GetDirection()), owner=img))
+
+def to_itk(vol: Volume):
+    """
+    ITK image sharing the Volume's buffer. Arrays that are not Fortran contiguous in [x,y,z]
+    are copied once and the copy is kept by the Volume, which must stay alive as long as the
+    image is used.
+    """
+    import itk
+    array = vol.array
+    if not array.flags.f_contiguous:
+        array = np.asfortranarray(array)
+        vol._owner = (vol._owner, array)
+    img = itk.GetImageViewFromArray(array)
+    img.SetOrigin(vol.origin)
+    img.SetSpacing(vol.spacing)
+    img.SetDirection(itk.matrix_from_array(np.ascontiguousarray(vol.direction)))
+    return(img)
+
+def from_ants(img) -> Volume:
+    array = img.view()
+    return(Volume(array, img.origin, img.spacing, img.direction, owner=img))
+
+def to_ants(vol: Volume):
+    import ants
+    array = vol.array
+    if array.dtype == np.bool_:
+        array = array.astype(np.uint8)
+    return(ants.from_numpy(array, origin=list(vol.origin), spacing=list(vol.spacing), direction=vol.direction))
+
+def from_nibabel(img) -> Volume:
+    """
+    Volume from a nibabel image. Uncompressed files loaded with mmap stay memory mapped.
+    """
+    affine = _RAS_TO_LPS @ img.affine[:3, :]
+    spacing = np.linalg.norm(affine[:, :3], axis=0)
+    direction = affine[:, :3] / spacing
+    return(Volume(np.asanyarray(img.dataobj), affine[:, 3], spacing, direction, owner=img))
+
+def to_nibabel(vol: Volume):
+    import nibabel as nib
+    affine = np.eye(4)
+    affine[:3, :3] = _RAS_TO_LPS @ (vol.direction * np.asarray(vol.spacing))
+    affine[:3, 3] = _RAS_TO_LPS @ np.asarray(vol.origin)
+    array = vol.array
+    if array.dtype == np.bool_:
+        array = array.astype(np.uint8)
+    img = nib.Nifti1Image(array, affine)
+    img.set_qform(affine, code=1)
+    img.set_sform(affine, code=1)
+    return(img)
@@ -1,32 +1,81 @@
 import SimpleITK as sitk
 import os, sys, argparse
 import csv
-import pandas as pd
+import numpy as np
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/utils/image_region_stats.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.utils.io_policy import add_io_arguments, apply_io_arguments, read_image
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments, traced
+
+# Shape metrics that can be requested one by one from the numpy calculator
+SHAPE_METRICS = ["physical_size", "skewness", "roundness", "elongation", "feret_diameter", "perimeter",
+                 "ellipsoid_diameter", "equivalent_spherical_radius"]
 
 # id,accession,series_number,series_name,system,label,number,calculator,measure,metric,value
 def stats_to_csv(stats, key, sys_name, calc, subject, session):
+    # One dict per row, stats_store.stats_to_table builds the same rows as typed columns
     dat=[]
     for label in stats.keys():
         istats=stats[label]
-        print(label)
-
         for measure in istats.keys():   
-            print(measure)
             mstats=istats[measure]
             for metric in  mstats.keys():
-                print(metric)
                 row = {"subject": subject, "session": session, "label":label, "name": key[label], "system": sys_name, "measure": measure, "metric": metric, "value": mstats[metric]}
                 dat.append(row)
     return(dat)
 
-def get_simple_itk_stats(image, labels, key, extended):
+def write_stats(systems, stats, calc, subject, session, output=None, store=None):
+    """
+    Write the stats of each (segmentation, key, system name) in systems to a csv and/or the stats store.
+
+    The store needs pyarrow (pip install picsl-gh-pipelines[store]). Without it the csv is written
+    with the csv module, in the same layout as stats_store.write_csv.
+    """
+    try:
+        import pyarrow as pa
+        from picslpipes.utils.stats_store import stats_to_table, write_csv, append_stats
+    except ImportError:
+        if store is not None:
+            raise
+        rows = [ row for seg, key, name in systems for row in stats_to_csv(stats[name], key, name, calc, subject, session) ]
+        columns = ["subject", "session", "label", "name", "system", "measure", "metric", "value"]
+        with open(output, "w", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow([""] + columns)
+            for i, row in enumerate(rows):
+                writer.writerow([i] + [ row[c] for c in columns ])
+        return
+
+    table = pa.concat_tables([ stats_to_table(stats[name], key, name, calc, subject, session) for seg, key, name in systems ])
+    if output is not None:
+        write_csv(table, output)
+    if store is not None:
+        append_stats(store, table)
+
+@traced()
+def get_simple_itk_stats(image, labels, key=None, extended=True, stats=None):
+    """
+    Get intensity and shape stats for each label in key using SimpleITK.
+
+    labels may also be a list of (segmentation, key, system name) triples, in which case
+    every labeling system is computed against the same image with one filter instance and
+    a dict of system name to stats is returned.
+    """
 
-    stats = sitk.LabelIntensityStatisticsImageFilter()
-    stats.SetBackgroundValue(0)
+    if stats is None:
+        stats = sitk.LabelIntensityStatisticsImageFilter()
+        stats.SetBackgroundValue(0)
 
-    if extended:
-        stats.ComputeFeretDiameterOn()
-        stats.ComputePerimeterOn()
+        if extended:
+            stats.ComputeFeretDiameterOn()
+            stats.ComputePerimeterOn()
+
+    if isinstance(labels, (list, tuple)):
+        systems={}
+        for seg, sys_key, sys_name in labels:
+            systems[sys_name] = get_simple_itk_stats(image, seg, sys_key, extended, stats)
+        return(systems)
 
     stats.Execute(labels, image)
     dat={}
@@ -56,45 +105,197 @@ def get_simple_itk_stats(image, labels, key, extended):
         dat[value]=measure
     return(dat)
 
+@traced()
+def get_numpy_stats(image, labels, key=None, shape=None, percentiles=None):
+    """
+    Get intensity and selected shape stats for each label in key using vectorized numpy.
+
+    Count, mean, sd and min/max for every label come from one np.bincount/ufunc.at pass over
+    the labeled voxels, and the median and percentiles from a single sort grouped by label.
+    The median is exact, unlike the histogram estimate of the SimpleITK calculator. Only the
+    shape metrics listed in shape are computed; metrics other than physical_size and skewness
+    need a LabelShapeStatisticsImageFilter pass, and feret_diameter/perimeter are only turned
+    on in that filter when asked for.
+
+    shape defaults to ["physical_size"] and percentiles to [5, 25, 75, 95].
+
+    labels may also be a list of (segmentation, key, system name) triples, as for get_simple_itk_stats.
+    """
+
+    if shape is None:
+        shape = ["physical_size"]
+    if percentiles is None:
+        percentiles = [5, 25, 75, 95]
+
+    if isinstance(labels, (list, tuple)):
+        systems={}
+        for seg, sys_key, sys_name in labels:
+            systems[sys_name] = get_numpy_stats(image, seg, sys_key, shape, percentiles)
+        return(systems)
+
+    for metric in shape:
+        if metric not in SHAPE_METRICS:
+            raise ValueError("Unknown shape metric: "+str(metric))
+
+    values = [ int(v) for v in key ]
+    label_array = sitk.GetArrayViewFromImage(labels).ravel()
+
+    # Map label values in the key to dense indices 1..n, everything else to 0
+    dense = np.zeros(max(int(label_array.max(initial=0)), max(values, default=0)) + 1, dtype=np.int32)
+    dense[values] = np.arange(1, len(values)+1)
+    index = dense[label_array]
+    selected = np.flatnonzero(index)
+    index = index[selected]
+    signal = sitk.GetArrayViewFromImage(image).ravel()[selected].astype(np.float64)
+    n = len(values) + 1
+
+    count = np.bincount(index, minlength=n)
+    safe_count = np.maximum(count, 1)
+    mean = np.bincount(index, weights=signal, minlength=n) / safe_count
+    centered = signal - mean[index]
+    m2 = np.bincount(index, weights=centered*centered, minlength=n)
+    sd = np.sqrt(m2 / np.maximum(count-1, 1))
+    minimum = np.full(n, np.inf)
+    maximum = np.full(n, -np.inf)
+    np.minimum.at(minimum, index, signal)
+    np.maximum.at(maximum, index, signal)
+
+    # Sort voxels by label then value so each label's values are a contiguous sorted run
+    ordered = signal[np.lexsort((signal, index))]
+    start = np.concatenate(([0], np.cumsum(count)[:-1]))
+
+    def percentile(q):
+        pos = (count-1) * (q/100.0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        present = count > 0
+        result = np.full(n, np.nan)
+        lo_val = ordered[(start+lo)[present]]
+        hi_val = ordered[(start+hi)[present]]
+        result[present] = lo_val + (hi_val - lo_val) * (pos - lo)[present]
+        return(result)
+
+    median = percentile(50)
+    pvalues = { q: percentile(q) for q in percentiles }
+
+    if "skewness" in shape:
+        m3 = np.bincount(index, weights=centered*centered*centered, minlength=n) / safe_count
+        skewness = m3 / np.where(sd > 0, sd**3, np.inf)
+
+    shape_stats = None
+    sitk_shape = [ m for m in shape if m not in ["physical_size", "skewness"] ]
+    if len(sitk_shape) > 0:
+        shape_stats = sitk.LabelShapeStatisticsImageFilter()
+        shape_stats.SetBackgroundValue(0)
+        if "feret_diameter" in sitk_shape:
+            shape_stats.ComputeFeretDiameterOn()
+        if "perimeter" in sitk_shape or "roundness" in sitk_shape:
+            shape_stats.ComputePerimeterOn()
+        shape_stats.Execute(labels)
+
+    voxel_volume = float(np.prod(labels.GetSpacing()))
+
+    dat={}
+    for i, value in enumerate(values, start=1):
+        intensity={}
+        shape_dat={}
+        measure={}
+        if count[i] > 0:
+            intensity["count"] = int(count[i])
+            intensity["mean"] = float(mean[i])
+            intensity["minimum"] = float(minimum[i])
+            intensity["maximum"] = float(maximum[i])
+            intensity["median"] = float(median[i])
+            intensity["sd"] = float(sd[i])
+            for q in percentiles:
+                intensity["p"+str(q).zfill(2)] = float(pvalues[q][i])
+
+            if "physical_size" in shape:
+                shape_dat["physical_size"] = float(count[i] * voxel_volume)
+            if "skewness" in shape:
+                shape_dat["skewness"] = float(skewness[i])
+            if shape_stats is not None and shape_stats.HasLabel(value):
+                if "roundness" in shape:
+                    shape_dat["roundness"] = shape_stats.GetRoundness(value)
+                if "elongation" in shape:
+                    shape_dat["elongation"] = shape_stats.GetElongation(value)
+                if "feret_diameter" in shape:
+                    shape_dat["feret_diameter"] = shape_stats.GetFeretDiameter(value)
+                if "perimeter" in shape:
+                    shape_dat["perimeter"] = shape_stats.GetPerimeter(value)
+                if "ellipsoid_diameter" in shape:
+                    diameter = shape_stats.GetEquivalentEllipsoidDiameter(value)
+                    shape_dat["ellipsoid_diameter_0"] = diameter[0]
+                    shape_dat["ellipsoid_diameter_1"] = diameter[1]
+                    shape_dat["ellipsoid_diameter_2"] = diameter[2]
+                if "equivalent_spherical_radius" in shape:
+                    shape_dat["equivalent_spherical_radius"] = shape_stats.GetEquivalentSphericalRadius(value)
+        measure['shape']=shape_dat
+        measure['intensity']=intensity
+        dat[value]=measure
+    return(dat)
+
+def read_key(filename):
+    key={}
+    with open(filename, 'r') as keyfile:
+        reader=csv.reader(keyfile)
+        for count, row in enumerate(reader):
+            if count > 0 and (len(row)>0):
+                key[int(row[0])]=row[1]
+        keyfile.close()
+    return(key)
+
 def main():
     parser = argparse.ArgumentParser(description='Apply lung segmentation models to a CT volume')
     parser.add_argument('-i', '--input', help='Input CT volume', type=str, required=True)
-    parser.add_argument('-s', '--segmentation', help='Labeled regions', type=str, required=True)
-    parser.add_argument('-k', '--key', help='csv with labels and names', type=str, required=True)
-    parser.add_argument('-n', '--name', help='name of the labeling system', type=str, required=True)
-    parser.add_argument('-c', '--calculator', help='package to use for stats: [simpleitk, pyradiomics]', type=str, required=False, default="simpleitk")
-    parser.add_argument('-e', '--extended', help='get shape stats', type=bool, required=False, default=True)
+    parser.add_argument('-s', '--segmentation', help='Labeled regions, one per labeling system', type=str, nargs='+', required=True)
+    parser.add_argument('-k', '--key', help='csv with labels and names, one per segmentation', type=str, nargs='+', required=True)
+    parser.add_argument('-n', '--name', help='name of the labeling system, one per segmentation', type=str, nargs='+', required=True)
+    parser.add_argument('-c', '--calculator', help='package to use for stats: [simpleitk, numpy, texture]', type=str, required=False, default="simpleitk")
+    parser.add_argument('-e', '--extended', help='get all shape stats', action='store_true', default=False)
+    parser.add_argument('-m', '--shape', help='shape stats for the numpy calculator: '+str(SHAPE_METRICS), type=str, nargs='*', required=False, default=["physical_size"])
+    parser.add_argument('--bins', help='grey level bins for the texture calculator', type=int, default=16)
+    parser.add_argument('--hmin', help='histogram minimum for the texture calculator (default: region minimum)', type=float)
+    parser.add_argument('--hmax', help='histogram maximum for the texture calculator, values from it up are not binned (default: just above the region maximum)', type=float)
+    parser.add_argument('--run-bins', help='run length bins for the texture calculator', type=int, default=32)
     parser.add_argument('-a', '--subject', type=str, required=True)
     parser.add_argument('-b', '--session', type=str, required=True)    
 
     parser.add_argument('-o', '--output', help='Output csv')
+    parser.add_argument('--store', help='Also append the stats to this partitioned Parquet dataset (see stats_store.py)', type=str)
+    add_io_arguments(parser)
+    add_trace_arguments(parser)
     args = parser.parse_args()
+    apply_io_arguments(args)
+    apply_trace_arguments(args)
 
-    key={}
-    with open(args.key, 'r') as keyfile:
-        reader=csv.reader(keyfile)
-        for count, row in enumerate(reader):
-            if count > 0 and (len(row)>0):
-                print(row)
-                key[int(row[0])]=row[1]
-        keyfile.close()
+    if not (len(args.segmentation) == len(args.key) == len(args.name)):
+        print("Number of segmentations, keys and names must match")
+        return(1)
+
+    if args.output is None and args.store is None:
+        print("Need an output csv (-o) or a stats store (--store)")
+        return(1)
 
-    print(key)
+    keys=[ read_key(k) for k in args.key ]
     
-    if args.calculator == 'simpleitk':
-        signal = sitk.ReadImage(args.input)
-        labels = sitk.ReadImage(args.segmentation, sitk.sitkUInt16)
-        stats = get_simple_itk_stats(signal, labels, key, args.extended )
-        print(stats)
+    if args.calculator not in ['simpleitk', 'numpy', 'texture']:
+        print("Unknown calculator: "+args.calculator)
+        return(1)
 
+    signal = read_image(args.input)
+    systems = [ (read_image(seg, sitk.sitkUInt16), key, name) for seg, key, name in zip(args.segmentation, keys, args.name) ]
 
+    if args.calculator == 'simpleitk':
+        stats = get_simple_itk_stats(signal, systems, extended=args.extended)
+    elif args.calculator == 'numpy':
+        shape = SHAPE_METRICS if args.extended else args.shape
+        stats = get_numpy_stats(signal, systems, shape=shape)
+    elif args.calculator == 'texture':
+        from picslpipes.utils.region_texture_features import get_region_texture_stats
+        stats = get_region_texture_stats(signal, systems, bins=args.bins, hmin=args.hmin, hmax=args.hmax, run_bins=args.run_bins)
 
-        dat=stats_to_csv(stats, key, args.name, args.calculator, args.subject, args.session)
-        print(dat)
-        df=pd.DataFrame(dat)
-        with pd.option_context('display.max_rows', None, 'display.max_columns', None):  # more options can be specified also
-            print(df)
-        df.to_csv(args.output)
+    write_stats(systems, stats, args.calculator, args.subject, args.session, args.output, args.store)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,182 @@
+import os
+import gzip
+import shutil
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from picslpipes.utils.tracing import stage
+
+# How images are written and read by the picslpipes tools.
+#
+# Final outputs named *.gz are written uncompressed and then compressed with several threads:
+# pigz when it is on the PATH, otherwise independent gzip members compressed in a thread pool
+# (zlib releases the GIL) and concatenated, which any gzip reader, ITK and nibabel included,
+# reads as one stream. Intermediates should be plain .nii, ideally in a scratch directory:
+# they skip compression entirely, stream by slab in SimpleITK and open memory mapped in nibabel.
+#
+# Settings come from environment variables so they reach every tool started by a driver
+# script, and can be overridden on the command line with add_io_arguments/apply_io_arguments.
+
+ENV_SCRATCH = "PICSLPIPES_SCRATCH"
+ENV_GZIP_LEVEL = "PICSLPIPES_GZIP_LEVEL"
+ENV_GZIP_THREADS = "PICSLPIPES_GZIP_THREADS"
+
+GZIP_CHUNK = 16 << 20
+
+# Cores allocated to the job by SLURM, LSF, SGE and PBS
+ENV_ALLOCATED_CPUS = ["SLURM_CPUS_PER_TASK", "LSB_DJOB_NUMPROC", "NSLOTS", "PBS_NUM_PPN"]
+
+def available_cpus() -> int:
+    """
+    CPUs this process may use: the CPUs it is pinned to, capped by the cores the batch system
+    allocated to the job, so a job on a shared node does not start a thread per core of the node
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    for env in ENV_ALLOCATED_CPUS:
+        value = os.environ.get(env, "")
+        if value.isdigit() and int(value) > 0:
+            return(min(cpus, int(value)))
+    return(cpus)
+
+def io_settings() -> dict:
+    """
+    Current I/O settings.
+
+    Returns:
+    dict: "scratch" (directory for intermediates or None), "gzip_level" (1-9) and "gzip_threads".
+    """
+    return({
+        "scratch": os.environ.get(ENV_SCRATCH) or None,
+        "gzip_level": int(os.environ.get(ENV_GZIP_LEVEL, 1)),
+        "gzip_threads": int(os.environ.get(ENV_GZIP_THREADS, available_cpus()))
+    })
+
+def add_io_arguments(parser):
+    parser.add_argument('--scratch', help='Directory for uncompressed intermediates (env '+ENV_SCRATCH+')', type=str)
+    parser.add_argument('--gzip-level', help='Compression level of .gz outputs (env '+ENV_GZIP_LEVEL+', default 1)', type=int)
+    parser.add_argument('--gzip-threads', help='Threads compressing .gz outputs (env '+ENV_GZIP_THREADS+', default the CPUs allocated to the job)', type=int)
+
+def apply_io_arguments(args) -> dict:
+    """
+    Copy the I/O options given on the command line into the environment, so child processes
+    use them too, and return the resulting settings
+    """
+    for env, value in [(ENV_SCRATCH, args.scratch), (ENV_GZIP_LEVEL, args.gzip_level), (ENV_GZIP_THREADS, args.gzip_threads)]:
+        if value is not None:
+            os.environ[env] = str(value)
+    return(io_settings())
+
+def scratch_path(filename: str, scratch: str=None) -> str:
+    """
+    Uncompressed path for an intermediate: filename with .nii.gz replaced by .nii, in the
+    scratch directory if one is set and next to filename otherwise.
+    """
+    if scratch is None:
+        scratch = io_settings()["scratch"]
+    if filename.endswith('.gz'):
+        filename = filename[:-3]
+    if scratch is None:
+        return(filename)
+    os.makedirs(scratch, exist_ok=True)
+    return(os.path.join(scratch, os.path.basename(filename)))
+
+def compress_file(src: str, dst: str, level: int=None, threads: int=None):
+    """
+    Gzip src into dst with several threads.
+
+    Parameters:
+    src (str): Uncompressed file.
+    dst (str): Compressed file, replaced atomically.
+    level (int): Compression level, default from io_settings.
+    threads (int): Compression threads, default from io_settings.
+    """
+    settings = io_settings()
+    level = settings["gzip_level"] if level is None else level
+    threads = settings["gzip_threads"] if threads is None else threads
+
+    tmp = dst+'.tmp.'+str(os.getpid())
+    pigz = shutil.which('pigz')
+    with stage("io.compress_file", file=dst, level=level, threads=threads, pigz=pigz is not None):
+        if pigz is not None:
+            logging.debug("compress_file: pigz -"+str(level)+" -p "+str(threads)+" "+src)
+            with open(tmp, 'wb') as out:
+                subprocess.run([pigz, '-'+str(level), '-p', str(threads), '-c', src], stdout=out, check=True)
+        else:
+            logging.debug("compress_file: "+str(threads)+" gzip threads, level "+str(level)+" "+src)
+            with open(src, 'rb') as f, open(tmp, 'wb') as out, ThreadPoolExecutor(threads) as pool:
+                while True:
+                    # A bounded batch of chunks at a time keeps memory at threads*GZIP_CHUNK
+                    chunks = [ c for c in [ f.read(GZIP_CHUNK) for i in range(threads) ] if len(c) > 0 ]
+                    if len(chunks) == 0:
+                        break
+                    for member in pool.map(lambda c: gzip.compress(c, level, mtime=0), chunks):
+                        out.write(member)
+    os.replace(tmp, dst)
+
+def _write_uncompressed(img, filename: str, compress: bool=False):
+    module = type(img).__module__.split('.')[0]
+    if module == 'SimpleITK':
+        import SimpleITK as sitk
+        sitk.WriteImage(img, filename, compress)
+    elif module == 'itk':
+        import itk
+        itk.imwrite(img, filename, compression=compress)
+    elif module == 'nibabel':
+        import nibabel as nib
+        nib.save(img, filename)
+    elif module == 'ants':
+        import ants
+        ants.image_write(img, filename)
+    else:
+        raise TypeError("Unsupported image type: "+str(type(img)))
+
+def write_image(img, filename: str):
+    """
+    Write a SimpleITK, ITK, nibabel or ANTs image following the I/O policy.
+
+    .nii and other uncompressed names are written directly. For .gz names the image is
+    written uncompressed to the scratch directory (or next to filename) and compressed
+    with compress_file, unless only one thread is allowed and pigz is missing, in which
+    case the library's own writer compresses it.
+    """
+    with stage("io.write_image", file=filename):
+        if not filename.endswith('.gz'):
+            _write_uncompressed(img, filename)
+            return
+
+        settings = io_settings()
+        if settings["gzip_threads"] <= 1 and shutil.which('pigz') is None:
+            _write_uncompressed(img, filename, True)
+            return
+
+        root, ext = os.path.splitext(scratch_path(filename))
+        tmp = root+'.tmp'+str(os.getpid())+ext
+        try:
+            _write_uncompressed(img, tmp)
+            compress_file(tmp, filename, settings["gzip_level"], settings["gzip_threads"])
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+def read_image(filename: str, pixel_type=None):
+    """
+    Read a SimpleITK image. Uncompressed .nii intermediates are read without decompression,
+    and SimpleITK's streaming reader (see merge_label_volume_files) only reads the requested region.
+    """
+    import SimpleITK as sitk
+    with stage("io.read_image", file=filename):
+        if pixel_type is None:
+            return(sitk.ReadImage(filename))
+        return(sitk.ReadImage(filename, pixel_type))
+
+def read_volume(filename: str):
+    """
+    Read an image as an image_interop Volume with nibabel. Uncompressed files are memory
+    mapped, so only the voxels that are used are read from disk.
+    """
+    import nibabel as nib
+    from picslpipes.utils.image_interop import from_nibabel
+    return(from_nibabel(nib.load(filename, mmap='r')))
@@ -1,19 +1,245 @@
-import itk, sys,argparse
+import itk, os, sys,argparse
+import multiprocessing
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/utils/itk_texture_features.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.utils.io_policy import add_io_arguments, apply_io_arguments, available_cpus, write_image
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments, traced
+
+@traced()
+def texture_feature_image(im, mask, features, bins, hmin, hmax, radius, min_distance=None, max_distance=None):
+    """
+    Run the ITK GLCM or GLRLM texture filter and return the multi-component feature image
+    """
+    if features == 'GLCM':
+        filtr = itk.CoocurrenceTextureFeaturesImageFilter.New(im)
+        filtr.SetMaskImage(mask)
+        filtr.SetNumberOfBinsPerAxis(bins)
+        filtr.SetHistogramMinimum(hmin)
+        filtr.SetHistogramMaximum(hmax)
+        filtr.SetNeighborhoodRadius([radius, radius, radius])
+    elif features == 'GLRLM':
+        filtr = itk.RunLengthTextureFeaturesImageFilter.New(im)
+        filtr.SetMaskImage(mask)
+        filtr.SetNumberOfBinsPerAxis(bins)
+        filtr.SetHistogramValueMinimum(hmin)
+        filtr.SetHistogramValueMaximum(hmax)
+        if min_distance is not None:
+            filtr.SetHistogramDistanceMinimum(min_distance)
+        if max_distance is not None:
+            filtr.SetHistogramDistanceMaximum(max_distance)
+        filtr.SetNeighborhoodRadius([radius, radius, radius])
+    else:
+        return(None)
+
+    filtr.Update()
+    return(filtr.GetOutput())
+
+def intensity_bounds(im, mask=None):
+    """
+    Minimum and maximum intensity of the image, or of the voxels inside the mask if given
+    """
+    values = itk.GetArrayViewFromImage(im)
+    if mask is not None:
+        values = values[itk.GetArrayViewFromImage(mask) > 0]
+        if values.size == 0:
+            return(None)
+    return((int(np.min(values)), int(np.max(values))))
+
+@traced()
+def quantize_image(im, bins, hmin, hmax, slab_size=32):
+    """
+    Digitize an image into histogram bins the same way the ITK texture filters do internally.
+
+    Values in [hmin, hmax) map to bin indices 0..bins-1 and values outside that range map to
+    bins, which the filters ignore. Running a filter on the result with a histogram range of
+    [0, bins] gives exactly the same features as running it on the original image with
+    [hmin, hmax], so one quantized image can be shared by several feature families.
+    The conversion is done in z-slabs to avoid a full-size floating point copy.
+    """
+    values = itk.GetArrayViewFromImage(im)
+    quantized = np.empty(values.shape, dtype=np.int16)
+    width = (hmax - hmin) / float(bins)
+    for z0 in range(0, values.shape[0], slab_size):
+        v = values[z0:z0+slab_size].astype(np.float64)
+        q = ((v - hmin) / width).astype(np.int16)
+        q[(v < hmin) | (v >= hmax)] = bins
+        quantized[z0:z0+slab_size] = q
+
+    out = itk.GetImageFromArray(quantized)
+    out.CopyInformation(im)
+    return(out)
+
+def mask_bounding_box(mask, pad):
+    """
+    Bounding box of the nonzero mask voxels as numpy (z,y,x) slices, padded by pad voxels
+    and clipped to the image. Returns None for an empty mask.
+    """
+    mask_array = itk.GetArrayViewFromImage(mask)
+    box = []
+    for axis in range(mask_array.ndim):
+        other = tuple([ a for a in range(mask_array.ndim) if a != axis ])
+        nonzero = np.flatnonzero(np.any(mask_array, axis=other))
+        if len(nonzero) == 0:
+            return(None)
+        box.append(slice(max(nonzero[0]-pad, 0), min(nonzero[-1]+pad+1, mask_array.shape[axis])))
+    return(tuple(box))
+
+def crop_image(im, box):
+    """
+    Copy the (z,y,x) box of an image into a new image with the matching physical origin
+    """
+    crop = itk.GetImageFromArray(np.ascontiguousarray(itk.GetArrayViewFromImage(im)[box]))
+    start = [ int(b.start) for b in box[::-1] ]
+    crop.SetOrigin(im.TransformIndexToPhysicalPoint(start))
+    crop.SetSpacing(im.GetSpacing())
+    crop.SetDirection(im.GetDirection())
+    return(crop)
+
+def vector_image_like(array, reference):
+    """
+    Wrap a (z,y,x,components) feature array as an ITK vector image with the reference geometry
+    """
+    out = itk.GetImageFromArray(array, is_vector=True)
+    out.SetOrigin(reference.GetOrigin())
+    out.SetSpacing(reference.GetSpacing())
+    out.SetDirection(reference.GetDirection())
+    return(out)
+
+def paste_feature_image(result, reference, box):
+    """
+    Paste a feature image computed on a cropped box into a zero image on the reference grid
+    """
+    result_array = itk.GetArrayViewFromImage(result)
+    full = np.zeros(itk.GetArrayViewFromImage(reference).shape + result_array.shape[3:], dtype=result_array.dtype)
+    full[box] = result_array
+    return(vector_image_like(full, reference))
+
+def _slab_texture_features(slab):
+    """
+    Process pool worker: rebuild the slab images from arrays and run the texture filter
+    with an explicit ITK thread count
+    """
+    im_array, mask_array, spacing, direction, threads, params = slab
+    itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(threads)
+
+    im = itk.GetImageFromArray(im_array)
+    mask = itk.GetImageFromArray(mask_array)
+    for img in [im, mask]:
+        img.SetSpacing(spacing)
+        img.SetDirection(itk.matrix_from_array(direction))
+
+    result = texture_feature_image(im, mask, *params)
+    return(itk.GetArrayFromImage(result))
+
+@traced()
+def tiled_texture_feature_image(im, mask, features, bins, hmin, hmax, radius, min_distance=None, max_distance=None, jobs=2, threads=None):
+    """
+    Run the texture filter on z-slabs in a process pool and stitch the slab interiors together.
+
+    Each slab is extended by a halo of radius slices on both sides so every voxel in its
+    interior sees the same neighborhood as in a single run over the whole image.
+
+    Parameters:
+    jobs (int): Number of worker processes and slabs.
+    threads (int): ITK threads per worker, defaults to the CPUs allocated to the job divided by jobs.
+    """
+    im_array = itk.GetArrayViewFromImage(im)
+    mask_array = itk.GetArrayViewFromImage(mask)
+    nz = im_array.shape[0]
+    halo = max(radius, 1)
+    jobs = max(1, min(jobs, nz))
+    if threads is None:
+        threads = max(1, available_cpus() // jobs)
+
+    spacing = [ float(s) for s in im.GetSpacing() ]
+    direction = itk.array_from_matrix(im.GetDirection())
+    params = (features, bins, hmin, hmax, radius, min_distance, max_distance)
+
+    edges = np.linspace(0, nz, jobs+1).astype(int)
+    bounds = []
+    slabs = []
+    for z0, z1 in zip(edges[:-1], edges[1:]):
+        a0 = max(z0-halo, 0)
+        a1 = min(z1+halo, nz)
+        bounds.append((z0, z1, a0))
+        slabs.append((np.ascontiguousarray(im_array[a0:a1]), np.ascontiguousarray(mask_array[a0:a1]), spacing, direction, threads, params))
+
+    full = None
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+        for (z0, z1, a0), result in zip(bounds, pool.map(_slab_texture_features, slabs)):
+            if full is None:
+                full = np.zeros(im_array.shape + result.shape[3:], dtype=result.dtype)
+            full[z0:z1] = result[z0-a0:z1-a0]
+
+    return(vector_image_like(full, im))
+
+@traced()
+def roi_texture_feature_image(im, mask, features, bins, hmin, hmax, radius, min_distance=None, max_distance=None, jobs=1, threads=None):
+    """
+    Run the texture filter only over the bounding box of the mask and paste the result back
+    onto the full grid.
+
+    The box is padded by the neighborhood radius (at least one voxel). The filter reads
+    neighbors past the image edge as copies of the edge voxel, so the margin keeps those
+    reads outside the mask and values inside the mask match an uncropped run exactly.
+    """
+    box = mask_bounding_box(mask, max(radius, 1))
+    if box is None:
+        return(None)
+
+    if jobs > 1:
+        result = tiled_texture_feature_image(crop_image(im, box), crop_image(mask, box), features, bins, hmin, hmax,
+                                             radius, min_distance, max_distance, jobs, threads)
+    else:
+        result = texture_feature_image(crop_image(im, box), crop_image(mask, box), features, bins, hmin, hmax,
+                                       radius, min_distance, max_distance)
+    if result is None:
+        return(None)
+
+    return(paste_feature_image(result, im, box))
+
+def compare_feature_maps(a, b, mask):
+    """
+    Maximum absolute difference between two feature images over the nonzero mask voxels.
+    Features undefined (NaN) in both images agree, NaN in only one of them is an infinite difference.
+    """
+    inside = itk.GetArrayViewFromImage(mask) > 0
+    a_inside = itk.GetArrayViewFromImage(a)[inside].astype(np.float64)
+    b_inside = itk.GetArrayViewFromImage(b)[inside].astype(np.float64)
+    diff = np.abs(a_inside - b_inside)
+    if diff.size == 0:
+        return(0.0)
+    # e.g. GLRLM features of a neighborhood without runs in the distance range
+    diff[np.isnan(a_inside) & np.isnan(b_inside)] = 0.0
+    diff[np.isnan(diff)] = np.inf
+    return(float(np.max(diff)))
 
 def main():
     parser = argparse.ArgumentParser(description='Apply lung segmentation models to a CT volume')
     parser.add_argument('-i', '--input', help='Input CT volume', type=str, required=True)
     parser.add_argument('-s', '--seg', help='Input segmentation', type=str, required=True)
-    parser.add_argument('-f', '--features', help='Type of features to calculate: GLCM or GLRLM', type=str, default='GLCM')
-    parser.add_argument('-o', '--output', help='Output file')
+    parser.add_argument('-f', '--features', help='Types of features to calculate: GLCM and/or GLRLM', type=str, nargs='+', default=['GLCM'])
+    parser.add_argument('-o', '--output', help='Output file, one per feature type', nargs='+')
     parser.add_argument('-b', '--bins', help='Number of bins per axis', type=int, default=256)
     parser.add_argument('-n', '--min', help='Minimum intensity value', type=int)
     parser.add_argument('-x', '--max', help='Maximum intensity value', type=int)
+    parser.add_argument('-m', '--mask-bounds', help='Compute missing intensity bounds inside the mask only', action='store_true', default=False)
     parser.add_argument('-r', '--radius', help='Neighborhood radius', type=int, default=2)
     parser.add_argument('-d', '--min-distance', help='Distance value min', type=int)
     parser.add_argument('-e', '--max-distance', help='Distance value max', type=int)
+    parser.add_argument('-c', '--roi', help='Only compute features in the bounding box of the mask', action='store_true', default=False)
+    parser.add_argument('-j', '--jobs', help='Number of worker processes, each running one z-slab', type=int, default=1)
+    parser.add_argument('-t', '--threads', help='ITK threads per worker (default: allocated CPUs / jobs)', type=int)
+    parser.add_argument('--verify', help='Also run the uncropped single-process filter and report the largest difference inside the mask', action='store_true', default=False)
+    add_io_arguments(parser)
+    add_trace_arguments(parser)
     args = parser.parse_args()
+    apply_io_arguments(args)
+    apply_trace_arguments(args)
     print(args)
 
     # Note - input image *must* have integer pixel type
@@ -32,44 +258,54 @@ def main():
     maskReader.SetFileName(args.seg)
 
     imReader.Update()
+    maskReader.Update()
     im = imReader.GetOutput()
     mask = maskReader.GetOutput()
 
+    for features in args.features:
+        if features not in ['GLCM', 'GLRLM']:
+            print('Unknown feature type: '+features)
+            return(1)
+
+    if args.output is None or len(args.output) != len(args.features):
+        print('Need one output file per feature type')
+        return(1)
+
     hmin = args.min
     hmax = args.max
 
-    if hmin is None:
-        hmin = int(np.min(itk.GetArrayViewFromImage(im)))
-    if hmax is None:
-        hmax = int(np.max(itk.GetArrayViewFromImage(im)))
-    
+    if hmin is None or hmax is None:
+        bounds = intensity_bounds(im, mask if args.mask_bounds else None)
+        if bounds is None:
+            print('Mask is empty')
+            return(1)
+        if hmin is None:
+            hmin = bounds[0]
+        if hmax is None:
+            hmax = bounds[1]
 
-    if args.features == 'GLCM':
-        filtr = itk.CoocurrenceTextureFeaturesImageFilter.New(im)
-        filtr.SetMaskImage(mask)
-        filtr.SetNumberOfBinsPerAxis(args.bins)
-        filtr.SetHistogramMinimum(hmin)
-        filtr.SetHistogramMaximum(hmax)
-        filtr.SetNeighborhoodRadius([args.radius, args.radius, args.radius])
-        result = filtr.GetOutput()
-        itk.imwrite(result, args.output)
-    elif args.features == 'GLRLM':
-        filtr = itk.RunLengthTextureFeaturesImageFilter.New(im)
-        filtr.SetMaskImage(mask)
-        filtr.SetNumberOfBinsPerAxis(args.bins)
-        filtr.SetHistogramValueMinimum(hmin)
-        filtr.SetHistogramValueMaximum(hmax)
-        if args.min_distance is not None:
-            filtr.SetHistogramDistanceMinimum(args.min_distance)
-        if args.max_distance is not None:
-            filtr.SetHistogramDistanceMaximum(args.max_distance)
-        filtr.SetNeighborhoodRadius([args.radius, args.radius, args.radius])
-        result = filtr.GetOutput()
-        itk.imwrite(result, args.output)
-    else:
-        print('Unknown feature type')
-        return(1)
+    # Digitize once and share the result between all feature types
+    quantized = quantize_image(im, args.bins, hmin, hmax)
+
+    for features, output in zip(args.features, args.output):
+        params = (features, args.bins, 0, args.bins, args.radius, args.min_distance, args.max_distance)
+        if args.roi:
+            result = roi_texture_feature_image(quantized, mask, *params, args.jobs, args.threads)
+            if result is None:
+                print('Mask is empty')
+                return(1)
+        elif args.jobs > 1:
+            result = tiled_texture_feature_image(quantized, mask, *params, args.jobs, args.threads)
+        else:
+            result = texture_feature_image(quantized, mask, *params)
+
+        if args.verify:
+            reference = texture_feature_image(im, mask, features, args.bins, hmin, hmax, args.radius, args.min_distance, args.max_distance)
+            diff = compare_feature_maps(result, reference, mask)
+            print(features+' maximum difference inside mask: '+str(diff))
+
+        write_image(result, output)
     
     return(0)
 if __name__=="__main__":
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())
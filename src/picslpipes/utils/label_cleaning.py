@@ -0,0 +1,114 @@
+import argparse
+import math
+import os
+import sys
+import logging
+import SimpleITK as sitk
+import numpy as np
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/utils/label_cleaning.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.utils.io_policy import add_io_arguments, apply_io_arguments, read_image, write_image
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments, traced
+
+def label_components( image ) -> tuple:
+    """
+    Connected components of every label of a label image in one pass.
+
+    ScalarConnectedComponent only joins neighboring voxels with the same value, so touching
+    regions with different labels stay separate components and no per-label thresholding is needed.
+
+    Returns:
+    tuple: Component image (0 for background), the label of each component and the voxel count
+    of each component, both indexed by component.
+    """
+    mask = sitk.Cast(image > 0, sitk.sitkUInt8)
+    component_image = sitk.ScalarConnectedComponent(image, mask)
+    components = sitk.GetArrayViewFromImage(component_image)
+    labels = sitk.GetArrayViewFromImage(image)
+
+    n = int(components.max()) + 1
+    sizes = np.bincount(components.ravel(), minlength=n)
+    component_label = np.zeros(n, dtype=labels.dtype)
+    component_label[components] = labels
+    sizes[0] = 0
+    return((component_image, component_label, sizes))
+
+@traced()
+def clean_label_components( image, largest: bool=True, min_voxels: int=0, min_volume: float=0.0, labels: list=None ) -> sitk.Image:
+    """
+    Remove small disconnected pieces from every label of a label image.
+
+    Parameters:
+    image (sitk.Image): Integer label image.
+    largest (bool): Keep the largest component of each label.
+    min_voxels (int): Also keep components with at least this many voxels.
+    min_volume (float): Also keep components of at least this physical volume (mm^3).
+    labels (list): Labels to keep, others are set to background. Default all labels.
+
+    With largest=False and no threshold every component is kept. Components are face connected,
+    as for ANTs GetLargestComponent.
+
+    Returns:
+    sitk.Image: Cleaned label image with the pixel type and geometry of image.
+    """
+    logging.debug("clean_label_components: start")
+
+    if labels is not None:
+        label_array = sitk.GetArrayViewFromImage(image)
+        keep_labels = np.isin(label_array, np.array(labels, dtype=label_array.dtype))
+        kept = sitk.GetImageFromArray(np.where(keep_labels, label_array, 0).astype(label_array.dtype))
+        kept.CopyInformation(image)
+        image = kept
+
+    voxel_volume = float(np.prod(image.GetSpacing()))
+    if min_volume > 0:
+        min_voxels = max(min_voxels, int(math.ceil(min_volume / voxel_volume - 1e-6)))
+
+    component_image, component_label, sizes = label_components(image)
+
+    keep = np.zeros(len(sizes), dtype=bool)
+    if largest:
+        # Largest component of each label: sort by label then size, the last of each label wins
+        order = np.lexsort((sizes, component_label))
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = component_label[order[:-1]] != component_label[order[1:]]
+        keep[order[last]] = True
+    if min_voxels > 0:
+        keep |= sizes >= min_voxels
+    if not largest and min_voxels <= 0:
+        keep[:] = True
+    keep[0] = False
+    keep &= component_label > 0
+
+    removed = sizes[~keep].sum()
+    logging.debug(f"clean_label_components: kept {int(keep.sum())} of {len(sizes)-1} components, removed {int(removed)} voxels")
+
+    label_array = sitk.GetArrayViewFromImage(image)
+    components = sitk.GetArrayViewFromImage(component_image)
+    cleaned = sitk.GetImageFromArray(np.where(keep[components], label_array, 0).astype(label_array.dtype))
+    cleaned.CopyInformation(image)
+    return(cleaned)
+
+def main():
+    my_parser = argparse.ArgumentParser(description='Keep the largest connected component (or components above a size) of every label')
+    my_parser.add_argument('-i', '--input', type=str, required=True, help="input label image")
+    my_parser.add_argument('-o', '--output', type=str, required=True, help="output label image")
+    my_parser.add_argument('-l', '--labels', type=int, nargs='+', required=False, help="labels to keep, others are removed")
+    my_parser.add_argument('-n', '--min-voxels', type=int, default=0, help="keep components with at least this many voxels")
+    my_parser.add_argument('-m', '--min-volume', type=float, default=0.0, help="keep components of at least this volume in mm^3")
+    my_parser.add_argument('-a', '--all', help="only apply the size threshold, do not always keep the largest component", action='store_true', default=False)
+    my_parser.add_argument('--verbose', help="Enable verbose output", action='store_true', default=False)
+    add_io_arguments(my_parser)
+    add_trace_arguments(my_parser)
+    args = my_parser.parse_args()
+    apply_io_arguments(args)
+    apply_trace_arguments(args)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format="%(asctime)s %(name)s - %(levelname)-6s - %(message)s")
+
+    cleaned = clean_label_components(read_image(args.input), not args.all, args.min_voxels, args.min_volume, args.labels)
+    write_image(cleaned, args.output)
+
+if __name__ == "__main__":
+    sys.exit(main())
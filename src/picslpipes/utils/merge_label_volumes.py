@@ -5,8 +5,14 @@ import logging
 import SimpleITK as sitk
 import numpy as np
 import json
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/utils/merge_label_volumes.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.utils.io_policy import add_io_arguments, apply_io_arguments, read_image, write_image
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments, traced
 
-def merge_label_volumes( inputs: dict, priorities: list) -> tuple:
+@traced()
+def merge_label_volumes( inputs: dict, priorities: list, overlap: bool=False) -> tuple:
     
     """
     Merges label volumes from multiple files into a single volume, resolving overlaps using priorities,
@@ -15,9 +21,11 @@ def merge_label_volumes( inputs: dict, priorities: list) -> tuple:
     Parameters:
     inputs (dict): Dictionary where keys are labels and values are the corresponding SimpleITK images.
     priorities (list): List of labels in the order of their priority. Higher priority labels appear first.
+    overlap (bool): Also build a bitmask image of every label claiming each voxel (see overlap_bits).
 
     Returns:
-    tuple: Merged SimpleITK label image and a JSON metadata file as a string.
+    tuple: Merged SimpleITK label image and a JSON metadata file as a string. If overlap is True
+    the bitmask overlap image is appended and the metadata gets an "Overlap" entry.
     """
     
     logging.debug("merge_label_volumes: start")
@@ -33,15 +41,25 @@ def merge_label_volumes( inputs: dict, priorities: list) -> tuple:
     metadata = {
         "MergedSegments": []
     }
+
+    merged_labels = [ label for label in priorities if label in inputs ]
+    membership = None
+    if overlap:
+        bits = overlap_bits(merged_labels)
+        if bits is None:
+            return None
+        membership = np.zeros(size, dtype=bits[1])
     
     # Iterate over the priority list to overlay each label and build the metadata
     for priority, label in enumerate(priorities, start=1):
         if label in inputs:
             logging.debug(f"Merging label {label} with priority.")
-            label_image = sitk.GetArrayFromImage(inputs[label])
+            label_image = sitk.GetArrayViewFromImage(inputs[label])
 
             # Overlay this label on the merged array, prioritizing the current label over the existing one
-            merged_array = np.where(label_image > 0, priority, merged_array)
+            merge_label_slab(merged_array, label_image, priority)
+            if overlap:
+                mark_label_slab(membership, label_image, bits[0][label])
 
             # Add segment information to the metadata
             metadata["MergedSegments"].append({
@@ -53,6 +71,192 @@ def merge_label_volumes( inputs: dict, priorities: list) -> tuple:
     merged_image = sitk.GetImageFromArray(merged_array)
     merged_image.CopyInformation(first_image)
 
+    if overlap:
+        overlap_values = {}
+        count_overlap_values(membership, overlap_values)
+        metadata["Overlap"] = overlap_metadata(bits[0], overlap_values)
+
+        overlap_image = sitk.GetImageFromArray(membership)
+        overlap_image.CopyInformation(first_image)
+        return((merged_image, metadata, overlap_image))
+
+    return((merged_image, metadata))
+
+def merge_label_slab( merged: np.ndarray, label_slab: np.ndarray, priority: int ) -> None:
+    """
+    Overlay one label onto a block of the merged array in place.
+
+    Equivalent to merged = np.where(label_slab > 0, priority, merged) but without
+    allocating a new full-size array for every label.
+    """
+    merged[label_slab > 0] = priority
+
+def overlap_bits( labels: list ) -> tuple:
+    """
+    Assign one bit of the overlap bitmask to each label.
+
+    Parameters:
+    labels (list): Labels being merged, in priority order. The first label gets bit 0.
+
+    Returns:
+    tuple: Dictionary of label to bit number and the numpy dtype for the bitmask
+    (uint16 for up to 16 labels, uint32 for up to 32), or None if there are too many labels.
+    """
+    if len(labels) <= 16:
+        dtype = np.uint16
+    elif len(labels) <= 32:
+        dtype = np.uint32
+    else:
+        logging.error(f"overlap_bits: {len(labels)} labels do not fit in a 32 bit overlap mask")
+        return None
+
+    return(({label: bit for bit, label in enumerate(labels)}, dtype))
+
+def mark_label_slab( membership: np.ndarray, label_slab: np.ndarray, bit: int ) -> None:
+    """
+    Set the bit for one label in a block of the overlap bitmask in place.
+    """
+    membership[label_slab > 0] |= membership.dtype.type(1 << bit)
+
+def count_overlap_values( membership: np.ndarray, counts: dict ) -> None:
+    """
+    Add the number of voxels for each bitmask value with more than one bit set to counts.
+
+    Only voxels claimed by several labels are examined, which is usually a tiny fraction
+    of the volume, so this can be called on every slab of a streaming merge.
+    """
+    multi = membership[(membership & (membership - 1)) != 0]
+    values, value_counts = np.unique(multi, return_counts=True)
+    for value, count in zip(values.tolist(), value_counts.tolist()):
+        counts[value] = counts.get(value, 0) + count
+
+def overlap_metadata( bits: dict, counts: dict ) -> dict:
+    """
+    Summarize the overlap bitmask as the "Overlap" entry of the merge metadata.
+
+    Parameters:
+    bits (dict): Dictionary of label to bit number from overlap_bits.
+    counts (dict): Voxel counts per multi-label bitmask value from count_overlap_values.
+
+    Returns:
+    dict: Bit assignment, total number of overlapping voxels and voxel counts for every pair of
+    labels that share at least one voxel.
+    """
+    pairs = []
+    labels = list(bits.keys())
+    for i, label_a in enumerate(labels):
+        for label_b in labels[i+1:]:
+            pair_mask = (1 << bits[label_a]) | (1 << bits[label_b])
+            voxels = sum([ count for value, count in counts.items() if value & pair_mask == pair_mask ])
+            if voxels > 0:
+                pairs.append({
+                    "Labels": [label_a, label_b],
+                    "Voxels": voxels
+                })
+
+    return({
+        "Bits": [ {"OriginalLabel": label, "Bit": bit, "Value": 1 << bit} for label, bit in bits.items() ],
+        "OverlapVoxels": sum(counts.values()),
+        "PairCounts": pairs
+    })
+
+@traced()
+def merge_label_volume_files( inputs: dict, priorities: list, slab_size: int=64, overlap: bool=False ) -> tuple:
+    """
+    Streaming version of merge_label_volumes that reads the inputs from disk in z-slabs.
+
+    Only the image headers are read up front. The merged volume is allocated once and each
+    slab of every input is overlaid onto it in priority order, so peak memory is roughly one
+    output volume plus one slab per input instead of one full volume per input. The result
+    is identical to merge_label_volumes on the same files.
+
+    Formats that ITK can stream (e.g. uncompressed .nii) only read the requested slices.
+    Compressed .nii.gz inputs are re-inflated from the start of the file for each slab, so
+    larger slabs trade memory for less decompression work.
+
+    Parameters:
+    inputs (dict): Dictionary where keys are labels and values are the corresponding image filenames.
+    priorities (list): List of labels in the order of their priority. Higher priority labels appear first.
+    slab_size (int): Number of z slices to read from each input at a time.
+    overlap (bool): Also build the bitmask overlap image, as in merge_label_volumes.
+
+    Returns:
+    tuple: Merged SimpleITK label image and a metadata dictionary (plus the overlap image if requested),
+    or None if the inputs do not share a grid.
+    """
+
+    logging.debug("merge_label_volume_files: start")
+
+    if slab_size < 1:
+        logging.error("merge_label_volume_files: slab size must be positive")
+        return None
+
+    # Read headers only so all inputs can be checked against the first one
+    readers = {}
+    for label, file_path in inputs.items():
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(file_path)
+        reader.ReadImageInformation()
+        readers[label] = reader
+
+    first_reader = next(iter(readers.values()))
+    size = first_reader.GetSize()
+    for label, reader in readers.items():
+        if reader.GetSize() != size:
+            logging.error(f"merge_label_volume_files: size of label {label} {reader.GetSize()} does not match {size}")
+            return None
+
+    merged_array = np.zeros(size[::-1], dtype=np.uint8)
+
+    metadata = {
+        "MergedSegments": []
+    }
+
+    merged_labels = [ (priority, label) for priority, label in enumerate(priorities, start=1) if label in readers ]
+    for priority, label in merged_labels:
+        metadata["MergedSegments"].append({
+            "OriginalLabel": label,
+            "Priority": priority,
+            "RelabeledValue": priority
+        })
+
+    membership = None
+    overlap_values = {}
+    if overlap:
+        bits = overlap_bits([ label for priority, label in merged_labels ])
+        if bits is None:
+            return None
+        membership = np.zeros(size[::-1], dtype=bits[1])
+
+    for z0 in range(0, size[2], slab_size):
+        nz = min(slab_size, size[2]-z0)
+        logging.debug(f"Merging slices {z0} to {z0+nz-1}")
+        merged_slab = merged_array[z0:z0+nz]
+        for priority, label in merged_labels:
+            reader = readers[label]
+            reader.SetExtractIndex([0, 0, z0])
+            reader.SetExtractSize([size[0], size[1], nz])
+            slab_image = reader.Execute()
+            merge_label_slab(merged_slab, sitk.GetArrayViewFromImage(slab_image), priority)
+            if overlap:
+                mark_label_slab(membership[z0:z0+nz], sitk.GetArrayViewFromImage(slab_image), bits[0][label])
+        if overlap:
+            count_overlap_values(membership[z0:z0+nz], overlap_values)
+
+    merged_image = sitk.GetImageFromArray(merged_array)
+    merged_image.SetOrigin(first_reader.GetOrigin())
+    merged_image.SetSpacing(first_reader.GetSpacing())
+    merged_image.SetDirection(first_reader.GetDirection())
+
+    logging.debug("merge_label_volume_files: complete")
+
+    if overlap:
+        metadata["Overlap"] = overlap_metadata(bits[0], overlap_values)
+
+        overlap_image = sitk.GetImageFromArray(membership)
+        overlap_image.CopyInformation(merged_image)
+        return((merged_image, metadata, overlap_image))
+
     return((merged_image, metadata))
 
 def main():
@@ -85,9 +289,17 @@ def main():
     my_parser.add_argument('-i', '--input', type=str, required=True, help="json with files and labels")
     my_parser.add_argument('-p', '--priority', type=str, required=False, help="mapping from priority to label number")
     my_parser.add_argument('-o', '--output', type=str, help="output image filename", required=True) 
+    my_parser.add_argument('-x', '--overlap', type=str, required=False, help="output bitmask image of voxels claimed by each label")
+    my_parser.add_argument('-s', '--slab', type=int, required=False, help="stream inputs in z-slabs of this many slices instead of reading them whole")
+    my_parser.add_argument('-c', '--clean', help="keep only the largest connected component of each merged label", action='store_true', default=False)
+    my_parser.add_argument('--min-volume', type=float, default=0.0, help="with --clean, also keep components of at least this volume in mm^3")
     my_parser.add_argument('--verbose', help="Enable verbose output", action='store_true', default=False)
+    add_io_arguments(my_parser)
+    add_trace_arguments(my_parser)
 
     args = my_parser.parse_args()
+    apply_io_arguments(args)
+    apply_trace_arguments(args)
 
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format="%(asctime)s %(name)s - %(levelname)-6s - %(message)s")
 
@@ -108,20 +320,33 @@ def main():
     priority_labels.sort(key=lambda x: priority_values)
 
 
-    in_images = {}
-    print(in_files)
-    for label, file_path in in_files.items():
-        try:
-            in_images[label] = sitk.ReadImage(file_path)
-        except Exception as e:
-            logging.error(f"Could not read input file: {file_path} due to {e}")
+    if args.slab is not None:
+        out_imgs = merge_label_volume_files(in_files, priority_labels, args.slab, args.overlap is not None)
+        if out_imgs is None:
             exit(1)
+    else:
+        in_images = {}
+        print(in_files)
+        for label, file_path in in_files.items():
+            try:
+                in_images[label] = read_image(file_path)
+            except Exception as e:
+                logging.error(f"Could not read input file: {file_path} due to {e}")
+                exit(1)
 
-    print(in_images)
+        print(in_images)
 
-    out_imgs = merge_label_volumes(in_images, priority_labels)
+        out_imgs = merge_label_volumes(in_images, priority_labels, args.overlap is not None)
+        if out_imgs is None:
+            exit(1)
     print(out_imgs[1])
-    sitk.WriteImage(out_imgs[0], args.output)
+    merged_image = out_imgs[0]
+    if args.clean:
+        from picslpipes.utils.label_cleaning import clean_label_components
+        merged_image = clean_label_components(merged_image, min_volume=args.min_volume)
+    write_image(merged_image, args.output)
+    if args.overlap is not None:
+        write_image(out_imgs[2], args.overlap)
 
 
 
@@ -0,0 +1,230 @@
+import numpy as np
+import SimpleITK as sitk
+from picslpipes.utils.tracing import traced
+
+def texture_offsets():
+    """
+    The 13 unique 3D neighbor directions (one of each +/- pair) as (z,y,x) offsets
+    """
+    offsets = []
+    for dz in [-1, 0, 1]:
+        for dy in [-1, 0, 1]:
+            for dx in [-1, 0, 1]:
+                if (dz, dy, dx) > (0, 0, 0):
+                    offsets.append((dz, dy, dx))
+    return(offsets)
+
+def _shift_slices(offset):
+    """
+    Slices selecting voxels v and v+offset for every v whose neighbor is inside the array
+    """
+    src = []
+    dst = []
+    for d in offset:
+        if d > 0:
+            src.append(slice(0, -d))
+            dst.append(slice(d, None))
+        elif d < 0:
+            src.append(slice(-d, None))
+            dst.append(slice(0, d))
+        else:
+            src.append(slice(None))
+            dst.append(slice(None))
+    return((tuple(src), tuple(dst)))
+
+def digitize(values, bins, hmin, hmax):
+    """
+    Map intensities in [hmin, hmax) to bin indices 0..bins-1, and values outside the range
+    (including hmax itself) to bins, as quantize_image and the ITK texture filters do
+    """
+    width = (hmax - hmin) / float(bins)
+    if width <= 0:
+        width = 1.0
+    q = np.floor((values.astype(np.float64) - hmin) / width)
+    # Rounding can put values just below hmax in bin bins
+    q = np.minimum(q, bins-1).astype(np.int32)
+    q[(values < hmin) | (values >= hmax)] = bins
+    return(q)
+
+def label_cooccurrence_matrices(index, quantized, n_labels, bins):
+    """
+    Symmetric grey level co-occurrence counts for every label, accumulated over all 13 directions.
+
+    Parameters:
+    index (np.ndarray): Dense label index per voxel, 0 for background and 1..n_labels for regions.
+    quantized (np.ndarray): Bin index per voxel, bins for voxels outside the histogram range.
+
+    Returns:
+    np.ndarray: Counts of shape (n_labels+1, bins, bins). Only pairs of voxels in the same region count.
+    """
+    counts = np.zeros((n_labels+1)*bins*bins, dtype=np.int64)
+    for offset in texture_offsets():
+        src, dst = _shift_slices(offset)
+        la = index[src]
+        qa = quantized[src]
+        qb = quantized[dst]
+        valid = (la > 0) & (la == index[dst]) & (qa < bins) & (qb < bins)
+        pairs = (la[valid].astype(np.int64)*bins + qa[valid])*bins + qb[valid]
+        counts += np.bincount(pairs, minlength=counts.size)
+
+    counts = counts.reshape((n_labels+1, bins, bins))
+    return(counts + counts.transpose((0, 2, 1)))
+
+def label_run_length_matrices(index, quantized, n_labels, bins, run_bins):
+    """
+    Grey level run length counts for every label, accumulated over all 13 directions.
+
+    A run is a line of consecutive voxels in one direction with the same label and bin. Runs
+    are followed with flat indices so each step only touches the runs that are still growing.
+
+    Returns:
+    np.ndarray: Counts of shape (n_labels+1, bins, run_bins). Run length is in voxels and runs
+    longer than run_bins are counted in the last bin.
+    """
+    counts = np.zeros((n_labels+1)*bins*run_bins, dtype=np.int64)
+    valid = (index > 0) & (quantized < bins)
+    strides = np.array([index.shape[1]*index.shape[2], index.shape[2], 1])
+    flat_index = index.ravel()
+    flat_quantized = quantized.ravel()
+
+    for offset in texture_offsets():
+        src, dst = _shift_slices(offset)
+
+        # cont[v]: the run through v continues at v+offset
+        cont = np.zeros(index.shape, dtype=bool)
+        cont[src] = valid[src] & valid[dst] & (index[src] == index[dst]) & (quantized[src] == quantized[dst])
+        continued = np.zeros(index.shape, dtype=bool)
+        continued[dst] = cont[src]
+
+        starts = np.flatnonzero(valid & ~continued)
+        lengths = np.ones(len(starts), dtype=np.int64)
+        flat_cont = cont.ravel()
+        step = int(np.dot(strides, offset))
+
+        active = np.arange(len(starts))
+        position = starts
+        while len(active) > 0:
+            grow = flat_cont[position]
+            active = active[grow]
+            position = position[grow] + step
+            lengths[active] += 1
+
+        runs = (flat_index[starts].astype(np.int64)*bins + flat_quantized[starts])*run_bins + np.minimum(lengths, run_bins) - 1
+        counts += np.bincount(runs, minlength=counts.size)
+
+    return(counts.reshape((n_labels+1, bins, run_bins)))
+
+def haralick_features(counts):
+    """
+    Haralick features of one co-occurrence count matrix, with the definitions of ITK's
+    HistogramToTextureFeaturesFilter (and so of the GLCM feature maps):
+
+    - correlation is divided by the square of the grey level variance
+    - entropy leaves out probabilities of 0.0001 or less
+    - haralick_correlation uses the mean and population variance of the marginal sums over
+      the bins, not of the grey levels, and is 0 when the marginal sums are all equal
+    """
+    total = counts.sum()
+    if total == 0:
+        return({})
+    p = counts / total
+    i, j = np.indices(p.shape)
+    px = p.sum(axis=1)
+    levels = np.arange(len(px))
+    mean = np.sum(levels * px)
+    variance = np.sum((levels - mean)**2 * px)
+    variance_squared = variance*variance if variance*variance > 0 else 1.0
+    marginal_mean = np.mean(px)
+    marginal_variance = np.mean((px - marginal_mean)**2)
+    counted = p > 0.0001
+
+    feat = {}
+    feat["energy"] = float(np.sum(p*p))
+    feat["entropy"] = float(-np.sum(p[counted] * np.log2(p[counted])))
+    feat["correlation"] = float(np.sum((i-mean)*(j-mean)*p) / variance_squared)
+    feat["inverse_difference_moment"] = float(np.sum(p / (1.0 + (i-j)**2)))
+    feat["inertia"] = float(np.sum((i-j)**2 * p))
+    feat["cluster_shade"] = float(np.sum(((i-mean) + (j-mean))**3 * p))
+    feat["cluster_prominence"] = float(np.sum(((i-mean) + (j-mean))**4 * p))
+    feat["haralick_correlation"] = float((np.sum(i*j*p) - marginal_mean*marginal_mean) / marginal_variance) if marginal_variance > 0 else 0.0
+    return(feat)
+
+def run_length_features(counts):
+    """
+    Run length features of one run length count matrix (grey levels and run lengths counted from 1)
+    """
+    runs = counts.sum()
+    if runs == 0:
+        return({})
+    i, j = np.indices(counts.shape)
+    i = (i + 1).astype(np.float64)
+    j = (j + 1).astype(np.float64)
+
+    feat = {}
+    feat["short_run_emphasis"] = float(np.sum(counts / j**2) / runs)
+    feat["long_run_emphasis"] = float(np.sum(counts * j**2) / runs)
+    feat["grey_level_nonuniformity"] = float(np.sum(counts.sum(axis=1)**2) / runs)
+    feat["run_length_nonuniformity"] = float(np.sum(counts.sum(axis=0)**2) / runs)
+    feat["low_grey_level_run_emphasis"] = float(np.sum(counts / i**2) / runs)
+    feat["high_grey_level_run_emphasis"] = float(np.sum(counts * i**2) / runs)
+    feat["short_run_low_grey_level_emphasis"] = float(np.sum(counts / (i**2 * j**2)) / runs)
+    feat["short_run_high_grey_level_emphasis"] = float(np.sum(counts * i**2 / j**2) / runs)
+    feat["long_run_low_grey_level_emphasis"] = float(np.sum(counts * j**2 / i**2) / runs)
+    feat["long_run_high_grey_level_emphasis"] = float(np.sum(counts * i**2 * j**2) / runs)
+    return(feat)
+
+@traced()
+def get_region_texture_stats(image, labels, key=None, bins=16, hmin=None, hmax=None, run_bins=32):
+    """
+    Get GLCM and GLRLM features for each label in key from one matrix per region.
+
+    Instead of voxelwise texture maps, one co-occurrence matrix and one run length matrix is
+    built per region over all 13 directions, and Haralick and run length features are computed
+    from those. The result has the same layout as get_simple_itk_stats, with measures "glcm"
+    and "glrlm", so it can go straight to stats_to_csv.
+
+    Intensities are binned over [hmin, hmax), so voxels at hmax are left out as by the ITK
+    filters. hmin defaults to the smallest value in the regions and hmax to just above the
+    largest, so by default every region voxel is binned. Run lengths are counted in voxels
+    rather than physical distance.
+
+    labels may also be a list of (segmentation, key, system name) triples, as for get_simple_itk_stats.
+    """
+
+    if isinstance(labels, (list, tuple)):
+        systems={}
+        for seg, sys_key, sys_name in labels:
+            systems[sys_name] = get_region_texture_stats(image, seg, sys_key, bins, hmin, hmax, run_bins)
+        return(systems)
+
+    values = [ int(v) for v in key ]
+    label_array = sitk.GetArrayViewFromImage(labels)
+    dense = np.zeros(max(int(label_array.max(initial=0)), max(values, default=0)) + 1, dtype=np.int32)
+    dense[values] = np.arange(1, len(values)+1)
+    index = dense[label_array]
+
+    dat={}
+    inside = np.argwhere(index > 0)
+    if len(inside) > 0:
+        # Only the bounding box of the regions is needed
+        box = tuple([ slice(lo, hi+1) for lo, hi in zip(inside.min(axis=0), inside.max(axis=0)) ])
+        index = np.ascontiguousarray(index[box])
+        signal = sitk.GetArrayViewFromImage(image)[box]
+        region_values = signal[index > 0]
+        lo = float(region_values.min()) if hmin is None else hmin
+        hi = float(np.nextafter(float(region_values.max()), np.inf)) if hmax is None else hmax
+        quantized = digitize(signal, bins, lo, hi)
+
+        glcm = label_cooccurrence_matrices(index, quantized, len(values), bins)
+        glrlm = label_run_length_matrices(index, quantized, len(values), bins, run_bins)
+
+    for i, value in enumerate(values, start=1):
+        measure={}
+        if len(inside) > 0:
+            measure['glcm'] = haralick_features(glcm[i])
+            measure['glrlm'] = run_length_features(glrlm[i])
+        else:
+            measure['glcm'] = {}
+            measure['glrlm'] = {}
+        dat[value]=measure
+    return(dat)
@@ -0,0 +1,136 @@
+import argparse
+import os
+import sys
+import logging
+import SimpleITK as sitk
+import numpy as np
+import json
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/utils/relabel_volume.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.utils.io_policy import add_io_arguments, apply_io_arguments, read_image, write_image
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments, traced
+
+def relabel_lookup_tables( tables: dict, max_label: int ) -> np.ndarray:
+    """
+    Build a stacked lookup table for a set of many-to-one label mappings.
+
+    Parameters:
+    tables (dict): Dictionary where keys are output names and values are dictionaries mapping
+                   input label values (int or str) to output label values. Unmapped labels become 0.
+    max_label (int): Largest label value present in the image to be relabeled.
+
+    Returns:
+    np.ndarray: Array of shape (len(tables), size) where row i is the lookup table for the i-th mapping.
+    """
+    size = max_label + 1
+    for mapping in tables.values():
+        for in_label in mapping.keys():
+            size = max(size, int(in_label) + 1)
+
+    max_value = max([ int(v) for mapping in tables.values() for v in mapping.values() ] + [0])
+    dtype = np.uint8 if max_value <= np.iinfo(np.uint8).max else np.uint16
+
+    lut = np.zeros((len(tables), size), dtype=dtype)
+    for i, mapping in enumerate(tables.values()):
+        for in_label, out_label in mapping.items():
+            lut[i, int(in_label)] = int(out_label)
+
+    return(lut)
+
+@traced()
+def relabel_volume( image: sitk.Image, tables: dict ) -> dict:
+    """
+    Apply one or more many-to-one label mappings to a label image in a single pass.
+
+    All lookup tables are stacked so every derived map is produced by one indexing
+    operation over the input voxels.
+
+    Parameters:
+    image (sitk.Image): Integer label image.
+    tables (dict): Dictionary where keys are output names and values are dictionaries mapping
+                   input label values to output label values. Unmapped labels become 0.
+
+    Returns:
+    dict: Dictionary where keys are the output names and values are the relabeled SimpleITK images,
+    or None if the image does not hold non-negative integer labels.
+    """
+
+    logging.debug("relabel_volume: start")
+
+    labels = sitk.GetArrayViewFromImage(image)
+    if not np.issubdtype(labels.dtype, np.integer):
+        logging.error("relabel_volume: input image does not have an integer pixel type")
+        return None
+
+    if labels.min() < 0:
+        logging.error("relabel_volume: input image has negative labels")
+        return None
+
+    lut = relabel_lookup_tables(tables, int(labels.max()))
+    relabeled = lut[:, labels]
+
+    out_images = {}
+    for i, name in enumerate(tables.keys()):
+        out_image = sitk.GetImageFromArray(relabeled[i])
+        out_image.CopyInformation(image)
+        out_images[name] = out_image
+
+    logging.debug("relabel_volume: complete")
+
+    return(out_images)
+
+def main():
+    my_parser = argparse.ArgumentParser(description='Derive relabeled maps from a label image')
+    my_parser.add_argument('-i', '--input', type=str, required=True, help="input label image")
+    my_parser.add_argument('-m', '--mapping', type=str, required=True, help="json with output names and label mappings")
+    my_parser.add_argument('-o', '--output', type=str, required=True, help="output prefix, each map is written to PREFIX_NAME.nii.gz")
+    my_parser.add_argument('-n', '--names', type=str, nargs='+', required=False, help="only write these maps from the mapping file")
+    my_parser.add_argument('-c', '--clean', type=str, nargs='+', required=False, help="keep only the largest connected component of each label in these maps")
+    my_parser.add_argument('--min-volume', type=float, default=0.0, help="with --clean, also keep components of at least this volume in mm^3")
+    my_parser.add_argument('--verbose', help="Enable verbose output", action='store_true', default=False)
+    add_io_arguments(my_parser)
+    add_trace_arguments(my_parser)
+    args = my_parser.parse_args()
+    apply_io_arguments(args)
+    apply_trace_arguments(args)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format="%(asctime)s %(name)s - %(levelname)-6s - %(message)s")
+
+    with open(args.mapping, 'r') as f:
+        tables = json.load(f)
+        f.close()
+
+    if args.names is not None:
+        missing = [ n for n in args.names if n not in tables ]
+        if len(missing) > 0:
+            logging.error("Maps not found in mapping file: "+str(missing))
+            exit(1)
+        tables = { n: tables[n] for n in args.names }
+
+    try:
+        labels = read_image(args.input)
+    except Exception as e:
+        logging.error(f"Could not read input file: {args.input} due to {e}")
+        exit(1)
+
+    out_images = relabel_volume(labels, tables)
+    if out_images is None:
+        exit(1)
+
+    if args.clean is not None:
+        from picslpipes.utils.label_cleaning import clean_label_components
+        missing = [ n for n in args.clean if n not in out_images ]
+        if len(missing) > 0:
+            logging.error("Maps to clean not found: "+str(missing))
+            exit(1)
+        for name in args.clean:
+            out_images[name] = clean_label_components(out_images[name], min_volume=args.min_volume)
+
+    for name, out_image in out_images.items():
+        out_file = args.output+'_'+name+'.nii.gz'
+        logging.debug("Writing "+out_file)
+        write_image(out_image, out_file)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,267 @@
+import argparse
+import os
+import re
+import sys
+import json
+import sqlite3
+import logging
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/utils/segment_index.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments, traced
+
+# Persistent index of the segmentations in a dataset laid out as ROOT/SUBJECT/SESSION/files.
+#
+# One scan of the dataset root records, for every session, the segment descriptions and
+# label IDs from the *seg-meta.json files (and optionally the DICOM SEG headers) and the
+# per-segment *_seg-N.nii.gz files. The scan is incremental: files whose size and mtime are
+# unchanged since the last refresh are not parsed again, and deleted files are dropped.
+# Lookups are single indexed queries, so dicom_seg_meta and dicom_seg_files can answer
+# without listing directories or parsing JSON. A lookup only trusts a file whose size and
+# mtime still match the index; anything changed since the last refresh is read from disk.
+
+SEG_FILE_PATTERN = re.compile(r'_seg-(\d+)\.nii(\.gz)?$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, subject TEXT, session TEXT, kind TEXT, size INTEGER, mtime_ns INTEGER);
+CREATE TABLE IF NOT EXISTS segments (source TEXT, subject TEXT, session TEXT, description TEXT, label_id INTEGER);
+CREATE TABLE IF NOT EXISTS seg_files (path TEXT PRIMARY KEY, directory TEXT, subject TEXT, session TEXT, label_id INTEGER);
+CREATE INDEX IF NOT EXISTS segments_source ON segments (source);
+CREATE INDEX IF NOT EXISTS segments_session ON segments (subject, session, description);
+CREATE INDEX IF NOT EXISTS seg_files_directory ON seg_files (directory, label_id);
+CREATE INDEX IF NOT EXISTS seg_files_session ON seg_files (subject, session, label_id);
+"""
+
+def source_kind( name: str, dicom: bool=False ) -> str:
+    """
+    Kind of file for the index: "meta", "seg", "dcm" or None for files that are not indexed
+    """
+    if name.endswith('seg-meta.json'):
+        return("meta")
+    if SEG_FILE_PATTERN.search(name) is not None:
+        return("seg")
+    if dicom and name.endswith('.dcm'):
+        return("dcm")
+    return(None)
+
+def scan_directory( directory: str, dicom: bool=False ) -> list:
+    """
+    Stat the indexable files below one directory.
+
+    Returns:
+    list: (path, kind, size, mtime_ns) for every indexable file.
+    """
+    found = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            kind = source_kind(name, dicom)
+            if kind is None:
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            found.append((path, kind, st.st_size, st.st_mtime_ns))
+    return(found)
+
+def parse_source( path: str, kind: str ) -> list:
+    """
+    Segments described by one file.
+
+    Returns:
+    list: (description, label ID) pairs. Empty for per-segment images and for .dcm files that
+    are not segmentations, None if the file could not be parsed.
+    """
+    if kind == "meta":
+        try:
+            with open(path, 'r') as f:
+                meta = json.load(f)
+            return([ (attr["SegmentDescription"], int(attr["labelID"])) for segment in meta["segmentAttributes"] for attr in segment ])
+        except Exception as e:
+            logging.warning("parse_source: could not read "+path+" "+str(e))
+            return(None)
+
+    if kind == "dcm":
+        import pydicom
+        try:
+            ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=["Modality", "SegmentSequence"])
+        except Exception as e:
+            logging.warning("parse_source: could not read "+path+" "+str(e))
+            return(None)
+        if ds.get("Modality") != "SEG" or "SegmentSequence" not in ds:
+            return([])
+        return([ (str(item.get("SegmentDescription", item.get("SegmentLabel", ""))), int(item.SegmentNumber)) for item in ds.SegmentSequence ])
+
+    return([])
+
+def is_current( path: str, size: int, mtime_ns: int ) -> bool:
+    """
+    True if path still has the size and mtime it was indexed with
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return(False)
+    return(st.st_size == size and st.st_mtime_ns == mtime_ns)
+
+def session_of( path: str ) -> tuple:
+    """
+    (subject, session) from the ROOT/SUBJECT/SESSION/file layout
+    """
+    session_dir = os.path.dirname(path)
+    return((os.path.basename(os.path.dirname(session_dir)), os.path.basename(session_dir)))
+
+class SegmentIndex:
+    """
+    SQLite index of segment descriptions, label IDs and per-segment files.
+
+    Parameters:
+    db_path (str): Index database file, created if it does not exist.
+    read_only (bool): Open an existing database for lookups only. Raises sqlite3.OperationalError
+    if db_path does not exist, instead of creating an empty index.
+    """
+    def __init__(self, db_path: str, read_only: bool=False):
+        self.db_path = db_path
+        if read_only:
+            self.db = sqlite3.connect("file:"+quote(os.path.abspath(db_path))+"?mode=ro", uri=True)
+        else:
+            self.db = sqlite3.connect(db_path)
+            self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    @traced()
+    def refresh(self, root: str, jobs: int=8, dicom: bool=False) -> dict:
+        """
+        Bring the index up to date with the files below root.
+
+        Subject directories are scanned in parallel and only new or changed files are parsed.
+
+        Parameters:
+        root (str): Dataset root with SUBJECT/SESSION directories.
+        jobs (int): Number of threads scanning and parsing.
+        dicom (bool): Also index the segments of DICOM SEG (.dcm) files.
+
+        Returns:
+        dict: Number of "added", "updated", "removed" and "unchanged" files.
+        """
+        root = os.path.abspath(root)
+        subdirs = [ e.path for e in os.scandir(root) if e.is_dir() ]
+        with ThreadPoolExecutor(jobs) as pool:
+            found = [ f for files in pool.map(lambda d: scan_directory(d, dicom), subdirs) for f in files ]
+
+        prefix = root+os.sep
+        known = { path: (size, mtime_ns) for path, size, mtime_ns in
+                  self.db.execute("SELECT path, size, mtime_ns FROM sources WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)) }
+
+        counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        changed = []
+        for path, kind, size, mtime_ns in found:
+            stamp = known.pop(path, None)
+            if stamp == (size, mtime_ns):
+                counts["unchanged"] += 1
+                continue
+            counts["added" if stamp is None else "updated"] += 1
+            changed.append((path, kind, size, mtime_ns))
+
+        with ThreadPoolExecutor(jobs) as pool:
+            parsed = list(pool.map(lambda f: parse_source(f[0], f[1]), changed))
+
+        with self.db:
+            for path in known.keys():
+                self._remove(path)
+                counts["removed"] += 1
+            for (path, kind, size, mtime_ns), segments in zip(changed, parsed):
+                self._remove(path)
+                if segments is None:
+                    # Unreadable, retried on the next refresh
+                    continue
+                subject, session = session_of(path)
+                self.db.execute("INSERT INTO sources VALUES (?, ?, ?, ?, ?, ?)", (path, subject, session, kind, size, mtime_ns))
+                self.db.executemany("INSERT INTO segments VALUES (?, ?, ?, ?, ?)",
+                                    [ (path, subject, session, description, label_id) for description, label_id in segments ])
+                if kind == "seg":
+                    label_id = int(SEG_FILE_PATTERN.search(path).group(1))
+                    self.db.execute("INSERT INTO seg_files VALUES (?, ?, ?, ?, ?)", (path, os.path.dirname(path), subject, session, label_id))
+
+        logging.debug("SegmentIndex.refresh: "+str(counts))
+        return(counts)
+
+    def _remove(self, path: str):
+        self.db.execute("DELETE FROM sources WHERE path = ?", (path,))
+        self.db.execute("DELETE FROM segments WHERE source = ?", (path,))
+        self.db.execute("DELETE FROM seg_files WHERE path = ?", (path,))
+
+    def has_source(self, path: str) -> bool:
+        """
+        True if path is indexed and its size and mtime have not changed since
+        """
+        row = self.db.execute("SELECT size, mtime_ns FROM sources WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return(row is not None and is_current(path, row[0], row[1]))
+
+    def label_ids(self, structure_names: list, source: str=None, subject: str=None, session: str=None) -> dict:
+        """
+        Label ID of each structure, from one indexed source file or from everything indexed for a session.
+
+        Returns:
+        dict: Structure name to label ID, or None if the structure is not present.
+        """
+        if source is not None:
+            rows = self.db.execute("SELECT description, label_id FROM segments WHERE source = ?", (os.path.abspath(source),))
+        else:
+            rows = self.db.execute("SELECT description, label_id FROM segments WHERE subject = ? AND session = ?", (subject, session))
+        found = dict(rows.fetchall())
+        return({ structure: found.get(structure) for structure in structure_names })
+
+    def seg_files(self, labels: list, directory: str=None, subject: str=None, session: str=None) -> dict:
+        """
+        Per-segment image of each label ID, from one directory or from a session.
+
+        Returns:
+        dict: Label ID to file path, for the labels that have a file that is unchanged since it was indexed.
+        """
+        query = "SELECT f.label_id, f.path, s.size, s.mtime_ns FROM seg_files f JOIN sources s ON s.path = f.path WHERE "
+        if directory is not None:
+            rows = self.db.execute(query+"f.directory = ?", (os.path.abspath(directory),))
+        else:
+            rows = self.db.execute(query+"f.subject = ? AND f.session = ?", (subject, session))
+        found = { label_id: path for label_id, path, size, mtime_ns in rows.fetchall() if is_current(path, size, mtime_ns) }
+        return({ label: found[int(label)] for label in labels if int(label) in found })
+
+    def sessions(self) -> list:
+        return([ tuple(r) for r in self.db.execute("SELECT DISTINCT subject, session FROM sources ORDER BY subject, session") ])
+
+def main():
+    my_parser = argparse.ArgumentParser(description='Build or refresh the segment index of a dataset')
+    my_parser.add_argument('-r', '--root', type=str, required=False, help="dataset root with SUBJECT/SESSION directories to scan")
+    my_parser.add_argument('-d', '--database', type=str, required=True, help="index database file")
+    my_parser.add_argument('-j', '--jobs', type=int, default=8, help="threads scanning and parsing")
+    my_parser.add_argument('--dicom', help="also index DICOM SEG (.dcm) headers", action='store_true', default=False)
+    my_parser.add_argument('-s', '--structures', type=str, nargs='+', required=False, help="print the label IDs of these structures for every session")
+    my_parser.add_argument('-v', '--verbose', help="verbose output", action='store_true', default=False)
+    add_trace_arguments(my_parser)
+    args = my_parser.parse_args()
+    apply_trace_arguments(args)
+
+    log_level=logging.WARNING
+    if args.verbose:
+        log_level=logging.DEBUG
+    logging.basicConfig(level=log_level, format="%(asctime)s %(name)s - %(levelname)-6s - %(message)s")
+
+    index = SegmentIndex(args.database)
+    if args.root is not None:
+        counts = index.refresh(args.root, args.jobs, args.dicom)
+        print(", ".join([ k+": "+str(v) for k, v in counts.items() ]))
+
+    if args.structures is not None:
+        for subject, session in index.sessions():
+            labels = index.label_ids(args.structures, subject=subject, session=session)
+            print(subject+','+session+','+','.join([ str(labels[s]) for s in args.structures ]))
+    index.close()
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+import argparse
+import os
+import sys
+import logging
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+if __package__ in (None, ""):
+    # Run by path from a checkout (python src/picslpipes/utils/stats_store.py): make picslpipes importable
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments, traced
+
+# Long format region stats in a Parquet dataset partitioned by subject, session, system and
+# calculator (hive layout: ROOT/subject=S/session=T/system=N/calculator=C/part-0.parquet). Each
+# write replaces the partitions it touches, so rerunning a subject overwrites its rows instead of
+# duplicating them, stats of the same system from another calculator are kept, and different
+# subjects can be written concurrently. Cohort queries scan the dataset once,
+# reading only the partitions and columns they need.
+
+STATS_SCHEMA = pa.schema([
+    ("subject", pa.string()),
+    ("session", pa.string()),
+    ("label", pa.int32()),
+    ("name", pa.string()),
+    ("system", pa.string()),
+    ("measure", pa.string()),
+    ("metric", pa.string()),
+    ("value", pa.float64()),
+    ("calculator", pa.string())
+])
+
+PARTITION_COLUMNS = ["subject", "session", "system", "calculator"]
+
+# Columns of the per-subject csv files written by image_region_stats.py
+CSV_COLUMNS = ["subject", "session", "label", "name", "system", "measure", "metric", "value"]
+
+def _partitioning():
+    return(ds.partitioning(pa.schema([ STATS_SCHEMA.field(c) for c in PARTITION_COLUMNS ]), flavor="hive"))
+
+def stats_to_table(stats, key, sys_name, calc, subject, session) -> pa.Table:
+    """
+    Long format table of the stats of one labeling system, as get_simple_itk_stats,
+    get_numpy_stats or get_region_texture_stats return them.
+
+    Same rows as stats_to_csv, built column by column with the types of STATS_SCHEMA.
+    """
+    labels = []
+    measures = []
+    metrics = []
+    values = []
+    for label, istats in stats.items():
+        for measure, mstats in istats.items():
+            n = len(mstats)
+            labels.extend([label]*n)
+            measures.extend([measure]*n)
+            metrics.extend(mstats.keys())
+            values.extend(mstats.values())
+
+    n = len(values)
+    names = [ key[label] for label in labels ]
+    columns = [
+        pa.array([subject]*n, pa.string()),
+        pa.array([session]*n, pa.string()),
+        pa.array(labels, pa.int32()),
+        pa.array(names, pa.string()),
+        pa.array([sys_name]*n, pa.string()),
+        pa.array(measures, pa.string()),
+        pa.array(metrics, pa.string()),
+        pa.array(values, pa.float64()),
+        pa.array([calc]*n, pa.string())
+    ]
+    return(pa.Table.from_arrays(columns, schema=STATS_SCHEMA))
+
+def write_csv(table: pa.Table, filename: str):
+    """
+    Write a stats table in the csv layout of image_region_stats.py (with a leading row number)
+    """
+    table = table.select(CSV_COLUMNS)
+    table = table.add_column(0, "", pa.array(range(table.num_rows), pa.int64()))
+    import pyarrow.csv as pcsv
+    pcsv.write_csv(table, filename, pcsv.WriteOptions(quoting_style="needed"))
+
+@traced()
+def append_stats(root: str, table: pa.Table):
+    """
+    Write a stats table to the dataset at root, replacing the subject/session/system/calculator
+    partitions it contains
+    """
+    ds.write_dataset(table.cast(STATS_SCHEMA), root, format="parquet", partitioning=_partitioning(),
+                     existing_data_behavior="delete_matching", basename_template="part-{i}.parquet")
+
+@traced()
+def query_stats(root: str, columns: list=None, **filters) -> pa.Table:
+    """
+    Read the rows of the dataset at root that match the filters in one scan.
+
+    Parameters:
+    root (str): Dataset written by append_stats.
+    columns (list): Columns to read, default all.
+    filters: Column name to a value or a list of values, e.g. system="manual-lobes",
+    metric=["mean", "median"]. Filters on subject, session, system and calculator skip whole partitions.
+
+    Returns:
+    pa.Table: Matching rows.
+    """
+    dataset = ds.dataset(root, format="parquet", partitioning=_partitioning())
+    expression = None
+    for column, value in filters.items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            condition = pc.field(column).isin(list(value))
+        else:
+            condition = pc.field(column) == value
+        expression = condition if expression is None else expression & condition
+    return(dataset.to_table(columns=columns, filter=expression))
+
+def read_stats_csv(filename: str, calc: str) -> pa.Table:
+    """
+    Read a csv written by image_region_stats.py as a stats table
+    """
+    import pyarrow.csv as pcsv
+    convert = pcsv.ConvertOptions(column_types={ f.name: f.type for f in STATS_SCHEMA if f.name in CSV_COLUMNS },
+                                  include_columns=CSV_COLUMNS)
+    table = pcsv.read_csv(filename, convert_options=convert)
+    return(table.append_column("calculator", pa.array([calc]*table.num_rows, pa.string())))
+
+def main():
+    parser = argparse.ArgumentParser(description='Load region stats csv files into the stats store or query it')
+    parser.add_argument('-d', '--store', help='Stats dataset directory', type=str, required=True)
+    parser.add_argument('-i', '--input', help='image_region_stats.py csv files to add', type=str, nargs='*', default=[])
+    parser.add_argument('-c', '--calculator', help='calculator that produced the csv files', type=str, default="simpleitk")
+    parser.add_argument('-a', '--subject', help='only query these subjects', type=str, nargs='+')
+    parser.add_argument('-b', '--session', help='only query these sessions', type=str, nargs='+')
+    parser.add_argument('-n', '--system', help='only query these labeling systems', type=str, nargs='+')
+    parser.add_argument('-m', '--measure', help='only query these measures', type=str, nargs='+')
+    parser.add_argument('-t', '--metric', help='only query these metrics', type=str, nargs='+')
+    parser.add_argument('-o', '--output', help='Write the query result to this csv', type=str)
+    parser.add_argument('-v', '--verbose', help="verbose output", action='store_true', default=False)
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+    apply_trace_arguments(args)
+
+    log_level=logging.WARNING
+    if args.verbose:
+        log_level=logging.DEBUG
+    logging.basicConfig(level=log_level, format="%(asctime)s %(name)s - %(levelname)-6s - %(message)s")
+
+    for filename in args.input:
+        logging.debug("Adding "+filename)
+        append_stats(args.store, read_stats_csv(filename, args.calculator))
+
+    if args.output is not None:
+        table = query_stats(args.store, subject=args.subject, session=args.session, system=args.system,
+                            measure=args.measure, metric=args.metric)
+        write_csv(table, args.output)
+        print("rows: "+str(table.num_rows))
+
+if __name__ == "__main__":
+    sys.exit(main())
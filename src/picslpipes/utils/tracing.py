@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import argparse
+import threading
+import functools
+
+# Per-stage timing and memory records for the picslpipes tools.
+#
+# When PICSLPIPES_TRACE names a file, every traced stage appends one JSON line to it with its wall
+# and CPU time, the process peak RSS and the bytes read and written while it ran. Processes append
+# to the same file, so a driver script or pipeline run collects one trace for all of its tools. The
+# process that turned tracing on with --trace writes the Chrome trace (FILE.trace.json, open in
+# chrome://tracing or ui.perfetto.dev) once at exit; when only the variable is set, tracing.py -i
+# writes it afterwards.
+#
+# The byte counts come from /proc/self/io, which counts the whole process: a stage that runs while
+# other threads of the same process do I/O (worker pools, the scheduler heartbeat) is charged
+# for their reads and writes too. They are exact for stages that run alone in their process.
+#
+# When the variable is not set, stage() and traced functions only check one global.
+
+ENV_TRACE = "PICSLPIPES_TRACE"
+
+_trace_file = None
+_checked = False
+_registered = False
+_local = threading.local()
+_lock = threading.Lock()
+
+def trace_file() -> str:
+    """
+    File the records go to, or None when tracing is off
+    """
+    global _trace_file, _checked
+    if not _checked:
+        _trace_file = os.environ.get(ENV_TRACE) or None
+        _checked = True
+    return(_trace_file)
+
+def chrome_trace_path( filename: str ) -> str:
+    base = filename[:-len('.jsonl')] if filename.endswith('.jsonl') else filename
+    return(base+'.trace.json')
+
+def add_trace_arguments(parser):
+    parser.add_argument('--trace', help='Append per-stage timing and memory records to this JSON-lines file (env '+ENV_TRACE+')', type=str)
+
+def apply_trace_arguments(args):
+    """
+    Turn tracing on for this process and its children if --trace was given. This process then
+    writes the Chrome trace of the whole run at exit, after its children have finished.
+    """
+    global _checked, _registered
+    if args.trace is not None:
+        os.environ[ENV_TRACE] = os.path.abspath(args.trace)
+        _checked = False
+        if not _registered:
+            atexit.register(_write_chrome_trace)
+            _registered = True
+    return(trace_file())
+
+def _io_counters() -> dict:
+    # Linux only: rchar/wchar count all read/write calls, read_bytes/write_bytes what reached storage,
+    # both for all threads of the process
+    counters = {}
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return(counters)
+
+def _usage() -> tuple:
+    import resource
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return((own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime, own.ru_maxrss * scale))
+
+class _Stage:
+    """
+    Context manager that measures one stage and appends its record to the trace file
+    """
+    def __init__(self, name: str, args: dict):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.depth = getattr(_local, 'depth', 0)
+        _local.depth = self.depth + 1
+        self.io = _io_counters()
+        self.cpu, self.child_cpu, self.rss = _usage()
+        self.start = time.time()
+        self.wall = time.perf_counter()
+        return(self)
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall
+        cpu, child_cpu, rss = _usage()
+        io = _io_counters()
+        _local.depth = self.depth
+
+        record = {
+            "name": self.name, "pid": os.getpid(), "tid": threading.get_ident(), "depth": self.depth,
+            "start": self.start, "wall": wall, "cpu": cpu - self.cpu, "child_cpu": child_cpu - self.child_cpu,
+            "peak_rss": rss, "rss_growth": rss - self.rss,
+            "read_bytes": io.get("rchar", 0) - self.io.get("rchar", 0),
+            "write_bytes": io.get("wchar", 0) - self.io.get("wchar", 0),
+            "disk_read_bytes": io.get("read_bytes", 0) - self.io.get("read_bytes", 0),
+            "disk_write_bytes": io.get("write_bytes", 0) - self.io.get("write_bytes", 0),
+            "error": None if exc_type is None else exc_type.__name__,
+            "args": self.args
+        }
+        line = json.dumps(record, default=str)+"\n"
+        with _lock:
+            # One write per record with O_APPEND, so lines from concurrent processes do not interleave
+            fd = os.open(_trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+        logging.debug(f"trace: {self.name} {wall:.3f}s wall {record['cpu']:.3f}s cpu {rss/2**20:.0f}MB peak")
+        return(False)
+
+class _NullStage:
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc, tb):
+        return(False)
+
+_NULL_STAGE = _NullStage()
+
+def stage( name: str, **args ):
+    """
+    Context manager recording the enclosed block as one stage, e.g.
+
+        with stage("gzip", file=filename):
+            ...
+
+    args are stored with the record and must be JSON serializable (others are stored as strings).
+    Does nothing when tracing is off.
+    """
+    if _trace_file is None and (_checked or trace_file() is None):
+        return(_NULL_STAGE)
+    return(_Stage(name, args))
+
+def traced( name: str=None ):
+    """
+    Decorator recording every call of a function as a stage named name (default module.function)
+    """
+    def decorate(func):
+        # Module name from the file, so functions of a module run as a script are not named __main__
+        module = os.path.splitext(os.path.basename(func.__code__.co_filename))[0]
+        stage_name = name if name is not None else module+'.'+func.__qualname__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _trace_file is None and (_checked or trace_file() is None):
+                return(func(*args, **kwargs))
+            with _Stage(stage_name, {}):
+                return(func(*args, **kwargs))
+        return(wrapper)
+    return(decorate)
+
+def read_trace( filename: str ) -> list:
+    """
+    Records of a trace file, skipping a partially written last line
+    """
+    records = []
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return(records)
+
+def chrome_trace( records: list ) -> dict:
+    """
+    Chrome trace event format of trace records: one complete ("X") event per stage, with the
+    measurements as its arguments
+    """
+    events = []
+    for r in records:
+        measures = { k: r[k] for k in ["cpu", "child_cpu", "peak_rss", "rss_growth", "read_bytes", "write_bytes",
+                                       "disk_read_bytes", "disk_write_bytes", "error"] if k in r }
+        measures.update(r.get("args", {}))
+        events.append({"name": r["name"], "cat": "picslpipes", "ph": "X", "ts": r["start"]*1e6, "dur": r["wall"]*1e6,
+                       "pid": r["pid"], "tid": r["tid"], "args": measures})
+    return({"traceEvents": events, "displayTimeUnit": "ms"})
+
+def _write_chrome_trace():
+    if not os.path.exists(_trace_file):
+        return
+    try:
+        out_file = chrome_trace_path(_trace_file)
+        tmp = out_file+'.tmp.'+str(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(chrome_trace(read_trace(_trace_file)), f)
+        os.replace(tmp, out_file)
+    except OSError as e:
+        logging.warning("tracing: could not write the Chrome trace: "+str(e))
+
+def summarize( records: list ) -> list:
+    """
+    Total wall time, CPU time, largest peak RSS and bytes read and written per stage name,
+    longest first
+    """
+    totals = {}
+    for r in records:
+        t = totals.setdefault(r["name"], {"name": r["name"], "calls": 0, "wall": 0.0, "cpu": 0.0, "child_cpu": 0.0,
+                                          "peak_rss": 0, "read_bytes": 0, "write_bytes": 0})
+        t["calls"] += 1
+        for k in ["wall", "cpu", "child_cpu", "read_bytes", "write_bytes"]:
+            t[k] += r.get(k, 0)
+        t["peak_rss"] = max(t["peak_rss"], r.get("peak_rss", 0))
+    return(sorted(totals.values(), key=lambda t: -t["wall"]))
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize a trace file and write its Chrome trace')
+    parser.add_argument('-i', '--input', help='JSON-lines trace file', type=str, required=True)
+    parser.add_argument('-o', '--output', help='Chrome trace file (default: INPUT.trace.json)', type=str)
+    args = parser.parse_args()
+
+    records = read_trace(args.input)
+    out_file = args.output if args.output is not None else chrome_trace_path(args.input)
+    with open(out_file, 'w') as f:
+        json.dump(chrome_trace(records), f)
+
+    print("stage,calls,wall,cpu,child_cpu,peak_rss_mb,read_mb,write_mb")
+    for t in summarize(records):
+        print(f"{t['name']},{t['calls']},{t['wall']:.3f},{t['cpu']:.3f},{t['child_cpu']:.3f},"
+              f"{t['peak_rss']/2**20:.1f},{t['read_bytes']/2**20:.1f},{t['write_bytes']/2**20:.1f}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Run the tests against the source tree without installing the package
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC)
@@ -0,0 +1,93 @@
+import os
+import json
+import pytest
+from picslpipes.pipeline.dag import Stage, Pipeline
+
+def upper(text: str, shouted: str, suffix: str=""):
+    with open(text) as f, open(shouted, 'w') as out:
+        out.write(f.read().upper()+suffix)
+
+def count(shouted: str, counted: str):
+    with open(shouted) as f, open(counted, 'w') as out:
+        out.write(str(len(f.read())))
+
+def list_files(directory: str, listing: str):
+    with open(listing, 'w') as out:
+        json.dump(sorted([ os.path.join(directory, name) for name in os.listdir(directory) ]), out)
+
+def concatenate(listing: str, joined: str):
+    with open(listing) as f, open(joined, 'w') as out:
+        for path in json.load(f):
+            with open(path) as part:
+                out.write(part.read())
+
+def read(path: str) -> str:
+    with open(path) as f:
+        return(f.read())
+
+def write(path: str, text: str):
+    # New mtime for every write, so the memoized hashes see the change
+    with open(path, 'w') as f:
+        f.write(text)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+def chain(tmp_path, suffix: str="") -> Pipeline:
+    p = Pipeline(str(tmp_path / "cache"))
+    p.add(Stage("upper", upper, {"text": str(tmp_path / "in.txt")}, {"shouted": str(tmp_path / "upper.txt")}, {"suffix": suffix}))
+    p.add(Stage("count", count, {"shouted": str(tmp_path / "upper.txt")}, {"counted": str(tmp_path / "count.txt")}))
+    return(p)
+
+def test_unchanged_stages_are_cached(tmp_path):
+    write(str(tmp_path / "in.txt"), "abc")
+    assert chain(tmp_path).run() == {"upper": "ran", "count": "ran"}
+    assert chain(tmp_path).run() == {"upper": "cached", "count": "cached"}
+    assert chain(tmp_path, "!").run() == {"upper": "ran", "count": "ran"}
+    assert read(str(tmp_path / "count.txt")) == "4"
+
+def test_same_output_does_not_rerun_downstream(tmp_path):
+    write(str(tmp_path / "in.txt"), "abc")
+    chain(tmp_path).run()
+    write(str(tmp_path / "in.txt"), "ABC")
+    assert chain(tmp_path).run() == {"upper": "ran", "count": "cached"}
+
+def test_outputs_are_restored_from_linked_objects(tmp_path):
+    write(str(tmp_path / "in.txt"), "abc")
+    chain(tmp_path).run()
+    write(str(tmp_path / "in.txt"), "xyz")
+    chain(tmp_path).run()
+    # Back to the first input: restored, and rerunning for "xyz" did not change the cached "ABC"
+    write(str(tmp_path / "in.txt"), "abc")
+    assert chain(tmp_path).run() == {"upper": "cached", "count": "cached"}
+    assert read(str(tmp_path / "upper.txt")) == "ABC"
+    assert os.stat(str(tmp_path / "upper.txt")).st_nlink == 2
+
+    os.remove(str(tmp_path / "count.txt"))
+    assert chain(tmp_path).run(["count"]) == {"upper": "cached", "count": "cached"}
+    assert read(str(tmp_path / "count.txt")) == "3"
+
+def test_inputs_hashed_by_names_and_listed_files(tmp_path):
+    parts = tmp_path / "parts"
+    parts.mkdir()
+    write(str(parts / "a.txt"), "a")
+    write(str(parts / "b.txt"), "b")
+    def pipeline():
+        p = Pipeline(str(tmp_path / "cache"))
+        p.add(Stage("list", list_files, {"directory": str(parts)}, {"listing": str(tmp_path / "listing.json")}, hash_as={"directory": "names"}))
+        p.add(Stage("join", concatenate, {"listing": str(tmp_path / "listing.json")}, {"joined": str(tmp_path / "joined.txt")}, hash_as={"listing": "listed"}))
+        return(p)
+
+    assert pipeline().run() == {"list": "ran", "join": "ran"}
+    # A listed file changed: the listing stage only looks at names, the join reads the file
+    write(str(parts / "b.txt"), "B")
+    assert pipeline().run() == {"list": "cached", "join": "ran"}
+    assert read(str(tmp_path / "joined.txt")) == "aB"
+    write(str(parts / "c.txt"), "c")
+    assert pipeline().run() == {"list": "ran", "join": "ran"}
+
+def test_order_and_cycles(tmp_path):
+    p = chain(tmp_path)
+    assert p.order(["count"]) == ["upper", "count"]
+    p.add(Stage("back", upper, {"text": str(tmp_path / "count.txt")}, {"shouted": str(tmp_path / "in.txt")}))
+    with pytest.raises(ValueError):
+        p.order()
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from picslpipes.utils.dicom_seg_decode import decode_dicom_seg
+
+SPACING = (0.5, 0.75, 2.0)
+ORIGIN = (-10.0, 20.0, 5.0)
+SEGMENTS = {1: "Lung-Left", 2: "Lung-Right", 3: "GTV-1"}
+
+def item(**attributes) -> Dataset:
+    ds = Dataset()
+    for name, value in attributes.items():
+        setattr(ds, name, value)
+    return(ds)
+
+def frame_layout(mask: np.ndarray, k: int, layout: str) -> tuple:
+    """
+    Pixels of slice k of a [z,y,x] mask as a frame with the given in-plane layout, with the
+    frame orientation and the grid index of its first pixel
+    """
+    nx = mask.shape[2]
+    if layout == "rows_along_y":
+        return(mask[k], (1, 0, 0, 0, 1, 0), (0, 0, k))
+    if layout == "rows_along_x":
+        return(mask[k].T, (0, 1, 0, 1, 0, 0), (0, 0, k))
+    if layout == "flipped_x":
+        return(mask[k][:, ::-1], (-1, 0, 0, 0, 1, 0), (nx-1, 0, k))
+    raise ValueError(layout)
+
+def write_seg(filename: str, masks: dict, layout: str="rows_along_y", fractional: bool=False, shift: float=0.0):
+    """
+    DICOM SEG with one frame per slice and segment of the [z,y,x] masks, on the grid of SPACING and ORIGIN
+    """
+    frames = []
+    per_frame = []
+    for segment, mask in masks.items():
+        for k in range(mask.shape[0]):
+            pixels, orientation, index = frame_layout(mask, k, layout)
+            frames.append(pixels)
+            position = [ o + i*s for o, i, s in zip(ORIGIN, index, SPACING) ]
+            position[0] += shift
+            per_frame.append(item(SegmentIdentificationSequence=[item(ReferencedSegmentNumber=segment)],
+                                  PlanePositionSequence=[item(ImagePositionPatient=position)]))
+    rows, cols = frames[0].shape
+    # PixelSpacing is (between rows, between columns)
+    col_spacing, row_spacing = [ SPACING[[abs(v) for v in orientation[a:a+3]].index(1)] for a in (0, 3) ]
+
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.SOPClassUID = "1.2.840.10008.5.1.4.1.1.66.4"
+    ds.SOPInstanceUID = generate_uid()
+    ds.Modality = "SEG"
+    ds.Rows = rows
+    ds.Columns = cols
+    ds.NumberOfFrames = len(frames)
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.SegmentSequence = [ item(SegmentNumber=number, SegmentLabel=label, SegmentDescription=label) for number, label in SEGMENTS.items() ]
+    ds.SharedFunctionalGroupsSequence = [item(PlaneOrientationSequence=[item(ImageOrientationPatient=list(orientation))],
+                                              PixelMeasuresSequence=[item(PixelSpacing=[row_spacing, col_spacing], SliceThickness=SPACING[2])])]
+    ds.PerFrameFunctionalGroupsSequence = per_frame
+    stack = np.stack(frames)
+    if fractional:
+        ds.SegmentationType = "FRACTIONAL"
+        ds.MaximumFractionalValue = 255
+        ds.BitsAllocated = ds.BitsStored = 8
+        ds.PixelData = np.where(stack, 200, 60).astype(np.uint8).tobytes()
+    else:
+        ds.SegmentationType = "BINARY"
+        ds.BitsAllocated = ds.BitsStored = 1
+        ds.PixelData = np.packbits(stack.ravel(), bitorder='little').tobytes()
+    ds.HighBit = ds.BitsStored - 1
+    ds.PixelRepresentation = 0
+    pydicom.dcmwrite(filename, ds, enforce_file_format=True)
+
+def reference(shape: tuple) -> sitk.Image:
+    image = sitk.Image(shape[::-1], sitk.sitkInt16)
+    image.SetSpacing(SPACING)
+    image.SetOrigin(ORIGIN)
+    return(image)
+
+def random_masks(shape: tuple) -> dict:
+    rng = np.random.default_rng(2)
+    return({ segment: rng.random(shape) < 0.4 for segment in SEGMENTS })
+
+# 7x5 frames are not a whole number of bytes, so the packed bits run across frame boundaries
+@pytest.mark.parametrize("shape", [(3, 5, 7), (3, 4, 8)])
+@pytest.mark.parametrize("layout", ["rows_along_y", "rows_along_x", "flipped_x"])
+@pytest.mark.parametrize("fractional", [False, True])
+def test_frames_land_on_the_grid(tmp_path, shape, layout, fractional):
+    masks = random_masks(shape)
+    filename = str(tmp_path / "seg.dcm")
+    write_seg(filename, masks, layout, fractional)
+
+    priorities = [3, 1, 2]
+    merged, metadata = decode_dicom_seg(filename, reference(shape), priorities)
+    expected = np.zeros(shape, dtype=np.uint8)
+    for p, segment in enumerate(priorities, start=1):
+        expected[masks[segment]] = p
+    assert np.array_equal(sitk.GetArrayFromImage(merged), expected)
+    assert merged.GetSpacing() == SPACING and merged.GetOrigin() == ORIGIN
+    assert [ m["OriginalLabel"] for m in metadata["MergedSegments"] ] == priorities
+
+def test_overlap_bits(tmp_path):
+    shape = (3, 5, 7)
+    masks = random_masks(shape)
+    filename = str(tmp_path / "seg.dcm")
+    write_seg(filename, masks)
+    merged, metadata, overlap = decode_dicom_seg(filename, reference(shape), [1, 2, 3], overlap=True)
+    expected = sum([ masks[segment].astype(np.uint8) << bit for bit, segment in enumerate([1, 2, 3]) ])
+    assert np.array_equal(sitk.GetArrayFromImage(overlap), expected)
+
+def test_off_grid_frames_are_rejected(tmp_path):
+    shape = (3, 5, 7)
+    filename = str(tmp_path / "seg.dcm")
+    write_seg(filename, random_masks(shape), shift=SPACING[0]/2)
+    assert decode_dicom_seg(filename, reference(shape)) is None
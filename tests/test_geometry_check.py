@@ -0,0 +1,38 @@
+import itertools
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from picslpipes.utils.geometry_check import reoriented_geometry, grid_differences, orientation, check_geometry
+
+CODES = ["LPS", "RAS", "LAI", "PIR", "SRA", "ILP"]
+
+def geometry(image: sitk.Image) -> dict:
+    return({"size": image.GetSize(), "origin": image.GetOrigin(), "spacing": image.GetSpacing(), "direction": image.GetDirection()})
+
+def oriented(code: str) -> sitk.Image:
+    # Anisotropic grid of different sizes along each axis, so any mixed up axis shows
+    image = sitk.Image((5, 6, 7), sitk.sitkInt16)
+    image.SetSpacing((0.7, 0.9, 2.5))
+    image.SetOrigin((-12.0, 30.0, 4.0))
+    return(sitk.DICOMOrient(image, code))
+
+@pytest.mark.parametrize("source, target", list(itertools.permutations(CODES, 2)))
+def test_matches_dicom_orient(source, target):
+    image = oriented(source)
+    expected = geometry(sitk.DICOMOrient(image, target))
+    result = reoriented_geometry(geometry(image), expected)
+    assert orientation(result) == target
+    assert grid_differences(expected, result) == []
+    assert result["size"] == expected["size"]
+    assert np.allclose(result["origin"], expected["origin"])
+
+def test_check_geometry_suggests_the_reorientation(tmp_path):
+    reference = str(tmp_path / "ct.nii")
+    moved = str(tmp_path / "seg.nii")
+    ct = oriented("LPS")
+    sitk.WriteImage(ct, reference)
+    sitk.WriteImage(sitk.DICOMOrient(ct, "RAS"), moved)
+    results = check_geometry(reference, [reference, moved])
+    assert results[reference]["ok"]
+    assert not results[moved]["ok"]
+    assert results[moved]["reorient"] == "LPS"
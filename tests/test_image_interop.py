@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+import nibabel as nib
+from picslpipes.utils.image_interop import Volume, from_sitk, to_sitk, from_nibabel, to_nibabel, from_itk, to_itk, from_ants, to_ants
+
+SIZE = (5, 6, 7)
+SPACING = (0.7, 0.9, 2.5)
+ORIGIN = (-12.0, 30.0, 4.0)
+
+def oblique_direction() -> tuple:
+    """
+    A rotation about an oblique axis followed by flipping y, so no axis is aligned or positive
+    """
+    a = 0.3
+    rotation = np.array([[np.cos(a), -np.sin(a), 0.0], [np.sin(a), np.cos(a), 0.0], [0.0, 0.0, 1.0]])
+    tilt = np.array([[1.0, 0.0, 0.0], [0.0, np.cos(a), -np.sin(a)], [0.0, np.sin(a), np.cos(a)]])
+    return(tuple((rotation @ tilt @ np.diag([1.0, -1.0, 1.0])).ravel()))
+
+DIRECTIONS = [tuple(np.eye(3).ravel()), (0.0, 0.0, 1.0, 1.0, 0.0, 0.0, 0.0, 1.0, 0.0), oblique_direction()]
+
+def sitk_image(direction: tuple) -> sitk.Image:
+    # Every voxel holds its own x, y and z, so any transposed or flipped axis shows
+    x, y, z = np.meshgrid(*[ np.arange(n) for n in SIZE ], indexing='ij')
+    image = sitk.GetImageFromArray((x + 10*y + 100*z).astype(np.int16).T)
+    image.SetSpacing(SPACING)
+    image.SetOrigin(ORIGIN)
+    image.SetDirection(direction)
+    return(image)
+
+def assert_same_image(a: sitk.Image, b: sitk.Image):
+    assert a.GetSize() == b.GetSize()
+    assert np.allclose(a.GetSpacing(), b.GetSpacing())
+    assert np.allclose(a.GetOrigin(), b.GetOrigin())
+    assert np.allclose(a.GetDirection(), b.GetDirection())
+    assert np.array_equal(sitk.GetArrayFromImage(a), sitk.GetArrayFromImage(b))
+
+def assert_same_volume(a: Volume, b: Volume):
+    assert a.same_grid(b)
+    assert np.array_equal(np.asarray(a.array), np.asarray(b.array))
+
+@pytest.mark.parametrize("direction", DIRECTIONS)
+def test_volume_is_indexed_x_y_z(direction):
+    image = sitk_image(direction)
+    vol = from_sitk(image)
+    assert vol.array.shape == SIZE
+    for index in [(0, 0, 0), (4, 1, 2), (1, 5, 6)]:
+        assert vol.array[index] == image.GetPixel(index)
+    # The origin and direction columns place voxels where SimpleITK does
+    index = (4, 1, 2)
+    point = np.asarray(vol.origin) + vol.direction @ (np.asarray(index) * np.asarray(vol.spacing))
+    assert np.allclose(point, image.TransformIndexToPhysicalPoint(index))
+
+@pytest.mark.parametrize("direction", DIRECTIONS)
+def test_sitk_nibabel_round_trip(tmp_path, direction):
+    image = sitk_image(direction)
+    vol = from_sitk(image)
+    assert_same_image(to_sitk(from_nibabel(to_nibabel(vol))), image)
+
+    # Geometry agrees with what the libraries write and read from a file
+    filename = str(tmp_path / "image.nii")
+    sitk.WriteImage(image, filename)
+    assert_same_volume(from_nibabel(nib.load(filename)), vol)
+    nib.save(to_nibabel(vol), str(tmp_path / "nibabel.nii"))
+    assert_same_image(sitk.ReadImage(str(tmp_path / "nibabel.nii")), image)
+
+@pytest.mark.parametrize("direction", DIRECTIONS)
+def test_cropped_volume(direction):
+    image = sitk_image(direction)
+    start = (1, 2, 3)
+    stop = (4, 6, 5)
+    size = [ b-a for a, b in zip(start, stop) ]
+    expected = sitk.RegionOfInterest(image, size, start)
+    crop = from_sitk(image).crop(start, stop)
+    assert_same_image(to_sitk(crop), expected)
+    assert_same_image(to_sitk(from_nibabel(to_nibabel(crop))), expected)
+
+@pytest.mark.parametrize("direction", DIRECTIONS)
+@pytest.mark.parametrize("cropped", [False, True])
+def test_itk_round_trip(tmp_path, direction, cropped):
+    itk = pytest.importorskip("itk")
+    image = sitk_image(direction)
+    vol = from_sitk(image)
+    if cropped:
+        # A view that is not contiguous, so to_itk copies it
+        vol = vol.crop((1, 0, 2), (5, 4, 7))
+        image = sitk.RegionOfInterest(image, [4, 4, 5], [1, 0, 2])
+    itk_image = to_itk(vol)
+    assert_same_image(to_sitk(from_itk(itk_image)), image)
+
+    filename = str(tmp_path / "image.nii")
+    sitk.WriteImage(image, filename)
+    read = itk.imread(filename)
+    assert np.allclose(tuple(read.GetOrigin()), tuple(itk_image.GetOrigin()))
+    assert np.allclose(itk.array_from_matrix(read.GetDirection()), itk.array_from_matrix(itk_image.GetDirection()))
+    assert np.array_equal(itk.GetArrayViewFromImage(read), itk.GetArrayViewFromImage(itk_image))
+
+@pytest.mark.parametrize("direction", DIRECTIONS)
+def test_ants_round_trip(direction):
+    pytest.importorskip("ants")
+    image = sitk_image(direction)
+    vol = from_sitk(image)
+    assert_same_image(to_sitk(from_ants(to_ants(vol))), image)
+    crop = vol.crop((1, 2, 3), (4, 6, 5))
+    assert_same_image(to_sitk(from_ants(to_ants(crop))), to_sitk(crop))
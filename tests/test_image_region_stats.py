@@ -0,0 +1,68 @@
+import sys
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from picslpipes.utils.image_region_stats import get_numpy_stats, get_simple_itk_stats
+
+KEY = {1: "left", 2: "right", 3: "tumor"}
+
+@pytest.fixture(scope="module")
+def volumes():
+    rng = np.random.default_rng(1)
+    ct = rng.normal(-500, 200, size=(20, 24, 28)).astype(np.int16)
+    labels = np.zeros(ct.shape, dtype=np.uint8)
+    labels[2:18, 3:12, 4:14] = 1
+    labels[2:18, 13:22, 4:14] = 2
+    labels[8:11, 5:8, 6:9] = 3
+    # A label outside the key is ignored
+    labels[0, 0, 0:4] = 7
+    images = []
+    for array in [ct, labels]:
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing((0.8, 0.8, 2.5))
+        images.append(image)
+    return({"ct": images[0], "labels": images[1], "ct_array": ct.astype(np.float64), "label_array": labels})
+
+def test_matches_simpleitk(volumes):
+    ours = get_numpy_stats(volumes["ct"], volumes["labels"], KEY)
+    theirs = get_simple_itk_stats(volumes["ct"], volumes["labels"], KEY, extended=False)
+    for label in KEY:
+        for metric in ["mean", "minimum", "maximum", "sd"]:
+            assert ours[label]["intensity"][metric] == pytest.approx(theirs[label]["intensity"][metric], rel=1e-9, abs=1e-9)
+        assert ours[label]["shape"]["physical_size"] == pytest.approx(theirs[label]["shape"]["physical_size"])
+
+def test_median_and_percentiles_are_exact(volumes):
+    ours = get_numpy_stats(volumes["ct"], volumes["labels"], KEY, percentiles=[5, 95])
+    for label in KEY:
+        values = volumes["ct_array"][volumes["label_array"] == label]
+        assert ours[label]["intensity"]["count"] == values.size
+        assert ours[label]["intensity"]["median"] == pytest.approx(np.median(values))
+        assert ours[label]["intensity"]["p05"] == pytest.approx(np.percentile(values, 5))
+        assert ours[label]["intensity"]["p95"] == pytest.approx(np.percentile(values, 95))
+
+def test_missing_labels_and_empty_key(volumes):
+    ours = get_numpy_stats(volumes["ct"], volumes["labels"], {4: "absent", 200: "beyond the max label"})
+    assert ours == {4: {"shape": {}, "intensity": {}}, 200: {"shape": {}, "intensity": {}}}
+    assert get_numpy_stats(volumes["ct"], volumes["labels"], {}) == {}
+
+def test_systems(volumes):
+    systems = [(volumes["labels"], KEY, "a"), (volumes["labels"], {1: "left"}, "b")]
+    ours = get_numpy_stats(volumes["ct"], systems)
+    assert sorted(ours.keys()) == ["a", "b"]
+    assert ours["b"][1] == ours["a"][1]
+
+def test_csv_without_pyarrow_matches_pyarrow(volumes, tmp_path, monkeypatch):
+    from picslpipes.utils.image_region_stats import write_stats
+    from picslpipes.utils.stats_store import read_stats_csv
+    systems = [(volumes["labels"], KEY, "regions")]
+    stats = get_simple_itk_stats(volumes["ct"], systems)
+    write_stats(systems, stats, "simpleitk", "S1", "T1", str(tmp_path / "pyarrow.csv"))
+    # A None entry in sys.modules makes import pyarrow raise ImportError
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    write_stats(systems, stats, "simpleitk", "S1", "T1", str(tmp_path / "stdlib.csv"))
+    with pytest.raises(ImportError):
+        write_stats(systems, stats, "simpleitk", "S1", "T1", store=str(tmp_path / "store"))
+    monkeypatch.undo()
+    expected = read_stats_csv(str(tmp_path / "pyarrow.csv"), "simpleitk")
+    assert read_stats_csv(str(tmp_path / "stdlib.csv"), "simpleitk").to_pylist() == expected.to_pylist()
+    assert expected.num_rows > 0
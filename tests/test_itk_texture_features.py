@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+import itk
+from picslpipes.utils.itk_texture_features import texture_feature_image, roi_texture_feature_image, tiled_texture_feature_image, intensity_bounds, quantize_image, compare_feature_maps
+
+BINS = 8
+HMIN = -40
+HMAX = 40
+# Feature family, radius, min and max run length distance
+PARAMS = [("GLCM", 1, None, None), ("GLRLM", 1, 1, 4), ("GLCM", 2, None, None)]
+
+def ct_image() -> itk.Image:
+    array = np.random.default_rng(3).integers(HMIN-10, HMAX+10, (9, 10, 11)).astype(np.int16)
+    # Histogram edges inside the first mask: hmax is outside the histogram, hmin is the first bin
+    array[4, 4, 5] = HMAX
+    array[4, 5, 5] = HMIN - 1
+    array[3, 3, 4] = HMIN
+    image = itk.GetImageFromArray(array)
+    image.SetSpacing([0.8, 0.9, 1.5])
+    image.SetOrigin([-5.0, 10.0, 2.0])
+    return(image)
+
+def mask_image(box: tuple) -> itk.Image:
+    array = np.zeros((9, 10, 11), dtype=np.uint8)
+    array[box] = 1
+    mask = itk.GetImageFromArray(array)
+    mask.SetSpacing([0.8, 0.9, 1.5])
+    mask.SetOrigin([-5.0, 10.0, 2.0])
+    return(mask)
+
+# Inside the volume, and touching the first slice and the last column so the halo is clipped
+BOXES = [(slice(3, 6), slice(3, 7), slice(4, 7)), (slice(0, 3), slice(2, 5), slice(8, 11))]
+
+@pytest.mark.parametrize("features, radius, min_distance, max_distance", PARAMS)
+@pytest.mark.parametrize("box", BOXES)
+def test_roi_matches_full_volume_inside_mask(features, radius, min_distance, max_distance, box):
+    im = ct_image()
+    mask = mask_image(box)
+    full = texture_feature_image(im, mask, features, BINS, HMIN, HMAX, radius, min_distance, max_distance)
+    roi = roi_texture_feature_image(im, mask, features, BINS, HMIN, HMAX, radius, min_distance, max_distance)
+    assert np.array_equal(itk.GetArrayViewFromImage(roi).shape, itk.GetArrayViewFromImage(full).shape)
+    assert np.allclose(roi.GetOrigin(), im.GetOrigin()) and np.allclose(roi.GetSpacing(), im.GetSpacing())
+    assert compare_feature_maps(roi, full, mask) == 0.0
+    # The filter leaves voxels outside the mask at zero, and the paste adds nothing outside the box
+    outside = itk.GetArrayViewFromImage(mask) == 0
+    assert not np.any(itk.GetArrayViewFromImage(roi)[outside])
+
+def test_roi_of_empty_mask():
+    assert roi_texture_feature_image(ct_image(), mask_image((slice(0, 0),)), "GLCM", BINS, HMIN, HMAX, 1) is None
+
+def test_tiled_matches_untiled():
+    # 2 jobs split the 9 slices at z=4, inside the mask; workers are spawned processes
+    im = ct_image()
+    mask = mask_image(BOXES[0])
+    full = texture_feature_image(im, mask, "GLCM", BINS, HMIN, HMAX, 2)
+    tiled = tiled_texture_feature_image(im, mask, "GLCM", BINS, HMIN, HMAX, 2, jobs=2, threads=1)
+    assert np.allclose(tiled.GetOrigin(), im.GetOrigin()) and np.allclose(tiled.GetSpacing(), im.GetSpacing())
+    assert compare_feature_maps(tiled, full, mask) == 0.0
+
+@pytest.mark.parametrize("features, radius, min_distance, max_distance", PARAMS[:2])
+@pytest.mark.parametrize("mask_bounds", [False, True])
+def test_quantized_image_gives_the_same_features(features, radius, min_distance, max_distance, mask_bounds):
+    im = ct_image()
+    mask = mask_image(BOXES[0])
+    if mask_bounds:
+        # The mask maximum is hmax itself, so the brightest mask voxels fall outside the histogram
+        hmin, hmax = intensity_bounds(im, mask)
+    else:
+        hmin, hmax = HMIN, HMAX
+    values = itk.GetArrayViewFromImage(im)
+    inside = itk.GetArrayViewFromImage(mask) > 0
+    assert np.any(values[inside] == hmax)
+    assert mask_bounds or np.any(values[inside] < hmin)
+
+    # A slab size that does not divide the 9 slices
+    quantized = quantize_image(im, BINS, hmin, hmax, slab_size=4)
+    q = itk.GetArrayViewFromImage(quantized)
+    assert q.dtype == np.int16
+    assert np.all(q[values == hmax] == BINS) and np.all(q[values < hmin] == BINS)
+    assert np.all((q >= 0) & (q <= BINS))
+
+    reference = texture_feature_image(im, mask, features, BINS, hmin, hmax, radius, min_distance, max_distance)
+    result = texture_feature_image(quantized, mask, features, BINS, 0, BINS, radius, min_distance, max_distance)
+    assert compare_feature_maps(result, reference, mask) == 0.0
+
+def test_intensity_bounds():
+    im = ct_image()
+    values = itk.GetArrayViewFromImage(im)
+    assert intensity_bounds(im) == (int(values.min()), int(values.max()))
+    inside = values[BOXES[1]]
+    assert intensity_bounds(im, mask_image(BOXES[1])) == (int(inside.min()), int(inside.max()))
+    assert intensity_bounds(im, mask_image((slice(0, 0),))) is None
@@ -0,0 +1,56 @@
+import numpy as np
+import SimpleITK as sitk
+from picslpipes.utils.label_cleaning import clean_label_components
+
+def labels() -> np.ndarray:
+    """
+    Label 1: a 4x4x4 block and a 2 voxel island. Label 2: a 3x3x3 block touching label 1, a
+    1 voxel island and a voxel that only touches the block at a corner.
+    """
+    array = np.zeros((10, 10, 10), dtype=np.uint16)
+    array[0:4, 0:4, 0:4] = 1
+    array[8, 8, 8:10] = 1
+    array[0:3, 4:7, 0:3] = 2
+    array[9, 0, 9] = 2
+    array[3, 7, 3] = 2
+    return(array)
+
+def label_image(array: np.ndarray) -> sitk.Image:
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing((2.0, 1.0, 1.0))
+    image.SetOrigin((1.0, 2.0, 3.0))
+    return(image)
+
+def blocks() -> np.ndarray:
+    array = labels()
+    array[8, 8, 8:10] = 0
+    array[9, 0, 9] = 0
+    array[3, 7, 3] = 0
+    return(array)
+
+def cleaned(**kwargs) -> np.ndarray:
+    image = label_image(labels())
+    out = clean_label_components(image, **kwargs)
+    assert out.GetPixelID() == image.GetPixelID()
+    assert out.GetSpacing() == image.GetSpacing() and out.GetOrigin() == image.GetOrigin()
+    return(sitk.GetArrayFromImage(out))
+
+def test_largest_component_of_each_label():
+    # Touching regions of different labels and corner neighbors are separate components
+    assert np.array_equal(cleaned(), blocks())
+
+def test_minimum_size_keeps_larger_islands():
+    expected = blocks()
+    expected[8, 8, 8:10] = 1
+    assert np.array_equal(cleaned(min_voxels=2), expected)
+    # The island is 2 voxels of 2mm^3
+    assert np.array_equal(cleaned(min_volume=4.0), expected)
+    assert np.array_equal(cleaned(min_volume=4.5), blocks())
+
+def test_labels_filter():
+    expected = blocks()
+    expected[expected == 2] = 0
+    assert np.array_equal(cleaned(labels=[1]), expected)
+
+def test_keep_everything():
+    assert np.array_equal(cleaned(largest=False), labels())
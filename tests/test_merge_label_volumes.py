@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from picslpipes.utils.merge_label_volumes import merge_label_volumes, merge_label_volume_files, overlap_bits, count_overlap_values, overlap_metadata
+
+SHAPE = (7, 6, 5)
+SPACING = (0.8, 0.9, 2.5)
+ORIGIN = (-10.0, 20.0, 5.0)
+DIRECTION = (0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0)
+
+def label_arrays() -> dict:
+    """
+    Overlapping [z,y,x] masks keyed by label, each with a different nonzero value
+    """
+    arrays = {}
+    rng = np.random.default_rng(4)
+    for label in ["gtv", "lung", "nodes", "heart"]:
+        arrays[label] = np.where(rng.random(SHAPE) < 0.35, len(arrays)+1, 0).astype(np.uint8)
+    return(arrays)
+
+def label_image(array: np.ndarray) -> sitk.Image:
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing(SPACING)
+    image.SetOrigin(ORIGIN)
+    image.SetDirection(DIRECTION)
+    return(image)
+
+def baseline(arrays: dict, priorities: list) -> np.ndarray:
+    merged = np.zeros(SHAPE, dtype=np.uint8)
+    for priority, label in enumerate(priorities, start=1):
+        if label in arrays:
+            merged = np.where(arrays[label] > 0, priority, merged)
+    return(merged)
+
+def write_inputs(tmp_path, arrays: dict) -> dict:
+    files = {}
+    for label, array in arrays.items():
+        files[label] = str(tmp_path / (label+".nii"))
+        sitk.WriteImage(label_image(array), files[label])
+    return(files)
+
+def assert_geometry(image: sitk.Image):
+    assert image.GetSize() == SHAPE[::-1]
+    assert np.allclose(image.GetSpacing(), SPACING)
+    assert np.allclose(image.GetOrigin(), ORIGIN)
+    assert np.allclose(image.GetDirection(), DIRECTION)
+
+# "spleen" has no input and is skipped
+PRIORITIES = [["lung", "gtv", "nodes", "heart"], ["heart", "spleen", "nodes", "lung", "gtv"]]
+
+@pytest.mark.parametrize("priorities", PRIORITIES)
+def test_in_memory_merge_matches_where_chain(priorities):
+    arrays = label_arrays()
+    merged, metadata = merge_label_volumes({ label: label_image(a) for label, a in arrays.items() }, priorities)
+    assert np.array_equal(sitk.GetArrayFromImage(merged), baseline(arrays, priorities))
+    assert_geometry(merged)
+    assert [ s["OriginalLabel"] for s in metadata["MergedSegments"] ] == [ l for l in priorities if l in arrays ]
+
+# 2 and 3 do not divide the 7 slices, 7 and 64 read the volume in one slab
+@pytest.mark.parametrize("slab_size", [1, 2, 3, 7, 64])
+@pytest.mark.parametrize("priorities", PRIORITIES)
+def test_streaming_merge_matches_in_memory_merge(tmp_path, priorities, slab_size):
+    arrays = label_arrays()
+    merged, metadata = merge_label_volumes({ label: label_image(a) for label, a in arrays.items() }, priorities)
+    streamed, streamed_metadata = merge_label_volume_files(write_inputs(tmp_path, arrays), priorities, slab_size)
+    assert np.array_equal(sitk.GetArrayFromImage(streamed), sitk.GetArrayFromImage(merged))
+    assert np.array_equal(sitk.GetArrayFromImage(streamed), baseline(arrays, priorities))
+    assert_geometry(streamed)
+    assert streamed_metadata == metadata
+
+def test_streaming_merge_rejects_mismatched_grids(tmp_path):
+    arrays = label_arrays()
+    files = write_inputs(tmp_path, arrays)
+    sitk.WriteImage(label_image(arrays["gtv"][:-1]), files["gtv"])
+    assert merge_label_volume_files(files, PRIORITIES[0]) is None
+
+def overlapping_masks() -> dict:
+    """
+    Masks of three labels over 8 voxels: single labels, 2-way and 3-way overlaps and an empty voxel
+    """
+    claims = [["a"], ["a", "b"], ["a", "b", "c"], ["b", "c"], ["c"], [], ["a", "c"], ["a", "b", "c"]]
+    return({ label: np.array([ label in c for c in claims ], dtype=np.uint8).reshape((2, 2, 2)) for label in ["a", "b", "c"] })
+
+EXPECTED_OVERLAP = {
+    "Bits": [ {"OriginalLabel": "a", "Bit": 0, "Value": 1}, {"OriginalLabel": "b", "Bit": 1, "Value": 2},
+              {"OriginalLabel": "c", "Bit": 2, "Value": 4} ],
+    "OverlapVoxels": 5,
+    "PairCounts": [ {"Labels": ["a", "b"], "Voxels": 3}, {"Labels": ["a", "c"], "Voxels": 3},
+                    {"Labels": ["b", "c"], "Voxels": 3} ]
+}
+
+@pytest.mark.parametrize("slab_size", [None, 1])
+def test_overlap_bitmask_and_metadata(tmp_path, slab_size):
+    masks = overlapping_masks()
+    if slab_size is None:
+        merged, metadata, overlap = merge_label_volumes({ label: sitk.GetImageFromArray(m) for label, m in masks.items() }, ["a", "b", "c"], overlap=True)
+    else:
+        files = {}
+        for label, mask in masks.items():
+            files[label] = str(tmp_path / (label+".nii"))
+            sitk.WriteImage(sitk.GetImageFromArray(mask), files[label])
+        merged, metadata, overlap = merge_label_volume_files(files, ["a", "b", "c"], slab_size, overlap=True)
+    assert sitk.GetArrayFromImage(overlap).ravel().tolist() == [1, 3, 7, 6, 4, 0, 5, 7]
+    assert overlap.GetPixelID() == sitk.sitkUInt16
+    assert metadata["Overlap"] == EXPECTED_OVERLAP
+
+def test_count_overlap_values_accumulates_multi_label_voxels():
+    counts = {}
+    count_overlap_values(np.array([1, 3, 7, 6, 4, 0], dtype=np.uint16), counts)
+    assert counts == {3: 1, 6: 1, 7: 1}
+    count_overlap_values(np.array([5, 7, 2, 8], dtype=np.uint16), counts)
+    assert counts == {3: 1, 5: 1, 6: 1, 7: 2}
+    assert overlap_metadata({"a": 0, "b": 1, "c": 2}, counts) == EXPECTED_OVERLAP
+    assert overlap_metadata({"a": 0, "b": 1}, {})["PairCounts"] == []
+
+def test_overlap_bits_dtype():
+    bits, dtype = overlap_bits(list(range(16)))
+    assert dtype == np.uint16 and bits[15] == 15
+    bits, dtype = overlap_bits(list(range(17)))
+    assert dtype == np.uint32 and bits[16] == 16
+    assert overlap_bits(list(range(32)))[1] == np.uint32
+    assert overlap_bits(list(range(33))) is None
+
+def test_overlap_above_16_labels_uses_32_bits():
+    # Label 16 sets bit 16, which only a uint32 bitmask can hold
+    masks = { label: np.zeros((1, 1, 2), dtype=np.uint8) for label in range(17) }
+    masks[0][0, 0, 0] = 1
+    masks[16][0, 0, 0] = 1
+    masks[16][0, 0, 1] = 1
+    merged, metadata, overlap = merge_label_volumes({ label: sitk.GetImageFromArray(m) for label, m in masks.items() }, list(range(17)), overlap=True)
+    assert overlap.GetPixelID() == sitk.sitkUInt32
+    assert sitk.GetArrayFromImage(overlap).ravel().tolist() == [1 | (1 << 16), 1 << 16]
+    assert metadata["Overlap"]["PairCounts"] == [ {"Labels": [0, 16], "Voxels": 1} ]
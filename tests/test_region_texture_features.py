@@ -0,0 +1,149 @@
+import numpy as np
+import pytest
+import itk
+import SimpleITK as sitk
+from picslpipes.utils.itk_texture_features import quantize_image
+from picslpipes.utils.region_texture_features import haralick_features, digitize, get_region_texture_stats, texture_offsets, label_cooccurrence_matrices, label_run_length_matrices
+
+ITK_FEATURES = {"energy": "GetEnergy", "entropy": "GetEntropy", "correlation": "GetCorrelation",
+                "inverse_difference_moment": "GetInverseDifferenceMoment", "inertia": "GetInertia",
+                "cluster_shade": "GetClusterShade", "cluster_prominence": "GetClusterProminence",
+                "haralick_correlation": "GetHaralickCorrelation"}
+
+def itk_haralick_features(counts: np.ndarray) -> dict:
+    """
+    Features of a co-occurrence count matrix from ITK's HistogramToTextureFeaturesFilter
+    """
+    bins = counts.shape[0]
+    histogram = itk.Histogram[itk.D].New()
+    histogram.SetMeasurementVectorSize(2)
+    size = itk.Array[itk.UL](2)
+    size.Fill(bins)
+    lower = itk.Array[itk.D](2)
+    lower.Fill(0)
+    upper = itk.Array[itk.D](2)
+    upper.Fill(bins)
+    histogram.Initialize(size, lower, upper)
+    index = itk.Index[2]()
+    for i in range(bins):
+        for j in range(bins):
+            index[0] = i
+            index[1] = j
+            histogram.SetFrequencyOfIndex(index, int(counts[i, j]))
+    filtr = itk.HistogramToTextureFeaturesFilter[itk.Histogram[itk.D]].New()
+    filtr.SetInput(histogram)
+    filtr.Update()
+    return({ name: getattr(filtr, getter)() for name, getter in ITK_FEATURES.items() })
+
+def symmetric_counts(bins: int, seed: int, sparse: bool=False) -> np.ndarray:
+    counts = np.random.default_rng(seed).integers(0, 50, (bins, bins))
+    if sparse:
+        # Mostly empty with a few rare pairs, below the entropy cutoff
+        counts[counts < 45] = 0
+        counts[0, 0] = 1000000
+    return(counts + counts.T)
+
+@pytest.mark.parametrize("bins, seed, sparse", [(4, 0, False), (8, 1, False), (16, 2, False), (8, 3, True)])
+def test_haralick_features_match_itk(bins, seed, sparse):
+    counts = symmetric_counts(bins, seed, sparse)
+    ours = haralick_features(counts)
+    theirs = itk_haralick_features(counts)
+    for name in ITK_FEATURES:
+        assert ours[name] == pytest.approx(theirs[name], rel=1e-9, abs=1e-12), name
+
+def test_haralick_features_of_a_constant_region():
+    counts = np.zeros((4, 4), dtype=np.int64)
+    counts[2, 2] = 10
+    feat = haralick_features(counts)
+    assert feat["energy"] == 1.0 and feat["entropy"] == 0.0 and feat["correlation"] == 0.0
+    assert haralick_features(np.zeros((4, 4), dtype=np.int64)) == {}
+
+@pytest.mark.parametrize("bins, hmin, hmax", [(8, -40, 40), (7, -40, 41), (16, -33, 17)])
+def test_digitize_matches_quantize_image(bins, hmin, hmax):
+    # Values below hmin, at hmin, at hmax and above it
+    values = np.arange(-45, 46, dtype=np.int16).reshape((1, 1, -1))
+    expected = itk.GetArrayFromImage(quantize_image(itk.GetImageFromArray(values), bins, hmin, hmax))
+    q = digitize(values, bins, hmin, hmax)
+    assert np.array_equal(q, expected)
+    assert q[0, 0, hmax+45] == bins and q[0, 0, hmax+44] == bins-1 and q[0, 0, hmin+45] == 0
+
+def test_default_bounds_bin_the_region_maximum():
+    ct = np.zeros((2, 2, 2), dtype=np.int16)
+    ct[1, 1, 1] = 3
+    image = sitk.GetImageFromArray(ct)
+    labels = sitk.GetImageFromArray(np.ones((2, 2, 2), dtype=np.uint8))
+    # By default the brightest voxel is in the last bin, with hmax at the maximum it is left out
+    assert get_region_texture_stats(image, labels, {1: "lung"}, bins=4)[1]["glcm"]["energy"] < 1.0
+    assert get_region_texture_stats(image, labels, {1: "lung"}, bins=4, hmin=0, hmax=3)[1]["glcm"]["energy"] == 1.0
+
+def labelled_volume(bins: int) -> tuple:
+    """
+    Tiny volume with labels 1 and 2, background, out of range voxels (bin bins) and runs along
+    whole rows, columns and diagonals that touch the border on both ends
+    """
+    rng = np.random.default_rng(5)
+    shape = (4, 5, 6)
+    index = rng.integers(0, 3, shape).astype(np.int32)
+    quantized = rng.integers(0, bins+1, shape).astype(np.int32)
+    index[:, 0, :] = 1
+    quantized[:, 0, :] = 0
+    index[1, :, 2] = 2
+    quantized[1, :, 2] = 1
+    for k in range(4):
+        index[k, k+1, 5-k] = 2
+        quantized[k, k+1, 5-k] = 2
+    return((index, quantized))
+
+def inside(shape: tuple, voxel: tuple) -> bool:
+    return(all([ 0 <= v < s for v, s in zip(voxel, shape) ]))
+
+def brute_force_cooccurrence(index, quantized, n_labels, bins):
+    counts = np.zeros((n_labels+1, bins, bins), dtype=np.int64)
+    for v in np.ndindex(index.shape):
+        for offset in texture_offsets():
+            w = tuple([ a+b for a, b in zip(v, offset) ])
+            if not inside(index.shape, w) or index[v] == 0 or index[v] != index[w]:
+                continue
+            if quantized[v] < bins and quantized[w] < bins:
+                counts[index[v], quantized[v], quantized[w]] += 1
+                counts[index[v], quantized[w], quantized[v]] += 1
+    return(counts)
+
+def brute_force_run_lengths(index, quantized, n_labels, bins, run_bins):
+    counts = np.zeros((n_labels+1, bins, run_bins), dtype=np.int64)
+    def same_run(v, w):
+        return(inside(index.shape, w) and index[w] == index[v] and quantized[w] == quantized[v])
+    for offset in texture_offsets():
+        for v in np.ndindex(index.shape):
+            if index[v] == 0 or quantized[v] >= bins:
+                continue
+            if same_run(v, tuple([ a-b for a, b in zip(v, offset) ])):
+                continue
+            length = 1
+            while same_run(v, tuple([ a+length*b for a, b in zip(v, offset) ])):
+                length += 1
+            counts[index[v], quantized[v], min(length, run_bins)-1] += 1
+    return(counts)
+
+def test_texture_offsets_are_the_13_directions():
+    offsets = texture_offsets()
+    assert len(set(offsets)) == 13
+    assert sorted(offsets + [ tuple([ -d for d in o ]) for o in offsets ]) == sorted([ tuple([ d-1 for d in o ]) for o in np.ndindex(3, 3, 3) if o != (1, 1, 1) ])
+
+@pytest.mark.parametrize("bins", [2, 3])
+def test_cooccurrence_matches_brute_force(bins):
+    index, quantized = labelled_volume(bins)
+    counts = label_cooccurrence_matrices(index, quantized, 2, bins)
+    assert np.array_equal(counts, brute_force_cooccurrence(index, quantized, 2, bins))
+    assert counts[1].sum() > 0 and counts[2].sum() > 0 and counts[0].sum() == 0
+
+# Rows of 6 voxels are longer than 3 run bins, so the last bin also collects longer runs
+@pytest.mark.parametrize("bins, run_bins", [(2, 3), (3, 3), (3, 8)])
+def test_run_lengths_match_brute_force(bins, run_bins):
+    index, quantized = labelled_volume(bins)
+    counts = label_run_length_matrices(index, quantized, 2, bins, run_bins)
+    assert np.array_equal(counts, brute_force_run_lengths(index, quantized, 2, bins, run_bins))
+    if run_bins == 8:
+        # Whole rows of label 1 along x (the row at z=1 is cut by label 2), the column of label 2
+        # along y and the diagonal of label 2
+        assert counts[1, 0, 5] >= 3 and counts[2, 1, 4] >= 1 and counts[2, 2, 3] >= 1
@@ -0,0 +1,47 @@
+import numpy as np
+import SimpleITK as sitk
+from picslpipes.utils.relabel_volume import relabel_lookup_tables, relabel_volume
+
+TABLES = {
+    "lungs": {"1": 1, "2": 1, "3": 2, "4": 2, "5": 2},
+    "mask": {1: 1, 2: 1, 3: 1, 4: 1, 5: 1},
+    "right_middle": {4: 1}
+}
+
+def label_image(array: np.ndarray) -> sitk.Image:
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing((0.5, 0.75, 2.0))
+    image.SetOrigin((-10.0, 5.0, 3.0))
+    return(image)
+
+def test_lookup_tables():
+    lut = relabel_lookup_tables(TABLES, 6)
+    assert lut.shape == (3, 7)
+    assert lut.dtype == np.uint8
+    assert lut[0].tolist() == [0, 1, 1, 2, 2, 2, 0]
+    assert lut[2].tolist() == [0, 0, 0, 0, 1, 0, 0]
+
+def test_lookup_tables_cover_mapped_labels_above_the_image_max():
+    lut = relabel_lookup_tables({"a": {9: 3}}, 2)
+    assert lut.shape == (1, 10)
+    assert lut[0, 9] == 3
+
+def test_lookup_tables_widen_for_large_output_labels():
+    assert relabel_lookup_tables({"a": {1: 300}}, 1).dtype == np.uint16
+
+def test_relabel_matches_per_voxel_mapping():
+    rng = np.random.default_rng(0)
+    array = rng.integers(0, 7, size=(6, 7, 8)).astype(np.uint8)
+    image = label_image(array)
+    out = relabel_volume(image, TABLES)
+    assert list(out.keys()) == list(TABLES.keys())
+    for name, mapping in TABLES.items():
+        table = { int(k): v for k, v in mapping.items() }
+        expected = np.vectorize(lambda v: table.get(int(v), 0))(array)
+        assert np.array_equal(sitk.GetArrayFromImage(out[name]), expected)
+        assert out[name].GetSpacing() == image.GetSpacing()
+        assert out[name].GetOrigin() == image.GetOrigin()
+
+def test_relabel_rejects_float_and_negative_labels():
+    assert relabel_volume(label_image(np.ones((2, 2, 2), dtype=np.float32)), TABLES) is None
+    assert relabel_volume(label_image(np.full((2, 2, 2), -1, dtype=np.int16)), TABLES) is None
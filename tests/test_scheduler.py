@@ -0,0 +1,101 @@
+import os
+import time
+import multiprocessing
+import pytest
+from picslpipes.pipeline.scheduler import Manifest, shard_order, run_worker, _local_worker
+
+# Each unit appends a line to OUTPUT/ran, so units that run twice show
+COMMAND = "mkdir -p {output} && echo {subject} >> {output}/ran"
+
+@pytest.fixture
+def dataset(tmp_path):
+    root = tmp_path / "root"
+    for subject in range(5):
+        for session in ["baseline", "followup"]:
+            directory = root / ("subject-"+str(subject)) / session
+            directory.mkdir(parents=True)
+            (directory / "X_CT.nii.gz").write_bytes(b"")
+    # Not a unit: no CT
+    (root / "subject-9" / "baseline").mkdir(parents=True)
+    return({"root": str(root), "manifest": str(tmp_path / "manifest"), "output": str(tmp_path / "output")})
+
+def runs(output: str) -> dict:
+    counts = {}
+    for subject in os.listdir(output):
+        for session in os.listdir(os.path.join(output, subject)):
+            with open(os.path.join(output, subject, session, "ran")) as f:
+                counts[subject+"/"+session] = len(f.readlines())
+    return(counts)
+
+def test_shard_order():
+    units = list(range(7))
+    assert shard_order(units, 0, 3) == [0, 3, 6, 1, 4, 2, 5]
+    assert shard_order(units, 1, 3) == [1, 4, 2, 5, 0, 3, 6]
+    for task in range(3):
+        assert sorted(shard_order(units, task, 3)) == units
+
+def test_build_adds_new_sessions_once(dataset):
+    manifest = Manifest(dataset["manifest"])
+    assert len(manifest.build(dataset["root"])["units"]) == 10
+    assert len(manifest.build(dataset["root"])["units"]) == 10
+    assert manifest.summary() == {"pending": 10}
+
+def test_claims_are_exclusive_until_stale(dataset):
+    manifest = Manifest(dataset["manifest"], stale=60.0)
+    other = Manifest(dataset["manifest"], stale=60.0)
+    assert manifest.claim("unit")
+    assert not other.claim("unit")
+    manifest.release("unit")
+    assert other.claim("unit")
+
+    # A claim whose heartbeat stopped is taken over, a fresh heartbeat keeps it
+    old = time.time() - 120.0
+    os.utime(other.claim_path("unit"), (old, old))
+    other.heartbeat("unit")
+    assert not manifest.claim("unit")
+    os.utime(other.claim_path("unit"), (old, old))
+    assert manifest.claim("unit")
+
+def test_one_task_steals_the_other_shards(dataset):
+    Manifest(dataset["manifest"]).build(dataset["root"])
+    ran = run_worker(dataset["manifest"], 0, 4, dataset["output"], command=COMMAND)
+    assert len(ran) == 10 and set(ran.values()) == {"done"}
+    assert set(runs(dataset["output"]).values()) == {1}
+    # Nothing is left for a later task
+    assert run_worker(dataset["manifest"], 1, 4, dataset["output"], command=COMMAND) == {}
+
+def test_concurrent_tasks_run_each_unit_once(dataset):
+    Manifest(dataset["manifest"]).build(dataset["root"])
+    kwargs = {"manifest_dir": dataset["manifest"], "out_root": dataset["output"], "command": COMMAND, "tasks": 3}
+    with multiprocessing.get_context('spawn').Pool(3) as pool:
+        ran = pool.map(_local_worker, [ dict(kwargs, task=i) for i in range(3) ])
+    assert sum([ len(r) for r in ran ]) == 10
+    counts = runs(dataset["output"])
+    assert len(counts) == 10 and set(counts.values()) == {1}
+
+def test_failing_units_are_retried_then_failed(dataset):
+    manifest = Manifest(dataset["manifest"])
+    manifest.build(dataset["root"])
+    ran = run_worker(dataset["manifest"], 0, 1, dataset["output"], command="exit 3", attempts=2)
+    assert set(ran.values()) == {"failed"}
+    units = manifest.read()["units"]
+    assert all([ u["attempts"] == 2 and u["error"] == "exit status 3" for u in units ])
+    assert manifest.reset_failed() == 10
+    assert manifest.summary() == {"pending": 10}
+
+def test_dead_running_units_are_summarized_as_stale_and_taken_over(dataset):
+    manifest = Manifest(dataset["manifest"], stale=60.0)
+    units = manifest.build(dataset["root"])["units"]
+    # Two units were running on a node that died, one of them still within the stale timeout
+    for unit in units[:2]:
+        manifest.claim(unit["id"])
+        manifest.update(unit["id"], status="running", host="dead:1", attempts=1)
+    old = time.time() - 120.0
+    os.utime(manifest.claim_path(units[0]["id"]), (old, old))
+    assert manifest.summary() == {"pending": 8, "running": 1, "stale": 1}
+
+    ran = run_worker(dataset["manifest"], 0, 1, dataset["output"], command=COMMAND, stale=60.0)
+    assert len(ran) == 9 and units[0]["id"] in ran and units[1]["id"] not in ran
+    assert manifest.summary() == {"done": 9, "running": 1}
+    os.utime(manifest.claim_path(units[1]["id"]), (old, old))
+    assert manifest.summary() == {"done": 9, "stale": 1}
@@ -0,0 +1,20 @@
+import os
+import sys
+import glob
+import subprocess
+import pytest
+from conftest import SRC
+
+# The README and the driver script run the tools by path from a checkout, without installing
+# the package or setting PYTHONPATH
+ROOT = os.path.dirname(SRC)
+SCRIPTS = sorted([ f for f in glob.glob(os.path.join(SRC, "picslpipes", "*", "*.py")) if "__main__" in open(f).read() ]
+                 + glob.glob(os.path.join(ROOT, "scripts", "nsclc_radiomics", "*.py"))
+                 + [os.path.join(ROOT, "scripts", "benchmarks", "image_region_stats_benchmark.py")])
+
+@pytest.mark.parametrize("script", SCRIPTS, ids=[ os.path.basename(s) for s in SCRIPTS ])
+def test_runs_by_path(script, tmp_path):
+    env = { k: v for k, v in os.environ.items() if k != "PYTHONPATH" }
+    proc = subprocess.run([sys.executable, script, "-h"], capture_output=True, text=True, env=env, cwd=str(tmp_path))
+    assert proc.returncode == 0, proc.stderr
+    assert "usage:" in proc.stdout
@@ -0,0 +1,57 @@
+import os
+import json
+import pytest
+from picslpipes.utils.segment_index import SegmentIndex
+from picslpipes.utils.dicom_seg_meta import dicom_seg_meta
+from picslpipes.utils.dicom_seg_files import dicom_seg_files
+
+def write_meta(path: str, segments: dict):
+    meta = {"segmentAttributes": [ [{"SegmentDescription": name, "labelID": label}] for name, label in segments.items() ]}
+    with open(path, 'w') as f:
+        json.dump(meta, f)
+
+def bump_mtime(path: str):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+@pytest.fixture
+def dataset(tmp_path):
+    session = tmp_path / "root" / "subject-1" / "session-1"
+    session.mkdir(parents=True)
+    meta = str(session / "CT-seg-meta.json")
+    write_meta(meta, {"Lung-Left": 1, "Lung-Right": 2})
+    for label in [1, 2]:
+        (session / ("CT_seg-"+str(label)+".nii.gz")).write_bytes(b"")
+    db = str(tmp_path / "segments.db")
+    index = SegmentIndex(db)
+    index.refresh(str(tmp_path / "root"), jobs=1)
+    index.close()
+    return({"db": db, "meta": meta, "session": str(session)})
+
+def test_lookup_from_index(dataset):
+    assert dicom_seg_meta(["Lung-Left", "Lung-Right"], dataset["meta"], dataset["db"]) == {"Lung-Left": 1, "Lung-Right": 2}
+    files = dicom_seg_files(dataset["session"], [1, 2], index=dataset["db"])
+    assert sorted(files.keys()) == [1, 2]
+
+def test_changed_meta_is_read_again(dataset):
+    write_meta(dataset["meta"], {"Lung-Left": 3, "Lung-Right": 4})
+    bump_mtime(dataset["meta"])
+    index = SegmentIndex(dataset["db"], read_only=True)
+    assert not index.has_source(dataset["meta"])
+    index.close()
+    assert dicom_seg_meta(["Lung-Left", "Lung-Right"], dataset["meta"], dataset["db"]) == {"Lung-Left": 3, "Lung-Right": 4}
+
+def test_removed_seg_file_is_not_returned(dataset):
+    os.remove(os.path.join(dataset["session"], "CT_seg-2.nii.gz"))
+    assert sorted(dicom_seg_files(dataset["session"], [1, 2], index=dataset["db"]).keys()) == [1]
+
+def test_added_seg_file_is_found(dataset):
+    with open(os.path.join(dataset["session"], "CT_seg-3.nii.gz"), "wb"):
+        pass
+    assert sorted(dicom_seg_files(dataset["session"], [1, 3], index=dataset["db"]).keys()) == [1, 3]
+
+def test_missing_index_is_not_created(dataset, tmp_path):
+    missing = str(tmp_path / "typo.db")
+    assert dicom_seg_meta(["Lung-Left"], dataset["meta"], missing) == {"Lung-Left": 1}
+    assert sorted(dicom_seg_files(dataset["session"], [1, 2], index=missing).keys()) == [1, 2]
+    assert not os.path.exists(missing)
@@ -0,0 +1,38 @@
+import pyarrow.compute as pc
+from picslpipes.utils.stats_store import stats_to_table, append_stats, query_stats, write_csv, read_stats_csv
+
+KEY = {1: "left", 2: "right"}
+
+def lobe_stats(offset: float) -> dict:
+    return({ label: {"intensity": {"mean": label+offset, "median": label+offset+0.5}, "shape": {"volume": 10.0*label}} for label in KEY })
+
+def values(table, calculator: str) -> dict:
+    rows = table.filter(pc.field("calculator") == calculator).to_pylist()
+    return({ (r["label"], r["measure"], r["metric"]): r["value"] for r in rows })
+
+def test_round_trip(tmp_path):
+    store = str(tmp_path / "store")
+    table = stats_to_table(lobe_stats(0.0), KEY, "lobes", "simpleitk", "subject-1", "session-1")
+    append_stats(store, table)
+    result = query_stats(store)
+    assert result.num_rows == table.num_rows
+    assert sorted(result.to_pylist(), key=str) == sorted(table.select(result.column_names).to_pylist(), key=str)
+
+def test_calculators_do_not_replace_each_other(tmp_path):
+    store = str(tmp_path / "store")
+    append_stats(store, stats_to_table(lobe_stats(0.0), KEY, "lobes", "simpleitk", "subject-1", "session-1"))
+    append_stats(store, stats_to_table(lobe_stats(100.0), KEY, "lobes", "numpy", "subject-1", "session-1"))
+    # Rerunning one calculator replaces only its own rows
+    append_stats(store, stats_to_table(lobe_stats(1.0), KEY, "lobes", "simpleitk", "subject-1", "session-1"))
+
+    result = query_stats(store, subject="subject-1", system="lobes")
+    assert result.num_rows == 2 * 6
+    assert values(result, "simpleitk")[(1, "intensity", "mean")] == 2.0
+    assert values(result, "numpy")[(1, "intensity", "mean")] == 101.0
+    assert query_stats(store, calculator="numpy", metric="mean").num_rows == 2
+
+def test_csv_round_trip(tmp_path):
+    table = stats_to_table(lobe_stats(0.0), KEY, "lobes", "simpleitk", "subject-1", "session-1")
+    filename = str(tmp_path / "stats.csv")
+    write_csv(table, filename)
+    assert read_stats_csv(filename, "simpleitk").to_pylist() == table.to_pylist()
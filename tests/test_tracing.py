@@ -0,0 +1,32 @@
+import os
+import sys
+import json
+import subprocess
+from conftest import SRC
+
+CHILD = "from picslpipes.utils.tracing import stage\nwith stage('child'):\n    pass\n"
+
+PARENT = """import sys, subprocess, argparse
+from picslpipes.utils.tracing import add_trace_arguments, apply_trace_arguments, stage
+parser = argparse.ArgumentParser()
+add_trace_arguments(parser)
+apply_trace_arguments(parser.parse_args(sys.argv[1:3]))
+with stage('parent'):
+    subprocess.run([sys.executable, '-c', sys.argv[-1]], check=True)
+"""
+
+def test_only_the_traced_process_writes_the_chrome_trace(tmp_path):
+    env = dict(os.environ, PYTHONPATH=SRC)
+    env.pop("PICSLPIPES_TRACE", None)
+    trace = str(tmp_path / "run.jsonl")
+    chrome = str(tmp_path / "run.trace.json")
+
+    # A process that only inherits the variable appends its record and leaves the Chrome trace alone
+    subprocess.run([sys.executable, "-c", CHILD], env=dict(env, PICSLPIPES_TRACE=trace), check=True)
+    assert os.path.exists(trace)
+    assert not os.path.exists(chrome)
+
+    subprocess.run([sys.executable, "-c", PARENT, "--trace", trace, CHILD], env=env, check=True)
+    with open(chrome) as f:
+        events = json.load(f)["traceEvents"]
+    assert sorted([ e["name"] for e in events ]) == ["child", "child", "parent"]
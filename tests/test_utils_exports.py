@@ -0,0 +1,45 @@
+import os
+import sys
+import subprocess
+import pytest
+from conftest import SRC
+
+# Each check runs in a fresh interpreter, the import order is what is being tested
+def run_python(code: str) -> str:
+    env = dict(os.environ, PYTHONPATH=SRC)
+    proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env)
+    assert proc.returncode == 0, proc.stderr
+    return(proc.stdout.strip())
+
+FIRST = [
+    "pass",
+    "import picslpipes.utils.merge_label_volumes",
+    "from picslpipes.utils.merge_label_volumes import merge_label_volume_files",
+    "from picslpipes.utils import merge_label_volume_files",
+    "import picslpipes.utils.relabel_volume",
+    "import picslpipes.utils.dicom_seg_decode",
+]
+
+@pytest.mark.parametrize("first", FIRST)
+def test_exports_are_functions_whatever_is_imported_first(first):
+    out = run_python(first+"\n"
+                     "from picslpipes.utils import merge_label_volume_files, decode_dicom_seg, clean_label_components\n"
+                     "import picslpipes.utils as utils\n"
+                     "print(all(callable(f) and not isinstance(f, type(utils)) for f in\n"
+                     "          [merge_label_volume_files, decode_dicom_seg, clean_label_components, utils.merge_label_volume_files]))")
+    assert out == "True"
+
+@pytest.mark.parametrize("first", FIRST)
+def test_submodules_are_modules_whatever_is_imported_first(first):
+    out = run_python(first+"\n"
+                     "import picslpipes.utils.relabel_volume as rv\n"
+                     "import picslpipes.utils.merge_label_volumes as mlv\n"
+                     "from picslpipes.utils import merge_label_volumes\n"
+                     "print(rv.__name__, mlv.__name__, merge_label_volumes is mlv, callable(rv.relabel_volume))")
+    assert out == "picslpipes.utils.relabel_volume picslpipes.utils.merge_label_volumes True True"
+
+def test_json_tools_do_not_import_simpleitk():
+    out = run_python("import sys\n"
+                     "from picslpipes.utils import dicom_seg_meta, dicom_seg_files\n"
+                     "print('SimpleITK' in sys.modules)")
+    assert out == "False"